@@ -0,0 +1,287 @@
+"""Copyright 2018.
+
+Authors: Christiane Ahlheim, Sebastian Bobadilla-Suarez, Kurt Braunlich,
+Giles Greenway, & Olivia Guest.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+Benchmarks of the estimator's hot paths.
+
+Times the estimator, and traces its peak memory, over a grid of voxels,
+conditions, sessions and subjects of synthetic data, and writes the results
+as JSON, so that they can be compared between commits.
+
+Call this from the ./Python/FunctionalDimensionality directory using:
+python benchmarks/benchmark.py --preset quick --output before.json
+python benchmarks/benchmark.py --preset quick --compare before.json
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+from funcdim.crossval import make_components
+from funcdim.crossval import reconstruct
+from funcdim.crossval import svd_nested_crossval
+from funcdim.funcdim import covdiag
+from funcdim.funcdim import functional_dimensionality
+from funcdim.funcdim import pre_proc
+from funcdim.util import simulate_subjects
+import itertools
+import json
+import numpy as np
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# Grids of the number of voxels, which are cubes so that the data can be
+# generated by simulate_subjects, conditions, sessions and subjects.
+PRESETS = {
+    'quick': {'voxels': [64, 1000], 'conditions': [8, 16],
+              'sessions': [4, 6], 'subjects': [2]},
+    'full': {'voxels': [64, 1000, 8000, 27000, 103823],
+             'conditions': [8, 16, 50, 100], 'sessions': [4, 8, 16],
+             'subjects': [1, 4, 16]},
+}
+
+# Number of residual time points in each session, for whitening.
+N_TIMEPOINTS = 50
+
+
+def synthetic_subject(n_voxels, n_conditions, n_sessions, seed=0):
+    """Beta values and residuals for one subject, from simulate_subjects.
+
+    Returns
+    -------
+        data: n_voxels * n_conditions * n_sessions Numpy array of betas,
+            with four dimensions and noise in every session.
+        res: n_voxels * N_TIMEPOINTS * n_sessions Numpy array of residuals.
+
+    """
+    rng = np.random.default_rng(seed)
+    data = next(simulate_subjects(min(4, n_conditions - 1), n_voxels,
+                                  n_conditions, n_sessions, nsubs=1,
+                                  run_noise=1.0, rng=rng))
+    res = rng.standard_normal((n_voxels, N_TIMEPOINTS, n_sessions))
+    return data, res
+
+
+def mask_for(n_voxels):
+    """Cubic mask of all True for n_voxels."""
+    side = int(np.round(n_voxels**(1 / 3)))
+    return np.ones((side, side, side), dtype=bool)
+
+
+def case_inputs(case, n_voxels, n_conditions, n_sessions, n_subjects,
+                workers):
+    """Inputs of a case, and a function that runs the case on them."""
+    data, res = synthetic_subject(n_voxels, n_conditions, n_sessions)
+
+    if case == 'make_components':
+        return lambda: make_components(data)
+    if case == 'reconstruct':
+        U, S, V = make_components(data[:, :, 1:])
+        return lambda: reconstruct(U, S, V, n_conditions // 2,
+                                   data[:, :, 0])
+    if case.startswith('svd_nested_crossval'):
+        option, method = case[len('svd_nested_crossval['):-1].split(',')
+        return lambda: svd_nested_crossval(data, '1', option, method)
+    if case == 'covdiag':
+        return lambda: covdiag(res[:, :, 0].T)
+    if case == 'pre_proc':
+        return lambda: pre_proc(data, res)
+    if case == 'functional_dimensionality':
+        mask = mask_for(n_voxels)
+
+        def run():
+            # Threads rather than processes, so that the peak memory of the
+            # workers is traced.
+            with ThreadPoolExecutor(workers) as pool:
+                return functional_dimensionality(
+                    (data for _ in range(n_subjects)), n_subjects, mask,
+                    res=(res for _ in range(n_subjects)), pool=pool)
+        return run
+    raise ValueError('Unknown case: "' + str(case) + '".')
+
+
+# The cases, and estimates of the memory that each needs, in bytes, to skip
+# those that would not fit.
+CASES = {
+    'make_components': lambda n, m, o, s: 8 * n * m * (o + 3),
+    'reconstruct': lambda n, m, o, s: 8 * n * m * (o + 4),
+    'svd_nested_crossval[full,svd]': lambda n, m, o, s: 8 * n * m * (o + 4),
+    'svd_nested_crossval[mean,svd]': lambda n, m, o, s: 8 * n * m * (o + 4),
+    'svd_nested_crossval[full,gram]': lambda n, m, o, s: 8 * n * m * (o + 4),
+    'svd_nested_crossval[mean,gram]': lambda n, m, o, s: 8 * n * m * (o + 4),
+    'covdiag': lambda n, m, o, s: 8 * (4 * n**2 + 2 * N_TIMEPOINTS * n * o),
+    'pre_proc': lambda n, m, o, s: 8 * (4 * o * n**2 +
+                                        2 * N_TIMEPOINTS * n * o),
+    'functional_dimensionality': lambda n, m, o, s: 8 * (4 * o * n**2 +
+                                                         N_TIMEPOINTS * n * o),
+}
+
+# Cases that run the whole pipeline, over the grid of subjects.
+COHORT_CASES = ['functional_dimensionality']
+
+
+def measure(run, repeat):
+    """Peak traced memory of one run, and wall times of repeat more."""
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return peak, times
+
+
+def run_benchmarks(grid, cases=None, repeat=5, workers=1, max_bytes=2**31,
+                   log=None):
+    """Run the benchmarks over a grid.
+
+    Arguments
+    ---------
+        grid: Dictionary of lists of the numbers of 'voxels', 'conditions',
+            'sessions' and 'subjects', as PRESETS.
+        cases: Names of the cases to run, from CASES; default: all.
+        repeat: Number of timed runs of each case; default: 5.
+        workers: Number of threads for functional_dimensionality;
+            default: 1.
+        max_bytes: Cases estimated to need more memory than this are
+            skipped; default: 2 GiB.
+        log: File to report progress to; default: None.
+
+    Returns
+    -------
+        List of a dictionary for each case and size of the grid, of its
+        parameters, and its wall times and peak traced memory in bytes, or
+        'skipped' if it was estimated to need more than max_bytes.
+
+    """
+    if cases is None:
+        cases = list(CASES)
+
+    records = []
+    for n_voxels, n_conditions, n_sessions in itertools.product(
+            grid['voxels'], grid['conditions'], grid['sessions']):
+        for case in cases:
+            for n_subjects in (grid['subjects'] if case in COHORT_CASES
+                               else [1]):
+                record = {'case': case, 'voxels': n_voxels,
+                          'conditions': n_conditions, 'sessions': n_sessions,
+                          'subjects': n_subjects}
+                if CASES[case](n_voxels, n_conditions, n_sessions,
+                               n_subjects) > max_bytes:
+                    record['skipped'] = True
+                else:
+                    peak, times = measure(case_inputs(
+                        case, n_voxels, n_conditions, n_sessions, n_subjects,
+                        workers), repeat)
+                    record.update({'times': times, 'min_time': min(times),
+                                   'median_time': float(np.median(times)),
+                                   'peak_bytes': peak})
+                records.append(record)
+                if log is not None:
+                    print(json.dumps(record), file=log)
+    return records
+
+
+def git_commit():
+    """The current commit of the repository, or None outside of git."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def machine_info():
+    """Description of the commit, software and machine of a benchmark."""
+    return {'commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()}
+
+
+def record_key(record):
+    """The case and size of a benchmark record."""
+    return tuple(record[key] for key in ['case', 'voxels', 'conditions',
+                                         'sessions', 'subjects'])
+
+
+def compare(baseline, records, file=sys.stdout):
+    """Print the ratio of the median times of records to a baseline's."""
+    baseline = {record_key(record): record for record in baseline
+                if 'median_time' in record}
+    print('{:<32} {:>7} {:>4} {:>3} {:>3}  {:>10} {:>10}  {:>7}'.format(
+        'case', 'voxels', 'cond', 'ses', 'sub', 'baseline', 'time',
+        'speedup'), file=file)
+    for record in records:
+        old = baseline.get(record_key(record))
+        if old is None or 'median_time' not in record:
+            continue
+        print('{:<32} {:>7} {:>4} {:>3} {:>3}  {:9.4f}s {:9.4f}s  '
+              '{:6.2f}x'.format(*record_key(record), old['median_time'],
+                                record['median_time'],
+                                old['median_time'] / record['median_time']),
+              file=file)
+
+
+def main(argv=None):
+    """Run the benchmarks from the command line."""
+    parser = argparse.ArgumentParser(
+        description="Benchmarks of the estimator's hot paths.")
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='quick')
+    for key in ['voxels', 'conditions', 'sessions', 'subjects']:
+        parser.add_argument('--' + key, type=int, nargs='+',
+                            help='overrides the preset')
+    parser.add_argument('--cases', nargs='+', choices=sorted(CASES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--max-bytes', type=float, default=2**31)
+    parser.add_argument('--output', help='JSON file of the results')
+    parser.add_argument('--compare', help='JSON file of earlier results')
+    args = parser.parse_args(argv)
+
+    grid = dict(PRESETS[args.preset])
+    for key in grid:
+        if getattr(args, key) is not None:
+            grid[key] = getattr(args, key)
+
+    results = {'machine': machine_info(), 'grid': grid,
+               'records': run_benchmarks(grid, args.cases, args.repeat,
+                                         args.workers, args.max_bytes,
+                                         log=sys.stderr)}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f)['records'], results['records'])
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ python demos/demo_real_data.py
 """
 
 from funcdim.funcdim import functional_dimensionality
+from funcdim.stats import bootstrap_dimensionality
 import numpy as np
 import pandas as pd
 
@@ -34,3 +35,6 @@ df.to_csv('./demos/demo_data/demo_real_data_output.csv')
 
 # Show the median dimensionality:
 print(df['winning_model'].median())
+
+# Show a bootstrap 95% confidence interval for the median dimensionality:
+print(bootstrap_dimensionality(results, seed=0)['median_winning_model_ci'])
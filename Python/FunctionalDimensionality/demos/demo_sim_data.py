@@ -6,7 +6,7 @@ python demos/demo_sim_data.py
 """
 
 from funcdim.funcdim import functional_dimensionality
-from funcdim.util import demo_data
+from funcdim.util import simulate_subjects
 import numpy as np
 import pandas as pd
 
@@ -17,15 +17,14 @@ nsubs = 20
 # Create the subject IDs.
 subject_IDs = [str(i) for i in range(1, nsubs + 1)]
 
-# Create the random demo data.
-data = demo_data(nvoxels=nvoxels, nsubs=nsubs, functional_dims=4)
-
 # Create a mask (all True) for nvoxels.
 mask_dim = int(np.round(np.power(nvoxels, 1 / 3)))
 mask = np.ones((mask_dim, mask_dim, mask_dim), dtype='bool')
 
-# Create an iterator over the 20 subjects.
-all_subjects = (data[:, :, :, i] for i in range(nsubs))
+# Create an iterator over the 20 subjects of random demo data, which are only
+# generated as they are needed.
+all_subjects = simulate_subjects(nvoxels=nvoxels, nsubs=nsubs,
+                                 functional_dims=4)
 
 # Find the dimensionality.
 results = functional_dimensionality(all_subjects, nsubs, mask,
@@ -16,4 +16,10 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from . import crossval
+from . import group
+from . import parallel
+from . import profiling
+from . import results
+from . import searchlight
+from . import stats
 from . import util
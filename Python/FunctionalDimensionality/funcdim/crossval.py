@@ -17,17 +17,24 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from funcdim.profiling import profiled
+from funcdim.profiling import stage
 import numpy as np
 from scipy.stats import pearsonr
 
 
-def make_components(data):
+@profiled
+def make_components(data, method='svd'):
     """Factorize an array of mean beta values over all sessions.
 
     Arguments
     ---------
         data: n * m * o Numpy array of beta values for n voxels and m
         conditions over o sessions.
+        method: 'svd' or 'gram'; default: 'svd'. 'gram' eigendecomposes the
+            m * m Gram matrix of the mean instead, which is much cheaper when
+            n is much larger than m, and agrees with 'svd' up to the signs of
+            the components.
 
     Returns
     -------
@@ -37,10 +44,71 @@ def make_components(data):
             beta values over all sessions.
 
     """
-    u, diag, v = np.linalg.svd(np.mean(data, axis=2), full_matrices=False)
-    return (u, np.diag(diag), v.T)
+    mean = np.mean(data, axis=2)
+
+    if method == 'svd':
+        u, diag, v = np.linalg.svd(mean, full_matrices=False)
+        return (u, np.diag(diag), v.T)
+    elif method == 'gram':
+        S, V = gram_components(np.matmul(mean.T, mean))
+        return (recover_u(mean, S, V), S, V)
+    else:
+        raise ValueError('Unknown method: "' + str(method) +
+                         '"; "svd" and "gram" are the only methods.')
+
+
+def gram_components(gram):
+    """Factorize the Gram matrix of the mean beta values over all sessions.
+
+    Arguments
+    ---------
+        gram: m * m Numpy array M.T M, where M is the n * m mean of the beta
+            values over all sessions, for n voxels and m conditions. This may
+            have leading axes, over which the factorization is broadcast.
+
+    Returns
+    -------
+        S: m * m diagonal Numpy array of the singular values of M, in
+            descending order.
+        V: m * m Numpy array of the right singular vectors of M.
+
+    """
+    eigval, V = np.linalg.eigh(gram)
+    # eigh returns the eigenvalues in ascending order, and rounding leaves
+    # those of a rank-deficient matrix scattered around zero. They are zeroed
+    # below a tolerance relative to the largest, as in recover_u, so that,
+    # as for the SVD, the null space of M has singular values of exactly
+    # zero.
+    eigval = eigval[..., ::-1]
+    tolerance = eigval[..., :1] * gram.shape[-1] * np.finfo(eigval.dtype).eps
+    diag = np.sqrt(np.where(eigval > tolerance, eigval, 0.0))
+    return (diag[..., np.newaxis] * np.eye(diag.shape[-1], dtype=diag.dtype),
+            V[..., ::-1])
+
+
+def recover_u(mean, S, V):
+    """Recover the left singular vectors from a factorization of M.T M.
+
+    Arguments
+    ---------
+        mean: n * m Numpy array M for n voxels and m conditions.
+        S: m * m diagonal Numpy array of the singular values of M.
+        V: m * m Numpy array of the right singular vectors of M.
+
+    Returns
+    -------
+        U: n * m Numpy array such that M = USV.T. Columns for singular values
+            that are zero to within rounding are set to zero.
+
+    """
+    diag = np.diag(S)
+    nonzero = diag > diag.max() * max(mean.shape) * np.finfo(diag.dtype).eps
+    U = np.zeros(mean.shape, dtype=np.result_type(mean, V))
+    U[:, nonzero] = np.matmul(mean, V[:, nonzero]) / diag[nonzero]
+    return U
 
 
+@profiled
 def reconstruct(U, S, V, ncomp, testdata):
     """Pearson correlation between low-dimensional reconstruction of a matrix.
 
@@ -71,85 +139,485 @@ def reconstruct(U, S, V, ncomp, testdata):
     return correlation
 
 
-def svd_nested_crossval(data, subject_ID, option='full'):
-    """Estimate dimensionality for voxels for conditions and sessions.
+@profiled
+def reconstruct_all(U, S, V, testdata):
+    """Pearson correlations for reconstructions of every dimensionality.
+
+    Equivalent to calling reconstruct for each value of ncomp, but the
+    reconstructions are built up as cumulative sums of rank-one terms so that
+    only running sums of the reconstruction, its square and its product with
+    the test set are needed, rather than a full reconstruction per rank.
+
+    Arguments
+    ---------
+        U: n * m Numpy array for n voxels and m conditions.
+        S: m * m diagonal Numpy array.
+        V: m * m Numpy array such that M = USV.T is a reconstrution of the
+            original matrix.
+        testdata: n * m Numpy array for n voxels and m conditions to be
+            correlated with the reconstructions.
+
+        All arguments may have leading axes, over which the calculation is
+        broadcast.
+
+    Returns
+    -------
+        Numpy array of length m, such that element ncomp is the Pearson
+        correlation between the reconstruction of dimensionality ncomp + 1
+        and testdata, as returned by reconstruct(U, S, V, ncomp, testdata).
+
+    """
+    s = np.diagonal(S, axis1=-2, axis2=-1)
+    # Contribution of each rank-one term to the sum of the reconstruction,
+    # and to its inner product with the test set.
+    sum_x = s * U.sum(axis=-2) * V.sum(axis=-2)
+    sum_xy = s * np.einsum('...ij,...ij->...j', U, np.matmul(testdata, V))
+    # The columns of U and V are orthonormal, so the squared Frobenius norm of
+    # each reconstruction is the sum of the squared singular values.
+    sum_xx = s**2
+    correlations = rank_correlations(sum_x, sum_xx, sum_xy,
+                                     testdata.sum(axis=(-2, -1)),
+                                     np.square(testdata).sum(axis=(-2, -1)),
+                                     testdata.shape[-2] * testdata.shape[-1])
+    # With fewer voxels than conditions, there are fewer components than
+    # conditions, and every higher dimensionality reconstructs M exactly.
+    n_missing = testdata.shape[-1] - correlations.shape[-1]
+    if n_missing > 0:
+        correlations = np.concatenate(
+            [correlations,
+             np.repeat(correlations[..., -1:], n_missing, axis=-1)], axis=-1)
+    return correlations
+
+
+@profiled
+def reconstruct_all_gram(S, V, cross, mean_sum, test_sum, test_sumsq, n):
+    """Correlations for reconstructions of every dimensionality, from Grams.
+
+    As reconstruct_all, but computed entirely in the m-dimensional condition
+    space, so that the left singular vectors are never needed. All arguments
+    may have leading axes over which the calculation is broadcast.
+
+    Arguments
+    ---------
+        S: m * m diagonal Numpy array of the singular values of the n * m
+            matrix M to be reconstructed, for n voxels and m conditions.
+        V: m * m Numpy array of the right singular vectors of M.
+        cross: m * m Numpy array M.T T, for the n * m test set T.
+        mean_sum: Numpy array of length m, the sums of the columns of M.
+        test_sum: Sum of T.
+        test_sumsq: Sum of the squares of T.
+        n: Number of elements in T.
+
+    Returns
+    -------
+        Numpy array of length m, such that element ncomp is the Pearson
+        correlation between the reconstruction of dimensionality ncomp + 1
+        and T.
+
+    """
+    s = np.diagonal(S, axis1=-2, axis2=-1)
+    # For each rank-one term s u v.T, s u = M v, so its sum is
+    # (1.T M v)(v.T 1), and its inner product with T is v.T M.T T v. Terms
+    # of the null space of M, with s of zero, are exactly zero, rather than
+    # left to rounding, so that reconstructions of every dimensionality
+    # above the rank of M tie, as they do for reconstruct_all.
+    nonzero = s > 0
+    sum_x = np.where(nonzero,
+                     np.matmul(mean_sum[..., np.newaxis, :], V)[..., 0, :] *
+                     V.sum(axis=-2), 0.0)
+    sum_xy = np.where(nonzero,
+                      np.einsum('...ij,...ij->...j', V, np.matmul(cross, V)),
+                      0.0)
+    return rank_correlations(sum_x, s**2, sum_xy, test_sum, test_sumsq, n)
+
+
+def fold_correlations(mean, testdata, method='svd'):
+    """Correlations between every reconstruction of a training set and a test.
+
+    Arguments
+    ---------
+        mean: n * m Numpy array M of the mean beta values over the training
+            sessions, for n voxels and m conditions.
+        testdata: n * m Numpy array for n voxels and m conditions to be
+            correlated with the reconstructions of M.
+        method: 'svd' or 'gram', as for make_components; default: 'svd'.
+
+        mean and testdata may have matching leading axes, in which case the
+        factorizations of every M are computed in a single stacked call.
+
+    Returns
+    -------
+        Numpy array of length m, such that element ncomp is the Pearson
+        correlation between the reconstruction of M of dimensionality
+        ncomp + 1 and testdata.
+
+    """
+    if method == 'svd':
+        with stage('factorize'):
+            U, diag, Vt = np.linalg.svd(mean, full_matrices=False)
+        S = diag[..., np.newaxis] * np.eye(diag.shape[-1], dtype=diag.dtype)
+        return reconstruct_all(U, S, np.swapaxes(Vt, -2, -1), testdata)
+    elif method == 'gram':
+        mean_t = np.swapaxes(mean, -2, -1)
+        with stage('factorize'):
+            S, V = gram_components(np.matmul(mean_t, mean))
+        return reconstruct_all_gram(S, V, np.matmul(mean_t, testdata),
+                                    mean.sum(axis=-2),
+                                    testdata.sum(axis=(-2, -1)),
+                                    np.square(testdata).sum(axis=(-2, -1)),
+                                    testdata.shape[-2] * testdata.shape[-1])
+    else:
+        raise ValueError('Unknown method: "' + str(method) +
+                         '"; "svd" and "gram" are the only methods.')
+
+
+def rank_correlations(sum_x, sum_xx, sum_xy, sum_y, sum_yy, n):
+    """Pearson correlations from the rank-one terms of reconstructions.
+
+    Arguments
+    ---------
+        sum_x: Numpy array whose last axis holds the contribution of each
+            rank-one term to the sum of the reconstruction.
+        sum_xx: As sum_x, for the sum of the squared reconstruction.
+        sum_xy: As sum_x, for the sum of the reconstruction times the test
+            set.
+        sum_y: Sum of the test set, broadcastable against sum_x without its
+            last axis.
+        sum_yy: Sum of the squared test set, as for sum_y.
+        n: Number of elements in the test set.
+
+    Returns
+    -------
+        Numpy array the shape of sum_x, whose last axis holds the correlations
+        for reconstructions of increasing dimensionality, of the type of the
+        sums.
+
+    """
+    dtype = np.result_type(sum_x, sum_xx, sum_xy, sum_y, sum_yy)
+    # The covariances and variances are differences of nearly equal sums, so
+    # they are taken in double precision even for single-precision data.
+    sum_x = np.cumsum(sum_x, axis=-1, dtype=np.float64)
+    sum_xx = np.cumsum(sum_xx, axis=-1, dtype=np.float64)
+    sum_xy = np.cumsum(sum_xy, axis=-1, dtype=np.float64)
+    sum_y = np.expand_dims(sum_y, -1).astype(np.float64)
+    sum_yy = np.expand_dims(sum_yy, -1).astype(np.float64)
+
+    cov = sum_xy - sum_x * sum_y / n
+    var_x = sum_xx - sum_x**2 / n
+    var_y = sum_yy - sum_y**2 / n
+    return (cov / np.sqrt(var_x * var_y)).astype(dtype, copy=False)
+
+
+@profiled
+def batched_correlations(data, method='svd'):
+    """Correlations for every fold and dimensionality from stacked factors.
+
+    The training and validation sets of every fold are stacked, so that all
+    of them are factorized in a single broadcast call. This avoids the
+    overhead of many small factorizations, at the cost of holding every
+    fold in memory at once.
+
+    Arguments
+    ---------
+        data: n * m * o Numpy array of beta values for n voxels and m
+            conditions over o sessions.
+        method: 'svd' or 'gram', as for make_components; default: 'svd'.
+
+    Returns
+    -------
+        rmat: (m - 1) * (o - 1) * o Numpy array of the correlations between
+            reconstructions of each training set and its validation session,
+            indexed by dimensionality, validation session and test session.
+        test_rmat: m * o Numpy array of the correlations between
+            reconstructions of each validation set and its test session,
+            indexed by dimensionality and test session.
+
+    """
+    n_session = data.shape[2]
+    sessions = np.moveaxis(data, 2, 0)
+    val_sessions = np.array([np.delete(np.arange(n_session), i_test)
+                             for i_test in range(n_session)])
+
+    # As in svd_nested_crossval, sums rather than means over the sessions.
+    data_val = data.sum(axis=2) - sessions
+    data_val_test = sessions[val_sessions]
+    data_val_train = data_val[:, np.newaxis] - data_val_test
+
+    rmat = fold_correlations(data_val_train, data_val_test, method)[..., :-1]
+    test_rmat = fold_correlations(data_val, sessions, method)
+    return (np.transpose(rmat), test_rmat.T)
+
+
+def session_grams(data):
+    """Gram matrices between the sessions of an array of beta values.
 
     Arguments
     ---------
         data: n * m * o Numpy array of beta values for n voxels and m
             conditions over o sessions.
+
+    Returns
+    -------
+        gram: o * m * o * m Numpy array, such that gram[a, :, b, :] is
+            X_a.T X_b, where X_a is the n * m array of session a.
+        col_sum: o * m Numpy array of the sums of the columns of each X_a.
+
+    """
+    n_voxels, n_beta, n_session = data.shape
+    stacked = np.moveaxis(data, 2, 1).reshape(n_voxels, n_session * n_beta)
+    gram = np.matmul(stacked.T, stacked)
+    return (gram.reshape(n_session, n_beta, n_session, n_beta),
+            stacked.sum(axis=0).reshape(n_session, n_beta))
+
+
+def weighted_grams(weights, gram):
+    """Gram matrices of weighted sums of sessions.
+
+    Arguments
+    ---------
+        weights: Numpy array whose last axis holds the weight of each of o
+            sessions in a sum.
+        gram: o * m * o * m Numpy array of the Gram matrices between
+            sessions, as returned by session_grams, which may have leading
+            axes.
+
+    Returns
+    -------
+        m * m Numpy array of the Gram matrix of each sum, with the leading
+        axes of gram followed by those of weights.
+
+    """
+    n_session, n_beta = gram.shape[-2:]
+    flat_weights = weights.reshape(-1, n_session)
+    # Sum over the second session of each pair with one matrix product, and
+    # then over the first for each sum.
+    half = np.matmul(np.swapaxes(gram, -2, -1).reshape(-1, n_session),
+                     flat_weights.T)
+    half = half.reshape(gram.shape[:-2] + (n_beta, len(flat_weights)))
+    grams = np.einsum('fa,...amnf->...fmn', flat_weights, half)
+    return grams.reshape(gram.shape[:-4] + weights.shape[:-1] +
+                         (n_beta, n_beta))
+
+
+@profiled
+def gram_crossval_correlations(gram, col_sum, n_voxels):
+    """Correlations for every fold and dimensionality, from session Grams.
+
+    Every fold's training and validation sets are sums of sessions, so their
+    Gram matrices, and their products with the test sessions, are sums of
+    the Gram matrices between sessions. The whole nested cross-validation
+    therefore runs on m * m matrices, without the voxels, and matches
+    crossval_correlations with method 'gram'.
+
+    Arguments
+    ---------
+        gram: o * m * o * m Numpy array of the Gram matrices between
+            sessions, as returned by session_grams.
+        col_sum: o * m Numpy array of the column sums of each session.
+        n_voxels: Number of voxels.
+
+        gram and col_sum may have matching leading axes, such as for
+        permutations of the data, over which every fold is computed in the
+        same stacked calls.
+
+    Returns
+    -------
+        rmat: (m - 1) * (o - 1) * o Numpy array of validation correlations,
+            as returned by batched_correlations.
+        test_rmat: m * o Numpy array of test correlations, as returned by
+            batched_correlations.
+
+        Both have the leading axes of gram and col_sum.
+
+    """
+    n_session, n_beta = col_sum.shape[-2:]
+    n_batch_axes = col_sum.ndim - 2
+    val_sessions = np.array([np.delete(np.arange(n_session), i_test)
+                             for i_test in range(n_session)])
+    # The traces of the Gram matrices of each session with itself are the
+    # sums of the squares of the sessions.
+    sumsq = np.einsum('...amam->...a', gram)
+    session_sum = col_sum.sum(axis=-1)
+
+    def correlations(weights, test):
+        # Correlations for the sums of the sessions in weights, tested on
+        # the sessions in test. The leading axes of gram are followed by
+        # those of weights.
+        fold_shape = gram.shape[:n_batch_axes] + (1,) * (weights.ndim - 1)
+        S, V = gram_components(weighted_grams(weights, gram))
+        test_gram = np.moveaxis(np.take(gram, test, axis=-2),
+                                (n_batch_axes, n_batch_axes + 1), (-3, -2))
+        cross = np.einsum('...a,...amn->...mn', weights, test_gram)
+        mean_sum = np.einsum('...a,...am->...m', weights,
+                             col_sum.reshape(fold_shape + col_sum.shape[-2:]))
+        return reconstruct_all_gram(S, V, cross, mean_sum,
+                                    np.take(session_sum, test, axis=-1),
+                                    np.take(sumsq, test, axis=-1),
+                                    n_voxels * n_beta)
+
+    identity = np.eye(n_session, dtype=gram.dtype)
+    val_weights = 1.0 - identity
+    train_weights = val_weights[:, np.newaxis, :] - identity[val_sessions]
+
+    rmat = correlations(train_weights, val_sessions)[..., :-1]
+    test_rmat = correlations(val_weights, np.arange(n_session))
+    return (np.swapaxes(rmat, -3, -1), np.swapaxes(test_rmat, -2, -1))
+
+
+@profiled
+def select_models(rmat, test_rmat, option='full'):
+    """Pick the winning models and their correlations with the test sessions.
+
+    Arguments
+    ---------
+        rmat: (m - 1) * (o - 1) * o Numpy array of validation correlations,
+            as returned by batched_correlations.
+        test_rmat: m * o Numpy array of test correlations, as returned by
+            batched_correlations.
         option: 'full' or 'mean'; default: 'full'.
 
+        rmat and test_rmat may have matching leading axes, which the winning
+        models and test correlations also have.
+
     Returns
     -------
-        subject_ID: Unique indentifier for each subject.
         test_run: Which test set was used.
-        winning_model: Winning models/dimensionality.
+        winning_model: Index of the winning models, one less than their
+            dimensionality.
         test_correlation: The out-of-samplel correlation for the winning model.
 
     """
-    n_beta, n_session = data.shape[1:]
-    n_comp = n_beta - 1
-    rmat = np.zeros((n_comp, n_session - 1, n_session))
-    test_run = []
+    n_session = rmat.shape[-1]
 
     if option == 'full':
-        winning_model = np.zeros((n_session - 1, n_session), dtype='int32')
-        test_correlation = np.zeros((n_session - 1, n_session))
-    elif option == 'mean':
-        winning_model = np.zeros(n_session, dtype='int32')
-        test_correlation = np.zeros(n_session)
+        test_run = [i_test + 1 for i_test in range(n_session)
+                    for j_val in range(n_session - 1)]
+        # The index with the greatest correlation corresponds to the best
+        # dimensionality.
+        winning_model = np.argmax(rmat, axis=-3).astype('int32')
+        test_correlation = np.take_along_axis(test_rmat, winning_model,
+                                              axis=-2)
     else:
-        raise ValueError('Unknown option: "' + str(option) +
-                         '"; "full" and "mean" are the only options.')
+        test_run = [i_test + 1 for i_test in range(n_session)]
+        winning_model = np.argmax(np.mean(rmat, axis=-2),
+                                  axis=-2).astype('int32')
+        test_correlation = np.take_along_axis(
+            test_rmat, winning_model[..., np.newaxis, :], axis=-2)[..., 0, :]
 
-    for i_test in range(n_session):
-        # Remove the data for the ith session to produce test and validation
-        # sets.
-        data_val = np.delete(data, i_test, axis=2)
-        data_test = data[:, :, i_test]
+    return (test_run, winning_model, test_correlation)
 
-        for j_val in range(n_session - 1):
-            # Remove the data for the jth session to produce training and test
-            # sets.
-            data_val_train = np.delete(data_val, j_val, axis=2)
 
-            # Facorize the mean of the training set over all sessions.
-            Uval, Sval, Vval = make_components(data_val_train)
+def crossval_correlations(data, method='svd', batched=False):
+    """Correlations for every fold and dimensionality of the nested crossval.
 
-            # Find the correlations between reconstructions of the training set
-            # for each possible dimensionality and the test set.
-            for comp in range(n_comp):
-                rmat[comp, j_val, i_test] = reconstruct(Uval, Sval, Vval, comp,
-                                                        data_val[:, :, j_val])
+    Arguments
+    ---------
+        data: n * m * o Numpy array of beta values for n voxels and m
+            conditions over o sessions.
+        method: 'svd' or 'gram', the factorization used by make_components;
+            default: 'svd'.
+        batched: If True, factorize every fold in one stacked call, as
+            batched_correlations; default: False.
 
-            if option == 'full':
-                test_run.append(i_test + 1)
+    Returns
+    -------
+        rmat: (m - 1) * (o - 1) * o Numpy array of validation correlations,
+            as returned by batched_correlations.
+        test_rmat: m * o Numpy array of test correlations, as returned by
+            batched_correlations.
 
-                rmax = rmat[:, j_val, i_test]
+        Both are single precision for single-precision data, and double
+        precision otherwise.
 
-                # The index with the greatest correlation corresponds to the
-                # best dimensionality, so the incremented index must be
-                # returned.
-                winning_model[j_val, i_test] = np.argmax(rmax)
+    """
+    n_beta, n_session = data.shape[1:]
+    n_comp = n_beta - 1
+
+    if batched:
+        return batched_correlations(data, method)
+
+    dtype = np.promote_types(data.dtype, np.float32)
+    rmat = np.zeros((n_comp, n_session - 1, n_session), dtype=dtype)
+    test_rmat = np.zeros((n_beta, n_session), dtype=dtype)
 
-                U, S, V = make_components(data_val)
+    # The training and validation sets of each fold are means over all
+    # but one or two sessions, so they are built by subtracting the
+    # held-out sessions from the sum over all sessions, rather than by
+    # copying the remaining sessions. The correlations of reconstructions
+    # with the test sets are unchanged by scaling, so the sums are never
+    # divided by the number of sessions.
+    session_sum = data.sum(axis=2)
+    data_val = np.empty_like(session_sum)
+    data_val_train = np.empty_like(session_sum)
+
+    for i_test in range(n_session):
+        # Remove the data for the ith session to produce test and
+        # validation sets.
+        np.subtract(session_sum, data[:, :, i_test], out=data_val)
+        # Sessions of the validation set, in the order of the original
+        # data.
+        val_sessions = np.delete(np.arange(n_session), i_test)
+
+        # Factorize the validation set once, and keep the correlations of
+        # every dimensionality with the test set, so that any winning
+        # model can be scored without refactorizing.
+        test_rmat[:, i_test] = fold_correlations(
+            data_val, data[:, :, i_test], method)
+
+        for j_val in range(n_session - 1):
+            # Remove the data for the jth session to produce training and
+            # test sets.
+            np.subtract(data_val, data[:, :, val_sessions[j_val]],
+                        out=data_val_train)
 
-                test_correlation[j_val, i_test] = \
-                    reconstruct(
-                        U, S, V, winning_model[j_val, i_test], data_test)
+            # Facorize the mean of the training set over all sessions, and
+            # find the correlations between reconstructions of the
+            # training set for each possible dimensionality and the test
+            # set.
+            rmat[:, j_val, i_test] = fold_correlations(
+                data_val_train, data[:, :, val_sessions[j_val]],
+                method)[:n_comp]
 
-        if option == 'mean':
-            test_run.append(i_test + 1)
+    return (rmat, test_rmat)
 
-            meanr = np.mean(rmat[:, :, i_test], axis=1)
-            # The index with the greatest correlation corresponds to the best
-            # dimensionality, so the incremented index must be returned.
-            winning_model[i_test] = np.argmax(meanr)
 
-            U, S, V = make_components(data_val)
+@profiled
+def svd_nested_crossval(data, subject_ID, option='full', method='svd',
+                        batched=False, dtype=np.float64):
+    """Estimate dimensionality for voxels for conditions and sessions.
+
+    Arguments
+    ---------
+        data: n * m * o Numpy array of beta values for n voxels and m
+            conditions over o sessions.
+        option: 'full' or 'mean'; default: 'full'.
+        method: 'svd' or 'gram', the factorization used by make_components;
+            default: 'svd'.
+        batched: If True, factorize every fold in one stacked call, as
+            batched_correlations; default: False. This is much faster for
+            small numbers of voxels, but needs memory for o * o copies of
+            the data.
+        dtype: Floating-point type in which to compute; default:
+            np.float64. np.float32 halves the memory needed and speeds up the
+            factorizations, and the correlations are still accumulated in
+            double precision.
+
+    Returns
+    -------
+        subject_ID: Unique indentifier for each subject.
+        test_run: Which test set was used.
+        winning_model: Winning models/dimensionality.
+        test_correlation: The out-of-samplel correlation for the winning model.
+
+    """
+    if option not in ['full', 'mean']:
+        raise ValueError('Unknown option: "' + str(option) +
+                         '"; "full" and "mean" are the only options.')
 
-            test_correlation[i_test] = \
-                reconstruct(U, S, V, winning_model[i_test], data_test)
+    data = np.asarray(data, dtype=dtype)
+    test_run, winning_model, test_correlation = select_models(
+        *crossval_correlations(data, method, batched), option=option)
 
+    # The index with the greatest correlation corresponds to the best
+    # dimensionality, so the incremented index must be returned.
     return (subject_ID, test_run, winning_model + 1, test_correlation)
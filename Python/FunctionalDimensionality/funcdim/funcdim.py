@@ -17,13 +17,19 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from funcdim import profiling
 from funcdim.crossval import svd_nested_crossval
+from funcdim.parallel import as_pool
+from funcdim.parallel import bounded_map
+from funcdim.parallel import SharedArrays
+from funcdim.results import row_dtype
+from funcdim.util import array_key
+import functools
 import itertools
-from multiprocessing import Pool
 import numpy as np
-import scipy
 
 
+@profiling.profiled
 def covdiag(x, df=None):
     """Based on the function from the RSA Toolbox.
 
@@ -33,114 +39,431 @@ def covdiag(x, df=None):
     Arguments
     ---------
         x: Numpy array of size t * n, t observations of n random variables.
+            This may have leading axes, such as a batch * t * n stack, over
+            which the estimate is vectorized.
         df: Degrees of freedom, defaults to t-1.
 
     Returns
     -------
         Invertible covariance matrix estimator as an n * n Numpy array,
         accroding to the optimal shrikage method as outline in Ledoit & Wolf
-        (2005).
+        (2005), with the same leading axes as x.
 
     """
-    t, n = x.shape
+    t, n = x.shape[-2:]
 
     if df is None:  # pragma: no cover
         df = t - 1
 
     # De-mean returns.
-    x = x - x.mean(axis=0)
+    x = x - x.mean(axis=-2, keepdims=True)
 
     # Compute the sample covariance matrix.
-    sample = np.matmul(x.T, x) / df
+    sample = np.matmul(np.swapaxes(x, -2, -1), x) / df
     # Compute prior
-    prior = np.diag(np.diag(sample))
-
-    # Compute shrinkage parameter using Ledoit-Wolf method.
-    d = 1.0 / n * np.linalg.norm(sample - prior, ord='fro')**2
+    var = np.diagonal(sample, axis1=-2, axis2=-1)
+    prior = var[..., np.newaxis] * np.eye(n, dtype=var.dtype)
+
+    # Compute shrinkage parameter using Ledoit-Wolf method. The prior is the
+    # diagonal of the sample, so the squared Frobenius norm of their
+    # difference is that of the off-diagonal elements, and the sum of y.T y is
+    # the sum of the squared row sums of y.
+    sample_sumsq = np.square(sample).sum(axis=(-2, -1))
+    d = 1.0 / n * (sample_sumsq - np.square(var).sum(axis=-1))
     y = x**2
 
-    r2 = 1.0 / (n * df**2) * np.matmul(y.T, y).sum() - \
-        1.0 / (n * df) * (sample**2).sum()
+    r2 = 1.0 / (n * df**2) * np.square(y.sum(axis=-1)).sum(axis=-1) - \
+        1.0 / (n * df) * sample_sumsq
 
-    r2_by_d = r2 / d
-    if np.isnan(r2_by_d):  # pragma: no cover
-        r2_by_d = 1.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2_by_d = r2 / d
+    r2_by_d = np.where(np.isnan(r2_by_d), 1.0, r2_by_d)
 
-    shrinkage = np.max([0, np.min([1.0, r2_by_d])])
+    shrinkage = np.clip(r2_by_d, 0.0, 1.0)[..., np.newaxis, np.newaxis]
 
     # Regularize the estimate.
     return shrinkage * prior + (1.0 - shrinkage) * sample
 
 
-def pre_proc(data, res):
-    """Pre-process data."""
+def inv_sqrtm(cov):
+    """Inverse square root of symmetric positive definite matrices.
+
+    Arguments
+    ---------
+        cov: n * n symmetric positive definite Numpy array, such as a
+            covariance estimate from covdiag. This may have leading axes,
+            over which the calculation is broadcast.
+
+    Returns
+    -------
+        Real n * n Numpy array W, such that W W = inv(cov). A ValueError is
+        raised instead if cov is not finite, or any of its matrices is
+        singular to within rounding, such as for a voxel with constant
+        residuals.
+
+    """
+    if not np.all(np.isfinite(cov)):
+        raise ValueError('The covariance matrices must be finite.')
+    eigval, eigvec = np.linalg.eigh(cov)
+    # eigh returns the eigenvalues in ascending order.
+    floor = eigval[..., -1:] * cov.shape[-1] * np.finfo(eigval.dtype).eps
+    if np.any(eigval[..., :1] <= floor):
+        raise ValueError('The covariance matrices must be positive '
+                         'definite; check for voxels with constant '
+                         'residuals.')
+    return np.matmul(eigvec / np.sqrt(eigval)[..., np.newaxis, :],
+                     np.swapaxes(eigvec, -2, -1))
+
+
+@profiling.profiled
+def whitening(res, cache=None):
+    """Whitening matrices for the residuals of every session.
+
+    Arguments
+    ---------
+        res: n_voxels * t * n_sessions Numpy array of residuals.
+        cache: Optional mapping, such as a dict or util.NpyCache, in which
+            the matrices are stored under util.array_key(res), so that they
+            are only computed once for the same residuals.
+
+    Returns
+    -------
+        n_sessions * n_voxels * n_voxels Numpy array of the inverse square
+        roots of the covariance estimates of the residuals.
+
+    """
+    if cache is None:
+        return inv_sqrtm(covdiag(np.transpose(res, (2, 1, 0))))
+
+    key = array_key(res)
+    if key not in cache:
+        cache[key] = inv_sqrtm(covdiag(np.transpose(res, (2, 1, 0))))
+    return cache[key]
+
+
+@profiling.profiled
+def pre_proc(data, res, cache=None, dtype=np.float64):
+    """Pre-process data.
+
+    The betas of each session are whitened by the covariance of its
+    residuals, and then centred on the mean over the conditions for each
+    voxel. Whitening matrices are cached as for whitening. The data and
+    residuals are first converted to dtype; default: np.float64.
+    """
+    data = np.asarray(data, dtype=dtype)
+    res = np.asarray(res, dtype=dtype)
     n_voxels, n_betas, n_sessions = data.shape
-    beta_norm = np.zeros(data.shape)
-    for i_session in range(n_sessions):
-        cov_e = covdiag(res[:, :, i_session].T)
-        beta_norm[:, :, i_session] = \
-            np.matmul(data[:, :, i_session].T, scipy.linalg.
-                      fractional_matrix_power(cov_e, -0.5)).T
+    beta_norm = np.matmul(whitening(res, cache), np.moveaxis(data, 2, 0))
+    beta_norm = np.moveaxis(beta_norm, 0, 2)
 
     return beta_norm - beta_norm.mean(axis=1).reshape(n_voxels, 1, n_sessions)
 
 
-def roi_estimator(data, res, subject_IDs, option='full'):
+def roi_estimator(data, res, subject_IDs, option='full', method='svd',
+                  batched=False, whitening_cache=None, dtype=np.float64):
     """ROI estimator."""
     if res is None:
         subject_ID, test_run, winning_model, test_correlation = \
-            svd_nested_crossval(data, subject_IDs, option)
+            svd_nested_crossval(data, subject_IDs, option, method, batched,
+                                dtype)
     else:
         subject_ID, test_run, winning_model, test_correlation = \
-            svd_nested_crossval(pre_proc(data, res), subject_IDs, option)
+            svd_nested_crossval(pre_proc(data, res, whitening_cache, dtype),
+                                subject_IDs, option, method, batched, dtype)
 
     return {'subject_ID': np.tile(subject_ID, len(test_run)),
             'test_run': test_run, 'winning_model': winning_model,
             'test_correlation': test_correlation}
 
 
-def functional_dimensionality(wholebrain_all, n_subjects, mask, res=None,
-                              option='full', subject_IDs=None):
-    """Estimate functional dimensionality.
+def shared_roi_estimator(estimator, data, res, *args):
+    """Run estimator on data and residuals as parallel.SharedArrays."""
+    return estimator(data.load(), None if res is None else res.load(), *args)
+
+
+def roi_task(estimator, roi, *args):
+    """Run an estimator for one ROI of a subject, labelling its estimate."""
+    # The third argument of the estimator is the subject's ID.
+    with profiling.stage('estimate', subject=args[2], roi=roi):
+        estimate = estimator(*args)
+    estimate['roi'] = np.repeat([roi], len(estimate['test_run']))
+    return estimate
+
+
+def roi_masks(rois, roi_names=None):
+    """Masks and names of the ROIs of an atlas, or of a sequence of masks.
 
     Arguments
     ---------
-        wholebrain_all: Iterable of n_voxels * n_conditions * n_sessions Numpy
-            arrays over n_subjects. This can be an
-            n_subjects * n_voxels * n_conditions * n_sessions array.
-        mask: Mask as an i * j * k Numpy array of booleans such that
-            i * j * k = n_voxels.
-        res: Residuals.
-        option: 'full' or 'mean'; default: 'full'.
-        subject_IDs: unique identifiers for each subject; default
-                     range(1, n_subjects + 1)
+        rois: Labelled atlas as an i * j * k Numpy array of integers, in
+            which each ROI is the voxels with one label and 0 is outside
+            every ROI, or a sequence of masks as i * j * k Numpy arrays of
+            booleans.
+        roi_names: Names of the ROIs; default: the labels of an atlas in
+            ascending order, or the positions of the masks in the sequence.
+
+    Returns
+    -------
+        masks: n_rois * i * j * k Numpy array of booleans.
+        roi_names: Names of the ROIs.
 
     """
-    if subject_IDs is None:
-        subject_IDs = [str(i) for i in range(1, n_subjects + 1)]
+    rois = np.asarray(rois)
+    if rois.dtype == bool:
+        masks = rois
+        labels = np.arange(len(masks))
     else:
-        assert len(subject_IDs) == n_subjects
+        labels = np.unique(rois[rois != 0])
+        masks = rois == labels.reshape((-1,) + (1,) * rois.ndim)
+
+    if roi_names is None:
+        roi_names = labels
+    else:
+        assert len(roi_names) == len(masks)
+    return (masks, roi_names)
 
-    option = [option for n in range(n_subjects)]
 
-    iter_brain, first_brain = itertools.tee(wholebrain_all, 2)
+def iter_multi_roi_dimensionality(wholebrain_all, n_subjects, rois, res=None,
+                                  option='full', subject_IDs=None,
+                                  roi_names=None, method='svd', batched=False,
+                                  whitening_cache=None, pool=None,
+                                  max_in_flight=None, shared_memory=False,
+                                  dtype=np.float64, ordered=True,
+                                  estimator=roi_estimator,
+                                  estimator_args=None):
+    """Estimate functional dimensionality in many ROIs, yielding each estimate.
 
-    unmasked_voxels, n_conditions, _ = first_brain.__next__().shape
+    Subjects are read from wholebrain_all and res once, only as workers
+    become free. Every ROI of each subject is sliced out of its brain and
+    residuals and estimated as a separate task, so that at most
+    max_in_flight (subject, ROI) pairs are held in memory at once.
+
+    Arguments
+    ---------
+        As for multi_roi_dimensionality, and:
+        ordered: If True, yield the estimates for each subject in turn, in
+            the order of its ROIs, otherwise as soon as each finishes;
+            default: True.
+        estimator: Function run in the pool for each subject and ROI, as
+            estimator(data, res, subject_ID, *args), which returns a
+            dictionary of the estimates as roi_estimator; default:
+            roi_estimator.
+        estimator_args: Iterable of the tuple of further arguments args of
+            the estimator for each subject; default: option, method,
+            batched, whitening_cache and dtype, for every subject.
+
+    Yields
+    ------
+        Dictionary of the estimates for each subject and ROI, as returned by
+        the estimator, with the name of the ROI under the key 'roi'.
 
-    flat_mask = mask.ravel()
+    """
+    if subject_IDs is None:
+        subject_IDs = [str(i) for i in range(1, n_subjects + 1)]
+    else:
+        assert len(subject_IDs) == n_subjects
 
-    # Iterate over sets of voxels that are active in the mask.
-    masked_brains = (brain[flat_mask] for brain in iter_brain)
+    masks, roi_names = roi_masks(rois, roi_names)
+    flat_masks = masks.reshape(len(masks), -1)
+    n_voxels = flat_masks.shape[1]
+    flat_union = flat_masks.any(axis=0)
+    n_union = int(np.count_nonzero(flat_union))
+    # The voxels of each ROI within the union of the ROIs, or None where
+    # that is all of them.
+    union_masks = [None if roi_mask.all() else roi_mask
+                   for roi_mask in flat_masks[:, flat_union]]
+
+    owns_pool = pool is None
+    pool = as_pool(pool, n_subjects * len(masks),
+                   int(flat_masks.sum(axis=1).max()))
+    if max_in_flight is None:
+        max_in_flight = 2 * pool.n_workers
+
+    def roi_mask(array, i_roi):
+        # Brains and residuals loaded with the union of the ROIs, as by
+        # util.load_brain, already hold just the voxels that are in them.
+        if len(array) == n_union and len(array) != n_voxels:
+            return union_masks[i_roi]
+        return flat_masks[i_roi]
 
     if res is None:
         residuals = (None for i in range(n_subjects))
     else:
         residuals = res
+    if estimator_args is None:
+        estimator_args = itertools.repeat((option, method, batched,
+                                           whitening_cache, dtype))
+
+    if shared_memory:
+        shared = SharedArrays()
+        estimator = functools.partial(shared_roi_estimator, estimator)
+
+        def select(array, i_roi):
+            # Copy the voxels of the ROI straight into shared memory, so
+            # that the workers read them without pickling.
+            with profiling.stage('select'):
+                return shared.put(array, roi_mask(array, i_roi), dtype)
+    else:
+        def select(array, i_roi):
+            i_mask = roi_mask(array, i_roi)
+            with profiling.stage('select'):
+                return np.asarray(
+                    array if i_mask is None else array[i_mask], dtype=dtype)
+
+    def task_args():
+        subjects = zip(wholebrain_all, residuals, subject_IDs,
+                       estimator_args)
+        while True:
+            # Reading from the iterators is where lazily loaded subjects are
+            # loaded, or waited for.
+            with profiling.stage('load'):
+                subject = next(subjects, None)
+            if subject is None:
+                return
+            brain, residual, subject_ID, args = subject
+            for i_roi, roi in enumerate(roi_names):
+                yield (estimator, roi, select(brain, i_roi),
+                       None if residual is None else select(residual, i_roi),
+                       subject_ID) + tuple(args)
+
+    def release(arg):
+        if shared_memory:
+            shared.remove(arg[2])
+            shared.remove(arg[3])
+
+    try:
+        yield from bounded_map(pool, roi_task, task_args(), max_in_flight,
+                               ordered, release)
+    finally:
+        if owns_pool:
+            pool.close(cancel=True)
+        if shared_memory:
+            shared.close()
+
+
+def iter_functional_dimensionality(wholebrain_all, n_subjects, mask,
+                                   res=None, option='full', subject_IDs=None,
+                                   method='svd', batched=False,
+                                   whitening_cache=None, pool=None,
+                                   max_in_flight=None, shared_memory=False,
+                                   dtype=np.float64, ordered=True,
+                                   estimator=roi_estimator,
+                                   estimator_args=None):
+    """Estimate functional dimensionality, yielding each subject's estimate.
+
+    Subjects are read from wholebrain_all and res only as workers become
+    free, so that at most max_in_flight of them are held in memory at once,
+    however many subjects there are.
+
+    Arguments
+    ---------
+        As for functional_dimensionality, and:
+        ordered: If True, yield the estimates in the order of the subjects,
+            otherwise as soon as each finishes; default: True.
+        estimator, estimator_args: As for iter_multi_roi_dimensionality.
 
-    args = (brain for brain in zip(
-        masked_brains, residuals, subject_IDs, option))
-    estimator_pool = Pool()
-    estimates = estimator_pool.starmap(roi_estimator, args)
+    Yields
+    ------
+        Dictionary of the estimates for each subject, as returned by the
+        estimator.
+
+    """
+    estimates = iter_multi_roi_dimensionality(
+        wholebrain_all, n_subjects, [mask], res=res, option=option,
+        subject_IDs=subject_IDs, method=method, batched=batched,
+        whitening_cache=whitening_cache, pool=pool,
+        max_in_flight=max_in_flight, shared_memory=shared_memory,
+        dtype=dtype, ordered=ordered, estimator=estimator,
+        estimator_args=estimator_args)
+    try:
+        for estimate in estimates:
+            del estimate['roi']
+            yield estimate
+    finally:
+        estimates.close()
+
+
+def append_to_sink(estimates, sink):
+    """Append estimates to a results.ResultSink as they complete."""
+    for estimate in estimates:
+        sink.append(estimate)
+    sink.flush()
+    return sink
+
+
+def functional_dimensionality(wholebrain_all, n_subjects, mask, res=None,
+                              option='full', subject_IDs=None, method='svd',
+                              batched=False, whitening_cache=None,
+                              pool=None, max_in_flight=None,
+                              shared_memory=False, dtype=np.float64,
+                              sink=None):
+    """Estimate functional dimensionality.
+
+    Arguments
+    ---------
+        wholebrain_all: Iterable of n_voxels * n_conditions * n_sessions Numpy
+            arrays over n_subjects. This can be an
+            n_subjects * n_voxels * n_conditions * n_sessions array. Brains
+            that have already been masked, with one row for each voxel that
+            is active in the mask, as loaded by util.load_brain with the
+            mask, are used as they are.
+        mask: Mask as an i * j * k Numpy array of booleans such that
+            i * j * k = n_voxels.
+        res: Residuals, as an iterable of n_voxels * n_scans * n_sessions
+            Numpy arrays over n_subjects, which may also have been masked.
+        option: 'full' or 'mean'; default: 'full'.
+        subject_IDs: unique identifiers for each subject; default
+                     range(1, n_subjects + 1)
+        method: 'svd' or 'gram', the factorization used for each fold;
+            default: 'svd'.
+        batched: If True, factorize all of the folds for each subject in a
+            single stacked call; default: False. Faster for small masks.
+        whitening_cache: Optional mapping in which to cache the whitening
+            matrices for the residuals, so that reruns with the same
+            residuals skip whitening. Use a util.NpyCache to share it
+            between the worker processes; default: None.
+        pool: parallel.EstimatorPool or concurrent.futures.Executor to run
+            the estimates for each subject, which can be reused between
+            calls; default: a new pool of worker processes for this call,
+            split between processes and BLAS threads according to the
+            numbers of subjects and voxels by parallel.plan_parallelism.
+        max_in_flight: Most subjects submitted to the workers and not yet
+            collected, which bounds the number held in memory at once;
+            default: twice the number of workers.
+        shared_memory: If True, copy each subject's masked data and residuals
+            into memory-mapped files in shared memory, so that the workers
+            read them in place rather than having them pickled; default:
+            False.
+        dtype: Floating-point type of the whole computation, to which the
+            masked brains and residuals are converted as they are sent to
+            the workers; default: np.float64. np.float32 halves the memory
+            and data sent to the workers, and speeds up the factorizations,
+            usually with the same winning models.
+        sink: Optional results.ResultSink, such as a results.ArraySink or
+            results.NpzSink, to append each subject's estimate to as soon as
+            it completes, with typed columns, instead of gathering them all
+            in memory; default: None. Its columns must be those of
+            results.row_dtype(), without the ROIs or p-values.
+
+    Returns
+    -------
+        Dictionary of the results, or the sink if one is given, once every
+        estimate has been appended to it. The sink is not closed.
+
+    """
+    if sink is not None and sink.dtype != row_dtype():
+        raise ValueError('The sink needs the columns of row_dtype(); make '
+                         'it with roi=False and p_values=False.')
+
+    estimates = iter_functional_dimensionality(
+        wholebrain_all, n_subjects, mask, res=res, option=option,
+        subject_IDs=subject_IDs, method=method, batched=batched,
+        whitening_cache=whitening_cache, pool=pool,
+        max_in_flight=max_in_flight, shared_memory=shared_memory,
+        dtype=dtype)
+
+    if sink is not None:
+        return append_to_sink(estimates, sink)
 
     subject_ID = []
     test_run = []
@@ -153,10 +476,64 @@ def functional_dimensionality(wholebrain_all, n_subjects, mask, res=None,
         winning_model.append(estimate['winning_model'])
         test_correlation.append(estimate['test_correlation'])
 
-    results = {'subject_ID': np.asarray(subject_ID).flatten(),
-               'test_run': np.asarray(test_run).flatten(),
-               'winning_model': np.asarray(winning_model).flatten(),
-               'test_correlation': np.asarray(test_correlation).flatten()
-               }
+    with profiling.stage('assemble'):
+        results = {'subject_ID': np.asarray(subject_ID).flatten(),
+                   'test_run': np.asarray(test_run).flatten(),
+                   'winning_model': np.asarray(winning_model).flatten(),
+                   'test_correlation': np.asarray(test_correlation).flatten()
+                   }
 
     return results
+
+
+def multi_roi_dimensionality(wholebrain_all, n_subjects, rois, res=None,
+                             option='full', subject_IDs=None, roi_names=None,
+                             method='svd', batched=False,
+                             whitening_cache=None, pool=None,
+                             max_in_flight=None, shared_memory=False,
+                             dtype=np.float64, sink=None):
+    """Estimate functional dimensionality in each of many ROIs.
+
+    Each subject is read once, however many ROIs there are, and its
+    estimates for every ROI are computed as separate tasks in the pool.
+
+    Arguments
+    ---------
+        wholebrain_all: As for functional_dimensionality. Brains that have
+            been masked by the union of the ROIs are also accepted.
+        n_subjects: Number of subjects.
+        rois: Labelled atlas or sequence of masks, as for roi_masks.
+        res: Residuals, in the same form as wholebrain_all; default: None.
+        subject_IDs: As for functional_dimensionality.
+        roi_names: Names of the ROIs, as for roi_masks.
+        option, method, batched, whitening_cache, pool, max_in_flight,
+        shared_memory, dtype: As for functional_dimensionality. Each
+            (subject, ROI) pair counts as one task for max_in_flight.
+        sink: As for functional_dimensionality, made with roi=True.
+
+    Returns
+    -------
+        Dictionary of the results for every subject and ROI, as for
+        functional_dimensionality, with the name of the ROI of each row
+        under the key 'roi', or the sink if one is given.
+
+    """
+    if sink is not None and 'roi' not in sink.dtype.names:
+        raise ValueError('The sink needs a column for the ROIs; make it '
+                         'with roi=True.')
+
+    estimates = iter_multi_roi_dimensionality(
+        wholebrain_all, n_subjects, rois, res=res, option=option,
+        subject_IDs=subject_IDs, roi_names=roi_names, method=method,
+        batched=batched, whitening_cache=whitening_cache, pool=pool,
+        max_in_flight=max_in_flight, shared_memory=shared_memory,
+        dtype=dtype)
+    if sink is not None:
+        return append_to_sink(estimates, sink)
+    estimates = list(estimates)
+
+    with profiling.stage('assemble'):
+        return {key: np.concatenate([np.asarray(estimate[key]).flatten()
+                                     for estimate in estimates])
+                for key in ['roi', 'subject_ID', 'test_run', 'winning_model',
+                            'test_correlation']}
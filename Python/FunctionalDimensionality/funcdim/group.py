@@ -0,0 +1,372 @@
+"""Copyright 2018.
+
+Authors: Christiane Ahlheim, Sebastian Bobadilla-Suarez, Kurt Braunlich,
+Giles Greenway, & Olivia Guest.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from funcdim.parallel import as_pool
+from funcdim.stats import subject_table
+import numpy as np
+from scipy.special import expit
+from scipy.special import gammaln
+from scipy.special import log_expit
+from scipy.special import log_ndtr
+from scipy.special import stdtr
+
+# Acceptance rate that the proposal scales are adapted towards during warmup,
+# which is optimal for one-dimensional random walk Metropolis updates.
+TARGET_ACCEPTANCE = 0.44
+
+
+def log_diff_ndtr(a, b):
+    """Log of the standard normal probability between a and b, for a < b."""
+    # Use the lower tail, where log_ndtr is accurate.
+    upper = a > 0
+    a, b = np.where(upper, -b, a), np.where(upper, -a, b)
+    log_b = log_ndtr(b)
+    with np.errstate(divide='ignore'):
+        return log_b + np.log1p(-np.exp(log_ndtr(a) - log_b))
+
+
+def log_diff_stdtr(df, a, b):
+    """Log of the Student's t probability between a and b, for a < b."""
+    upper = a > 0
+    a, b = np.where(upper, -b, a), np.where(upper, -a, b)
+    with np.errstate(divide='ignore'):
+        return np.log(stdtr(df, b) - stdtr(df, a))
+
+
+def normal_log_density(x, loc, scale, lower, upper):
+    """Log density of a normal distribution truncated to [lower, upper]."""
+    z = (x - loc) / scale
+    return -0.5 * z**2 - 0.5 * np.log(2 * np.pi) - np.log(scale) - \
+        log_diff_ndtr((lower - loc) / scale, (upper - loc) / scale)
+
+
+def student_t_log_density(x, df, loc, scale, lower=None, upper=None):
+    """Log density of a Student's t distribution, optionally truncated."""
+    z = (x - loc) / scale
+    log_density = gammaln((df + 1) / 2) - gammaln(df / 2) - \
+        0.5 * np.log(df * np.pi) - np.log(scale) - \
+        (df + 1) / 2 * np.log1p(z**2 / df)
+    if lower is None:
+        return log_density
+    return log_density - log_diff_stdtr(df, (lower - loc) / scale,
+                                        (upper - loc) / scale)
+
+
+def model_data(winning_model, max_dim):
+    """Data of the hierarchical model, as in hierarchical_bayes_stan.m.
+
+    Arguments
+    ---------
+        winning_model: n_subjects * n_runs Numpy array of the winning models
+            of each subject, such as from stats.subject_table.
+        max_dim: Maximal dimensionality, which is the number of conditions
+            minus one without a hypothesis.
+
+    Returns
+    -------
+        Dictionary of the mean y and standard deviation sigma of the winning
+        models of each subject, the number of runs, and the bounds of the
+        parameters.
+
+    """
+    winning_model = np.asarray(winning_model, dtype=float)
+    n_runs = winning_model.shape[1]
+    if n_runs < 2:
+        raise ValueError('Each subject needs at least two runs.')
+
+    data = {'y': winning_model.mean(axis=1),
+            'sigma': winning_model.std(axis=1),
+            'n_runs': n_runs,
+            'max_dim': max_dim,
+            'max_tau_pop': np.sqrt((max_dim - 1)**2 / 12),
+            'max_tau_sub': np.sqrt((max_dim - (max_dim + 1) / 2)**2 *
+                                   n_runs / (n_runs - 1))}
+    if np.any((data['y'] < 1) | (data['y'] > max_dim)) or \
+            np.any(data['sigma'] > data['max_tau_sub']):
+        raise ValueError('The winning models must be between 1 and max_dim.')
+    return data
+
+
+def theta_log_density(theta, mu, tau_pop, data):
+    """Log density of the subjects' dimensionalities given the population."""
+    return normal_log_density(theta, mu, tau_pop, 1, data['max_dim'])
+
+
+def sigma_log_density(tau_sub, data):
+    """Log density of the subjects' standard deviations, for each subject."""
+    return normal_log_density(data['sigma'], tau_sub, 1, 0,
+                              data['max_tau_sub'])
+
+
+def y_log_density(theta, tau_sub, data):
+    """Log density of the subjects' mean winning models, for each subject."""
+    return student_t_log_density(data['y'], data['n_runs'] - 1, theta,
+                                 tau_sub, 1, data['max_dim'])
+
+
+def log_density(mu, tau_pop, theta, tau_sub, data):
+    """Log posterior density of the hierarchical model, up to a constant.
+
+    The model is that of hierarchical_bayes_stan.m: each subject's
+    dimensionality theta is drawn from a normal distribution about the
+    population dimensionality mu, truncated to [1, max_dim], and its mean
+    winning model from a Student's t distribution about theta, whose scale
+    tau_sub is informed by the standard deviation of its winning models.
+    The priors are uniform within the bounds of the parameters.
+
+    Arguments
+    ---------
+        mu: Population dimensionality.
+        tau_pop: Population standard deviation.
+        theta: Numpy array of the dimensionality of each subject.
+        tau_sub: Numpy array of the scale of each subject.
+        data: Data of the model, as returned by model_data.
+
+        The parameters may have matching leading axes, such as for chains
+        or draws, over which the density is vectorized.
+
+    Returns
+    -------
+        Log density of each set of parameters.
+
+    """
+    mu = np.expand_dims(mu, -1)
+    tau_pop = np.expand_dims(tau_pop, -1)
+    return np.sum(theta_log_density(theta, mu, tau_pop, data) +
+                  sigma_log_density(tau_sub, data) +
+                  y_log_density(theta, tau_sub, data), axis=-1)
+
+
+def constrain(u, lower, upper):
+    """Map unconstrained values into (lower, upper), as Stan does.
+
+    Returns
+    -------
+        x: The constrained values.
+        log_jacobian: Log of the Jacobian of the transformation.
+
+    """
+    return (lower + (upper - lower) * expit(u),
+            np.log(upper - lower) + log_expit(u) + log_expit(-u))
+
+
+def unconstrain(x, lower, upper):
+    """Inverse of constrain."""
+    fraction = (x - lower) / (upper - lower)
+    return np.log(fraction) - np.log1p(-fraction)
+
+
+def sample_chains(data, n_chains=1, n_warmup=1000, n_draws=1000, seeds=None):
+    """Sample chains from the posterior of the hierarchical model.
+
+    Every parameter is updated in turn by a random walk Metropolis step in
+    the unconstrained space of the parameter. Given the population
+    parameters, the subjects are independent, so the parameters of every
+    subject are updated at once, each accepted or rejected on its own. Each
+    iteration also proposes to shift mu and every theta together, and to
+    scale tau_pop and the spread of every theta about mu together, which
+    move along the strong posterior correlations between the population
+    and the subjects. The proposal scale of every update is adapted towards
+    TARGET_ACCEPTANCE during warmup, and then fixed.
+
+    The chains are run together, vectorized, each with its own random
+    stream.
+
+    Arguments
+    ---------
+        data: Data of the model, as returned by model_data.
+        n_chains: Number of chains; default: 1.
+        n_warmup: Number of warmup iterations, which are discarded;
+            default: 1000.
+        n_draws: Number of draws to keep; default: 1000.
+        seeds: Seeds of numpy.random.default_rng for each chain; default:
+            None.
+
+    Returns
+    -------
+        Dictionary of n_chains * n_draws Numpy arrays of the draws of mu and
+        tau_pop, and of n_chains * n_draws * n_subjects Numpy arrays of
+        theta, tau_sub and log_lik, the pointwise log-likelihood of each
+        subject's mean winning model, as generated by the Stan model.
+
+    """
+    if seeds is None:
+        seeds = [None] * n_chains
+    rngs = [np.random.default_rng(seed) for seed in seeds]
+
+    def draw(method, shape):
+        # A draw from each chain's stream.
+        return np.stack([getattr(rng, method)(size=shape[1:])
+                         for rng in rngs])
+
+    n_subjects = len(data['y'])
+    max_dim = data['max_dim']
+    bounds = {'mu': (1, max_dim), 'tau_pop': (0, data['max_tau_pop']),
+              'theta': (1, max_dim), 'tau_sub': (0, data['max_tau_sub'])}
+    # The population parameters have a trailing axis of one, so that they
+    # broadcast against those of the subjects.
+    shapes = {'mu': (n_chains, 1), 'tau_pop': (n_chains, 1),
+              'theta': (n_chains, n_subjects),
+              'tau_sub': (n_chains, n_subjects)}
+    log_scale = {name: np.zeros(shape) for name, shape in shapes.items()}
+    log_scale['shift'] = np.zeros((n_chains, 1))
+    log_scale['spread'] = np.zeros((n_chains, 1))
+
+    # Initial values uniform on (-2, 2) in the unconstrained space, as Stan.
+    params = {name: constrain(4 * draw('random', shape) - 2,
+                              *bounds[name])[0]
+              for name, shape in shapes.items()}
+
+    def log_density_terms(p, names):
+        # The terms of the log density for each subject.
+        terms = {}
+        if 'theta' in names:
+            terms['theta'] = theta_log_density(p['theta'], p['mu'],
+                                               p['tau_pop'], data)
+        if 'sigma' in names:
+            terms['sigma'] = sigma_log_density(p['tau_sub'], data)
+        if 'y' in names:
+            terms['y'] = y_log_density(p['theta'], p['tau_sub'], data)
+        return terms
+
+    # Every update only recomputes the terms that involve the parameters
+    # it changes.
+    affected_terms = {'theta': ['theta', 'y'], 'tau_sub': ['sigma', 'y'],
+                      'mu': ['theta'], 'tau_pop': ['theta'],
+                      'shift': ['theta', 'y'], 'spread': ['theta', 'y']}
+    current = log_density_terms(params, ['theta', 'sigma', 'y'])
+
+    def metropolis(update, proposed, log_jacobian_ratio, iteration):
+        # Accept or reject the proposed parameters, for each subject, or for
+        # each chain if any population parameter is proposed.
+        terms = log_density_terms(dict(params, **proposed),
+                                  affected_terms[update])
+        log_ratio = sum(terms[name] - current[name] for name in terms)
+        if update not in ['theta', 'tau_sub']:
+            log_ratio = np.sum(log_ratio, axis=-1, keepdims=True)
+        log_ratio = log_ratio + log_jacobian_ratio
+
+        accept = np.log(draw('random', log_ratio.shape)) < log_ratio
+        if iteration < n_warmup:
+            log_scale[update] = log_scale[update] + \
+                (iteration + 1)**-0.6 * (accept - TARGET_ACCEPTANCE)
+
+        for name, value in proposed.items():
+            params[name] = np.where(accept, value, params[name])
+        for name, term in terms.items():
+            current[name] = np.where(accept, term, current[name])
+
+    draws = {name: [] for name in ['mu', 'tau_pop', 'theta', 'tau_sub',
+                                   'log_lik']}
+    # Proposals far out in the tails overflow, and are rejected.
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        for iteration in range(n_warmup + n_draws):
+            for name in ['theta', 'tau_sub', 'mu', 'tau_pop']:
+                u = unconstrain(params[name], *bounds[name])
+                log_jacobian = constrain(u, *bounds[name])[1]
+                proposal, proposal_log_jacobian = constrain(
+                    u + np.exp(log_scale[name]) *
+                    draw('standard_normal', u.shape), *bounds[name])
+                metropolis(name, {name: proposal},
+                           proposal_log_jacobian - log_jacobian, iteration)
+
+            # Shift mu and every theta by the same amount.
+            shift = np.exp(log_scale['shift']) * \
+                draw('standard_normal', (n_chains, 1))
+            mu = params['mu'] + shift
+            theta = params['theta'] + shift
+            inside = (mu > 1) & (mu < max_dim) & \
+                np.all((theta > 1) & (theta < max_dim), axis=-1, keepdims=True)
+            metropolis('shift', {'mu': mu, 'theta': theta},
+                       np.where(inside, 0.0, -np.inf), iteration)
+
+            # Scale tau_pop and the spread of every theta about mu together,
+            # whose Jacobian is the scale to the power of n_subjects + 1.
+            log_spread = np.exp(log_scale['spread']) * \
+                draw('standard_normal', (n_chains, 1))
+            tau_pop = params['tau_pop'] * np.exp(log_spread)
+            theta = params['mu'] + np.exp(log_spread) * \
+                (params['theta'] - params['mu'])
+            inside = (tau_pop < data['max_tau_pop']) & \
+                np.all((theta > 1) & (theta < max_dim), axis=-1,
+                       keepdims=True)
+            metropolis('spread', {'tau_pop': tau_pop, 'theta': theta},
+                       np.where(inside, (n_subjects + 1) * log_spread,
+                                -np.inf), iteration)
+
+            if iteration >= n_warmup:
+                for name in ['mu', 'tau_pop', 'theta', 'tau_sub']:
+                    draws[name].append(params[name])
+                draws['log_lik'].append(student_t_log_density(
+                    data['y'], data['n_runs'] - 1, params['theta'],
+                    params['tau_sub']))
+
+    draws = {name: np.stack(draw, axis=1) for name, draw in draws.items()}
+    draws['mu'] = draws['mu'][..., 0]
+    draws['tau_pop'] = draws['tau_pop'][..., 0]
+    return draws
+
+
+def hierarchical_bayes(winning_model, max_dim, n_chains=4, n_warmup=1000,
+                       n_draws=1000, seed=None, pool=None):
+    """Fit the hierarchical model of hierarchical_bayes_stan.m.
+
+    Arguments
+    ---------
+        winning_model: n_subjects * n_runs Numpy array of the winning models
+            of each subject, or a dictionary of results as returned by
+            functional_dimensionality.
+        max_dim: Maximal dimensionality, which is the number of conditions
+            minus one without a hypothesis.
+        n_chains: Number of chains; default: 4.
+        n_warmup, n_draws: As for sample_chains; default: 1000.
+        seed: Seed for numpy.random.SeedSequence, from which each chain's
+            stream is spawned; default: None.
+        pool: parallel.EstimatorPool or concurrent.futures.Executor to run
+            the chains; default: a new pool of worker processes.
+
+    Returns
+    -------
+        Dictionary of the draws of each parameter, as returned by
+        sample_chains, with a leading axis for the chains. log_lik holds the
+        pointwise log-likelihood for PSIS-LOO.
+
+    """
+    if isinstance(winning_model, dict):
+        winning_model = subject_table(winning_model, 'winning_model')
+    data = model_data(winning_model, max_dim)
+
+    seeds = np.random.SeedSequence(seed).spawn(n_chains)
+    owns_pool = pool is None
+    pool = as_pool(pool)
+    try:
+        # The chains are shared between the workers, each of which runs its
+        # share vectorized.
+        futures = [pool.submit(sample_chains, data, len(task_seeds),
+                               n_warmup, n_draws, task_seeds)
+                   for task_seeds in np.array_split(
+                       np.array(seeds, dtype=object),
+                       min(n_chains, pool.n_workers))]
+        chains = [future.result() for future in futures]
+    finally:
+        if owns_pool:
+            pool.close(cancel=True)
+
+    return {name: np.concatenate([chain[name] for chain in chains])
+            for name in chains[0]}
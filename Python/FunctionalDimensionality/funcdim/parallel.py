@@ -0,0 +1,358 @@
+"""Copyright 2018.
+
+Authors: Christiane Ahlheim, Sebastian Bobadilla-Suarez, Kurt Braunlich,
+Giles Greenway, & Olivia Guest.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+from concurrent.futures import Executor
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from funcdim import profiling
+import numpy as np
+import os
+import shutil
+import tempfile
+import warnings
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:  # pragma: no cover
+    threadpool_limits = None
+
+# Voxels in a mask for each BLAS thread that plan_parallelism gives a worker.
+VOXELS_PER_BLAS_THREAD = 10000
+
+# Limits on the BLAS threads of this process, set by limit_blas_threads.
+blas_limits = None
+
+
+def limit_blas_threads(n_threads, warn=True):
+    """Limit the threads used by BLAS in this process.
+
+    This needs threadpoolctl, without which the limit is not applied.
+
+    Arguments
+    ---------
+        n_threads: Most threads for BLAS to use.
+        warn: If True, warn when threadpoolctl is not installed; default:
+            True.
+
+    """
+    global blas_limits
+    if threadpool_limits is None:  # pragma: no cover
+        if warn:
+            warnings.warn('threadpoolctl is not installed, so the number of '
+                          'BLAS threads cannot be limited.')
+        return
+    blas_limits = threadpool_limits(limits=n_threads, user_api='blas')
+
+
+def plan_parallelism(n_subjects, n_voxels, n_cpus=None):
+    """Split the CPUs between worker processes and BLAS threads.
+
+    Each subject is estimated by one worker process, in which BLAS may run
+    the factorizations of its folds over several threads. Many subjects with
+    small masks are best run by one single-threaded process per CPU, while
+    a few subjects with large masks are best run by fewer processes with
+    more threads each. Either way, the total number of threads is at most
+    the number of CPUs.
+
+    Arguments
+    ---------
+        n_subjects: Number of subjects.
+        n_voxels: Number of voxels in the mask.
+        n_cpus: Number of CPUs to use; default: all of them.
+
+    Returns
+    -------
+        n_workers: Number of worker processes.
+        blas_threads: Number of BLAS threads for each worker.
+
+    """
+    n_cpus = n_cpus or os.cpu_count() or 1
+    blas_threads = min(n_cpus, max(1, n_voxels // VOXELS_PER_BLAS_THREAD))
+    n_workers = max(1, min(n_subjects, n_cpus // blas_threads))
+    # Give any CPUs left over, when there are few subjects, to BLAS.
+    return (n_workers, max(1, n_cpus // n_workers))
+
+
+class EstimatorPool(object):
+    """Pool of workers that estimators can be submitted to repeatedly.
+
+    The pool is started once, and can be passed to functional_dimensionality
+    for any number of calls, which saves starting new worker processes for
+    each of them. Use it as a context manager, or call close when finished.
+
+    Arguments
+    ---------
+        n_workers: Number of worker processes, or of the workers of
+            executor, which sets how many tasks are submitted to it at once;
+            default: the number of CPUs.
+        blas_threads: Most threads for BLAS to use in each worker process,
+            if threadpoolctl is installed; default: the number of CPUs
+            divided by n_workers, so that the CPUs are not oversubscribed.
+        executor: Optional concurrent.futures.Executor to submit to instead
+            of starting worker processes. It is not shut down by close, and
+            its threads are not limited.
+        warn: If True, warn in each worker process if threadpoolctl is not
+            installed, so that blas_threads cannot be applied; default: only
+            if blas_threads is given.
+
+    """
+
+    def __init__(self, n_workers=None, blas_threads=None, executor=None,
+                 warn=None):  # noqa:D107
+        if executor is None:
+            n_cpus = os.cpu_count() or 1
+            self.n_workers = n_workers or n_cpus
+            # Only warn about missing threadpoolctl if threads were asked for.
+            if warn is None:
+                warn = blas_threads is not None
+            self.blas_threads = blas_threads or \
+                max(1, n_cpus // self.n_workers)
+            self.executor = ProcessPoolExecutor(
+                self.n_workers, initializer=limit_blas_threads,
+                initargs=(self.blas_threads, warn))
+            self.owns_executor = True
+        else:
+            # Executors do not expose their number of workers, so it must
+            # be given to size the windows of tasks submitted to them.
+            self.n_workers = n_workers or os.cpu_count() or 1
+            self.blas_threads = None
+            self.executor = executor
+            self.owns_executor = False
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs), returning a Future for its result."""
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def close(self, cancel=False):
+        """Shut down the worker processes, if they belong to this pool.
+
+        Arguments
+        ---------
+            cancel: If True, cancel the tasks that have not yet started
+                rather than waiting for them; default: False.
+
+        """
+        if self.owns_executor:
+            self.executor.shutdown(wait=True, cancel_futures=cancel)
+
+    def __enter__(self):  # noqa:D105
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):  # noqa:D105
+        self.close(cancel=exc_type is not None)
+
+
+def as_pool(pool, n_subjects=None, n_voxels=None):
+    """Wrap a concurrent.futures.Executor as an EstimatorPool.
+
+    Arguments
+    ---------
+        pool: EstimatorPool, concurrent.futures.Executor or None. To size
+            the windows of tasks submitted to an executor by its number of
+            workers, wrap it as EstimatorPool(n_workers, executor=executor).
+        n_subjects: Number of subjects, to plan a new pool.
+        n_voxels: Number of voxels in the mask, to plan a new pool.
+
+    Returns
+    -------
+        The EstimatorPool, a new one wrapping the executor, or a new pool of
+        worker processes if pool is None. If n_subjects and n_voxels are
+        given, the new pool's workers and BLAS threads are chosen by
+        plan_parallelism.
+
+    """
+    if isinstance(pool, EstimatorPool):
+        return pool
+    elif isinstance(pool, Executor):
+        return EstimatorPool(executor=pool)
+    elif pool is None:
+        if n_subjects is None or n_voxels is None:
+            return EstimatorPool()
+        n_workers, blas_threads = plan_parallelism(n_subjects, n_voxels)
+        # The threads were planned, not asked for, so are only a hint.
+        return EstimatorPool(n_workers, blas_threads, warn=False)
+    else:
+        raise TypeError('Unknown pool: ' + repr(pool) + '; expected an '
+                        'EstimatorPool or a concurrent.futures.Executor.')
+
+
+def bounded_map(pool, fn, args, max_in_flight, ordered=True, release=None):
+    """Map a function over argument tuples in a pool, a few at a time.
+
+    The arguments are only drawn from args as tasks are submitted, and no
+    more than max_in_flight tasks are submitted and not yet collected, so
+    that however long args is, only that many are held in memory at once.
+    Tasks that are still pending when the iteration stops are cancelled.
+
+    Arguments
+    ---------
+        pool: EstimatorPool or concurrent.futures.Executor.
+        fn: Function to run.
+        args: Iterable of tuples of the arguments of each task.
+        max_in_flight: Most tasks submitted and not yet collected.
+        ordered: If True, yield the results in the order of args, otherwise
+            as soon as each finishes; default: True.
+        release: Optional function called with the arguments of each task
+            once its result has been collected, such as to free its shared
+            arrays; default: None.
+
+    Returns
+    -------
+        Generator of fn(*arg) for each arg in args.
+
+    """
+    if max_in_flight < 1:
+        raise ValueError('max_in_flight must be at least 1, not ' +
+                         str(max_in_flight) + '.')
+
+    # Futures in the order they were submitted, and their arguments.
+    pending = collections.deque()
+    task_args = {}
+    # While profiling, the workers profile each task, and their profiles are
+    # merged into this one as the tasks are collected.
+    profile = profiling.state.profile
+
+    def collect():
+        with profiling.stage('wait'):
+            if ordered:
+                future = pending.popleft()
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                future = next(future for future in pending if future in done)
+                pending.remove(future)
+            try:
+                result = future.result()
+            finally:
+                arg = task_args.pop(future)
+                if release is not None:
+                    release(arg)
+        if profile is None:
+            return result
+        result, task_profile = result
+        profile.merge(task_profile)
+        return result
+
+    def results():
+        try:
+            for arg in args:
+                if len(pending) == max_in_flight:
+                    yield collect()
+                if profile is None:
+                    future = pool.submit(fn, *arg)
+                else:
+                    if profile.pickling:
+                        profile.time_pickling(arg)
+                    # Handing the task to the pool, without the pickling of
+                    # its arguments by a process pool, which follows.
+                    with profiling.stage('submit', profiling.array_bytes(arg)):
+                        future = pool.submit(profiling.run_profiled,
+                                             profile.keep_events, fn, *arg)
+                pending.append(future)
+                task_args[future] = arg
+
+            while pending:
+                yield collect()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    # The results are a generator of their own, so that max_in_flight is
+    # checked when bounded_map is called, rather than at the first result.
+    return results()
+
+
+class SharedArray(object):
+    """Handle to a Numpy array memory-mapped from a file in shared memory.
+
+    Only the path of the file is pickled, so passing a SharedArray to a
+    worker process does not copy the array, and load returns a read-only
+    view of the same memory.
+    """
+
+    def __init__(self, path):  # noqa:D107
+        self.path = path
+
+    def load(self):
+        """Memory-map the array, read-only."""
+        return np.load(self.path, mmap_mode='r')
+
+
+class SharedArrays(object):
+    """Temporary directory of SharedArrays, in RAM where possible.
+
+    The directory is on /dev/shm where that exists, so that the files are
+    never written to disk. It is removed, with any remaining arrays, by
+    close, or on leaving the context.
+    """
+
+    def __init__(self):  # noqa:D107
+        shm = '/dev/shm'
+        self.path = tempfile.mkdtemp(
+            prefix='funcdim-', dir=shm if os.path.isdir(shm) else None)
+        self.n_arrays = 0
+
+    def put(self, array, mask=None, dtype=None):
+        """Copy an array into shared memory.
+
+        Arguments
+        ---------
+            array: Numpy array.
+            mask: Optional boolean Numpy array, to select elements along the
+                first axis of array as they are copied, as array[mask].
+            dtype: Data type of the copy; default: that of array.
+
+        Returns
+        -------
+            SharedArray for the copy.
+
+        """
+        array = np.asanyarray(array)
+        shape = array.shape
+        if mask is not None:
+            shape = (int(np.count_nonzero(mask)),) + shape[1:]
+
+        path = os.path.join(self.path, str(self.n_arrays) + '.npy')
+        self.n_arrays += 1
+        shared = np.lib.format.open_memmap(
+            path, mode='w+', dtype=array.dtype if dtype is None else dtype,
+            shape=shape)
+        if mask is None:
+            shared[...] = array
+        else:
+            np.compress(mask, array, axis=0, out=shared)
+        shared.flush()
+        del shared
+        return SharedArray(path)
+
+    def remove(self, shared):
+        """Remove a SharedArray, once no worker needs it."""
+        if shared is not None:
+            os.remove(shared.path)
+
+    def close(self):
+        """Remove the directory and every array in it."""
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):  # noqa:D105
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):  # noqa:D105
+        self.close()
@@ -0,0 +1,260 @@
+"""Copyright 2018.
+
+Authors: Christiane Ahlheim, Sebastian Bobadilla-Suarez, Kurt Braunlich,
+Giles Greenway, & Olivia Guest.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import contextlib
+import functools
+import json
+import numpy as np
+import os
+import pickle
+import threading
+import time
+
+
+class ProfileState(threading.local):
+    """The profile that each thread records its stages in, if any."""
+
+    profile = None
+
+
+state = ProfileState()
+
+# Context manager that does nothing, for stages while profiling is off.
+no_stage = contextlib.nullcontext()
+
+
+class Profile(object):
+    """Wall time, calls and bytes of each stage of an estimate.
+
+    Stages are recorded while the profile is active, as by profile, and
+    those run by the workers of a pool are merged into it as their tasks
+    are collected by parallel.bounded_map.
+
+    The 'submit' stage of bounded_map only hands each task to the pool. A
+    process pool pickles the task's arguments afterwards, in a thread of its
+    own, so that serialization is not in any stage, unless pickling is set.
+
+    Arguments
+    ---------
+        events: If True, keep every call as an event for the Chrome trace,
+            as well as the totals of each stage; default: True.
+        pickling: If True, bounded_map pickles the arguments of each task
+            once more before submitting it, and records that as the
+            'pickle' stage, with the bytes pickled, to estimate the cost of
+            sending tasks to worker processes; default: False.
+
+    """
+
+    def __init__(self, events=True, pickling=False):  # noqa:D107
+        self.keep_events = events
+        self.pickling = pickling
+        # The number of calls, seconds and bytes of each stage.
+        self.stages = {}
+        self.events = []
+
+    def record(self, name, start, duration, nbytes=0, args=None):
+        """Record a call of a stage, which started at time.time() start."""
+        stage = self.stages.setdefault(name, [0, 0.0, 0])
+        stage[0] += 1
+        stage[1] += duration
+        stage[2] += nbytes
+        if self.keep_events:
+            self.events.append((name, start, duration, nbytes, os.getpid(),
+                                threading.get_ident(), args))
+
+    def time_pickling(self, value):
+        """Record the time and bytes of pickling value, as 'pickle'."""
+        start = time.time()
+        clock = time.perf_counter()
+        nbytes = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self.record('pickle', start, time.perf_counter() - clock, nbytes)
+
+    def merge(self, other):
+        """Add the stages and events of another Profile, such as a worker's."""
+        for name, (count, seconds, nbytes) in other.stages.items():
+            stage = self.stages.setdefault(name, [0, 0.0, 0])
+            stage[0] += count
+            stage[1] += seconds
+            stage[2] += nbytes
+        if self.keep_events:
+            self.events.extend(other.events)
+
+    def report(self):
+        """The profile as a dictionary.
+
+        Returns
+        -------
+            Dictionary of:
+            stages: For each stage, its number of calls, total wall time in
+                seconds and the bytes of the arrays it was given.
+            workers: For each worker process and thread, as 'pid:tid', its
+                number of tasks and their total wall time.
+            subjects: For each subject, the total wall time of its
+                estimates.
+
+            workers and subjects are only known if events were kept.
+
+        """
+        workers = {}
+        subjects = {}
+        for name, _, duration, _, pid, tid, args in self.events:
+            if name == 'task':
+                worker = workers.setdefault('{}:{}'.format(pid, tid),
+                                            {'count': 0, 'seconds': 0.0})
+                worker['count'] += 1
+                worker['seconds'] += duration
+            if args is not None and 'subject' in args:
+                subject = str(args['subject'])
+                subjects[subject] = subjects.get(subject, 0.0) + duration
+
+        return {'stages': {name: {'count': count, 'seconds': seconds,
+                                  'bytes': nbytes}
+                           for name, (count, seconds, nbytes)
+                           in self.stages.items()},
+                'workers': workers, 'subjects': subjects}
+
+    def chrome_trace(self):
+        """The events as a Chrome trace, for chrome://tracing or Perfetto."""
+        return {'traceEvents': [
+            {'name': name, 'ph': 'X', 'ts': start * 1e6,
+             'dur': duration * 1e6, 'pid': pid, 'tid': tid,
+             'args': dict(args or {}, bytes=nbytes)}
+            for name, start, duration, nbytes, pid, tid, args
+            in self.events]}
+
+    def save_json(self, path):
+        """Write the report to a JSON file."""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1, default=str)
+
+    def save_chrome_trace(self, path):
+        """Write the events to a JSON file in the Chrome trace format."""
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f, default=str)
+
+
+@contextlib.contextmanager
+def profile(events=True, pickling=False):
+    """Profile the stages run by this thread, and by any pool it submits to.
+
+    Arguments
+    ---------
+        events, pickling: As for Profile; default: True and False.
+
+    Yields
+    ------
+        The Profile, which holds the stages once the context is left.
+
+    """
+    previous = state.profile
+    state.profile = Profile(events, pickling)
+    try:
+        yield state.profile
+    finally:
+        state.profile = previous
+
+
+class Stage(object):
+    """Context manager that records a stage in a Profile."""
+
+    __slots__ = ['profile', 'name', 'nbytes', 'args', 'start', 'clock']
+
+    def __init__(self, profile, name, nbytes, args):  # noqa:D107
+        self.profile = profile
+        self.name = name
+        self.nbytes = nbytes
+        self.args = args
+
+    def __enter__(self):  # noqa:D105
+        self.start = time.time()
+        self.clock = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):  # noqa:D105
+        self.profile.record(self.name, self.start,
+                            time.perf_counter() - self.clock, self.nbytes,
+                            self.args)
+
+
+def stage(name, nbytes=0, **args):
+    """Time a stage, if this thread is profiling.
+
+    Arguments
+    ---------
+        name: Name of the stage.
+        nbytes: Bytes that the stage moves or is given; default: 0.
+        args: Details of this call of the stage, such as its subject, which
+            are kept in its event.
+
+    Returns
+    -------
+        Context manager, which does nothing while profiling is off.
+
+    """
+    if state.profile is None:
+        return no_stage
+    return Stage(state.profile, name, nbytes, args or None)
+
+
+def array_bytes(values):
+    """Total bytes of the Numpy arrays among values."""
+    return sum(value.nbytes for value in values
+               if isinstance(value, np.ndarray))
+
+
+def profiled(fn):
+    """Decorate a function to be recorded as a stage while profiling.
+
+    The stage is named after the function, and its bytes are those of the
+    arrays among the function's positional arguments. While profiling is
+    off, the function is called straight away.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        profile = state.profile
+        if profile is None:
+            return fn(*args, **kwargs)
+        with Stage(profile, fn.__name__, array_bytes(args), None):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def run_profiled(events, fn, *args):
+    """Run a task in a worker, profiling it.
+
+    Arguments
+    ---------
+        events: As for Profile.
+        fn: Function of the task.
+        args: Arguments of fn.
+
+    Returns
+    -------
+        The result of fn(*args), and the Profile of the task, to be merged
+        into that of the process that submitted it.
+
+    """
+    previous = state.profile
+    state.profile = Profile(events)
+    try:
+        with stage('task'):
+            result = fn(*args)
+        return (result, state.profile)
+    finally:
+        state.profile = previous
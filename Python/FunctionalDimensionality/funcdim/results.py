@@ -0,0 +1,344 @@
+"""Copyright 2018.
+
+Authors: Christiane Ahlheim, Sebastian Bobadilla-Suarez, Kurt Braunlich,
+Giles Greenway, & Olivia Guest.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import abc
+import numpy as np
+import zipfile
+
+try:
+    import h5py
+except ImportError:  # pragma: no cover
+    h5py = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+# Columns of the results and their types. Categorical columns hold the code
+# of each row's label, and the labels are kept by the sink.
+CATEGORICAL = ['roi', 'subject_ID']
+COLUMN_TYPES = {'roi': np.int32, 'subject_ID': np.int32,
+                'test_run': np.int8, 'winning_model': np.int8,
+                'test_correlation': np.float32, 'p_value': np.float32,
+                'n_permutations': np.int32}
+
+
+def row_dtype(roi=False, p_values=False):
+    """Structured Numpy type of the rows of results.
+
+    Arguments
+    ---------
+        roi: If True, include the 'roi' column; default: False.
+        p_values: If True, include the 'p_value' and 'n_permutations'
+            columns of stats.permutation_dimensionality; default: False.
+
+    """
+    columns = ['subject_ID', 'test_run', 'winning_model', 'test_correlation']
+    if roi:
+        columns = ['roi'] + columns
+    if p_values:
+        columns = columns + ['p_value', 'n_permutations']
+    return np.dtype([(column, COLUMN_TYPES[column]) for column in columns])
+
+
+def decode(table, categories):
+    """Columns of a table of results, with the labels of its categories.
+
+    Arguments
+    ---------
+        table: Structured Numpy array of rows, of type row_dtype.
+        categories: Dictionary of the labels of each categorical column, in
+            the order of their codes.
+
+    Returns
+    -------
+        Dictionary of a Numpy array for each column, as returned by
+        functional_dimensionality, but with the types of the table.
+
+    """
+    return {column: (np.asarray(categories[column])[table[column]]
+                     if column in categories else table[column])
+            for column in table.dtype.names}
+
+
+class ResultSink(abc.ABC):
+    """Destination that results are appended to as they complete.
+
+    Subclasses must write each chunk of rows, as a structured Numpy array of
+    type row_dtype, with write, and may finish writing with finish. Use a
+    sink as a context manager, or call close when finished.
+
+    Arguments
+    ---------
+        roi: If True, the results have a categorical 'roi' column, as those
+            of multi_roi_dimensionality; default: False.
+        chunk_size: Rows that are held before being written; default:
+            10000.
+        p_values: If True, the results have the p-values of
+            stats.permutation_dimensionality; default: False.
+
+    """
+
+    def __init__(self, roi=False, chunk_size=10000,
+                 p_values=False):  # noqa:D107
+        self.dtype = row_dtype(roi, p_values)
+        self.chunk_size = chunk_size
+        # The code of each label of each categorical column, in order.
+        self.codes = {column: {} for column in CATEGORICAL
+                      if column in self.dtype.names}
+        self.pending = []
+        self.n_pending = 0
+
+    @property
+    def categories(self):
+        """The labels of each categorical column, in the order of codes."""
+        return {column: list(codes) for column, codes in self.codes.items()}
+
+    def encode(self, estimate):
+        """Rows of a structured array for an estimate.
+
+        Arguments
+        ---------
+            estimate: Dictionary of the estimate of a subject, or of a
+                subject and ROI, as yielded by
+                iter_functional_dimensionality.
+
+        """
+        n_rows = len(estimate['test_run'])
+        rows = np.empty(n_rows, dtype=self.dtype)
+        for column in self.dtype.names:
+            values = np.asarray(estimate[column]).ravel()
+            if column in self.codes:
+                labels, inverse = np.unique(values, return_inverse=True)
+                codes = self.codes[column]
+                rows[column] = np.array(
+                    [codes.setdefault(label, len(codes))
+                     for label in labels.tolist()],
+                    dtype=rows.dtype[column])[inverse]
+            else:
+                if rows.dtype[column].kind == 'i':
+                    info = np.iinfo(rows.dtype[column])
+                    if np.any((values < info.min) | (values > info.max)):
+                        raise ValueError('"' + column + '" does not fit in '
+                                         + str(rows.dtype[column]) + '.')
+                rows[column] = values
+        return rows
+
+    def append(self, estimate):
+        """Append an estimate, writing the rows held once there are enough."""
+        rows = self.encode(estimate)
+        self.pending.append(rows)
+        self.n_pending += len(rows)
+        if self.n_pending >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Write the rows held."""
+        if self.pending:
+            self.write(np.concatenate(self.pending))
+            self.pending = []
+            self.n_pending = 0
+
+    @abc.abstractmethod
+    def write(self, rows):
+        """Write a chunk of rows."""
+
+    def finish(self):
+        """Finish writing, once every row has been written."""
+
+    def close(self):
+        """Write any rows held, and finish writing."""
+        self.flush()
+        self.finish()
+
+    def __enter__(self):  # noqa:D105
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):  # noqa:D105
+        self.close()
+
+
+class ArraySink(ResultSink):
+    """Sink that keeps the results in memory, as a structured Numpy array.
+
+    Arguments
+    ---------
+        As for ResultSink.
+
+    """
+
+    def __init__(self, roi=False, chunk_size=10000,
+                 p_values=False):  # noqa:D107
+        super().__init__(roi, chunk_size, p_values)
+        self.chunks = []
+
+    def write(self, rows):  # noqa:D102
+        self.chunks.append(rows)
+
+    def table(self):
+        """The rows appended so far, as a structured Numpy array."""
+        self.flush()
+        if len(self.chunks) != 1:
+            self.chunks = [np.concatenate(self.chunks) if self.chunks
+                           else np.empty(0, dtype=self.dtype)]
+        return self.chunks[0]
+
+    def to_dict(self):
+        """The rows appended so far, as a dictionary of columns, as decode."""
+        return decode(self.table(), self.categories)
+
+
+class NpzSink(ResultSink):
+    """Sink that writes the results to a .npz file, a chunk at a time.
+
+    Each chunk is added to the file as a structured array, and the labels
+    of the categorical columns are added on closing. Read the file with
+    load_npz.
+
+    Arguments
+    ---------
+        path: Path of the file, which is overwritten.
+        roi, chunk_size, p_values: As for ResultSink.
+
+    """
+
+    def __init__(self, path, roi=False, chunk_size=10000,
+                 p_values=False):  # noqa:D107
+        super().__init__(roi, chunk_size, p_values)
+        self.file = zipfile.ZipFile(path, 'w', allowZip64=True)
+        self.n_chunks = 0
+
+    def write(self, rows):  # noqa:D102
+        with self.file.open('rows_{:06d}.npy'.format(self.n_chunks),
+                            'w', force_zip64=True) as f:
+            np.lib.format.write_array(f, rows, allow_pickle=False)
+        self.n_chunks += 1
+
+    def finish(self):  # noqa:D102
+        if self.n_chunks == 0:
+            # An empty chunk, so that load_npz has the columns' types.
+            self.write(np.empty(0, dtype=self.dtype))
+        for column, labels in self.categories.items():
+            with self.file.open(column + '.npy', 'w') as f:
+                np.lib.format.write_array(f, np.asarray(labels),
+                                          allow_pickle=False)
+        self.file.close()
+
+
+def load_npz(path):
+    """Load results written by an NpzSink.
+
+    Returns
+    -------
+        Dictionary of columns, as decode.
+
+    """
+    with np.load(path) as npz:
+        chunks = sorted(name for name in npz.files
+                        if name.startswith('rows_'))
+        table = np.concatenate([npz[name] for name in chunks])
+        categories = {column: npz[column] for column in CATEGORICAL
+                      if column in table.dtype.names}
+    return decode(table, categories)
+
+
+class Hdf5Sink(ResultSink):
+    """Sink that writes the results to an HDF5 file, a chunk at a time.
+
+    Each column is a resizable dataset, and the labels of each categorical
+    column are written on closing as a dataset of strings with the suffix
+    '_categories'. This needs h5py.
+
+    Arguments
+    ---------
+        path: Path of the file, which is overwritten.
+        roi, chunk_size, p_values: As for ResultSink.
+
+    """
+
+    def __init__(self, path, roi=False, chunk_size=10000,
+                 p_values=False):  # noqa:D107
+        if h5py is None:
+            raise ImportError('Hdf5Sink needs h5py.')
+        super().__init__(roi, chunk_size, p_values)
+        self.file = h5py.File(path, 'w')
+        for column in self.dtype.names:
+            self.file.create_dataset(column, shape=(0,), maxshape=(None,),
+                                     dtype=self.dtype[column],
+                                     chunks=(chunk_size,))
+
+    def write(self, rows):  # noqa:D102
+        for column in self.dtype.names:
+            dataset = self.file[column]
+            n_rows = len(dataset)
+            dataset.resize(n_rows + len(rows), axis=0)
+            dataset[n_rows:] = rows[column]
+
+    def finish(self):  # noqa:D102
+        for column, labels in self.categories.items():
+            self.file.create_dataset(
+                column + '_categories',
+                data=np.array([str(label) for label in labels],
+                              dtype=h5py.string_dtype()))
+        self.file.close()
+
+
+class ParquetSink(ResultSink):
+    """Sink that writes the results to a Parquet file, a row group at a time.
+
+    Categorical columns are dictionary-encoded, with their labels as
+    strings, so they are read as pandas categoricals. This needs pyarrow.
+
+    Arguments
+    ---------
+        path: Path of the file, which is overwritten.
+        roi, chunk_size, p_values: As for ResultSink.
+
+    """
+
+    def __init__(self, path, roi=False, chunk_size=10000,
+                 p_values=False):  # noqa:D107
+        if pyarrow is None:
+            raise ImportError('ParquetSink needs pyarrow.')
+        super().__init__(roi, chunk_size, p_values)
+        self.schema = pyarrow.schema([
+            (column, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+             if column in self.codes
+             else pyarrow.from_numpy_dtype(self.dtype[column]))
+            for column in self.dtype.names])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):  # noqa:D102
+        categories = self.categories
+        arrays = []
+        for column in self.dtype.names:
+            if column in categories:
+                arrays.append(pyarrow.DictionaryArray.from_arrays(
+                    pyarrow.array(rows[column]),
+                    pyarrow.array([str(label)
+                                   for label in categories[column]])))
+            else:
+                arrays.append(pyarrow.array(rows[column]))
+        self.writer.write_table(pyarrow.Table.from_arrays(
+            arrays, schema=self.schema))
+
+    def finish(self):  # noqa:D102
+        self.writer.close()
@@ -0,0 +1,331 @@
+"""Copyright 2018.
+
+Authors: Christiane Ahlheim, Sebastian Bobadilla-Suarez, Kurt Braunlich,
+Giles Greenway, & Olivia Guest.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from funcdim.crossval import crossval_correlations
+from funcdim.crossval import gram_crossval_correlations
+from funcdim.crossval import select_models
+from funcdim.crossval import session_grams
+from funcdim.funcdim import pre_proc
+from funcdim.parallel import as_pool
+from funcdim.parallel import SharedArrays
+import numpy as np
+
+# Most spheres whose Gram matrices are updated incrementally before they are
+# recomputed from the data, to stop rounding errors accumulating.
+REFRESH_INTERVAL = 100
+
+
+def sphere_offsets(radius):
+    """Offsets of the voxels within a sphere.
+
+    Arguments
+    ---------
+        radius: Radius of the sphere, in voxels.
+
+    Returns
+    -------
+        k * 3 Numpy array of the offsets from the centre of the k voxels
+        whose centres are within radius of it, in lexicographic order.
+
+    """
+    extent = int(np.floor(radius))
+    grid = np.mgrid[-extent:extent + 1, -extent:extent + 1,
+                    -extent:extent + 1].reshape(3, -1).T
+    return grid[np.square(grid).sum(axis=1) <= radius**2]
+
+
+def sphere_neighbourhoods(mask, radius):
+    """Index of the voxels in the sphere around every voxel in a mask.
+
+    The index is stored in compressed sparse row form, so that the voxels of
+    the sphere around the ith voxel of the mask are
+    indices[indptr[i]:indptr[i + 1]]. Voxels are numbered in the order of
+    np.flatnonzero(mask), which is the order of brain[mask.ravel()], and
+    those of each sphere are in ascending order.
+
+    Arguments
+    ---------
+        mask: Mask as an i * j * k Numpy array of booleans.
+        radius: Radius of the spheres, in voxels.
+
+    Returns
+    -------
+        indptr: Numpy array of n + 1 offsets into indices, for the n voxels
+            in the mask.
+        indices: Numpy array of the voxels in each sphere that are also in
+            the mask.
+
+    """
+    coords = np.argwhere(mask)
+    n_voxels = len(coords)
+    index_dtype = np.int32 if n_voxels < np.iinfo(np.int32).max else np.int64
+
+    # The number of each voxel in the mask, or -1 outside it.
+    index = np.full(mask.shape, -1, dtype=index_dtype)
+    index[mask] = np.arange(n_voxels, dtype=index_dtype)
+
+    offsets = sphere_offsets(radius)
+    neighbours = np.full((n_voxels, len(offsets)), -1, dtype=index_dtype)
+    for i_offset, offset in enumerate(offsets):
+        neighbour = coords + offset
+        inside = np.all((neighbour >= 0) & (neighbour < mask.shape), axis=1)
+        neighbours[inside, i_offset] = index[tuple(neighbour[inside].T)]
+
+    in_mask = neighbours >= 0
+    indptr = np.zeros(n_voxels + 1, dtype=np.int64)
+    np.cumsum(in_mask.sum(axis=1), out=indptr[1:])
+    return (indptr, neighbours[in_mask])
+
+
+def sphere_estimates(data, res, option='mean', method='svd', batched=False):
+    """Estimate dimensionality within one searchlight sphere.
+
+    Arguments
+    ---------
+        data: n * m * o Numpy array of beta values for the n voxels of the
+            sphere, for m conditions over o sessions.
+        res: Residuals for the voxels of the sphere, or None.
+        option: 'full' or 'mean'; default: 'mean'.
+        method: 'svd' or 'gram'; default: 'svd'.
+        batched: As for svd_nested_crossval; default: False.
+
+    Returns
+    -------
+        bestn: The winning dimensionality for each run.
+        r_outer: The correlation of the reconstruction of the winning
+            dimensionality with the test data for each run.
+        r_alter: The correlation of the full-dimensional reconstruction with
+            the test data for each run.
+
+    """
+    if res is not None:
+        data = pre_proc(data, res)
+
+    return sphere_results(*crossval_correlations(data, method, batched),
+                          option=option)
+
+
+def sphere_results(rmat, test_rmat, option='mean'):
+    """The outputs of sphere_estimates from its correlations.
+
+    Arguments
+    ---------
+        rmat: Validation correlations, as returned by crossval_correlations.
+        test_rmat: Test correlations, as returned by crossval_correlations.
+        option: 'full' or 'mean'; default: 'mean'.
+
+    """
+    _, winning_model, test_correlation = select_models(rmat, test_rmat,
+                                                       option)
+    r_alter = np.broadcast_to(test_rmat[-1], winning_model.shape)
+    return (winning_model + 1, test_correlation, r_alter)
+
+
+def update_grams(gram, col_sum, data, sign=1):
+    """Add or remove voxels from session Gram matrices, in place.
+
+    Arguments
+    ---------
+        gram: Gram matrices between sessions, as returned by session_grams.
+        col_sum: Column sums of each session, as returned by session_grams.
+        data: n * m * o Numpy array of beta values for the n voxels to add
+            or remove.
+        sign: 1 to add the voxels, or -1 to remove them; default: 1.
+
+    """
+    voxel_gram, voxel_col_sum = session_grams(data)
+    gram += sign * voxel_gram
+    col_sum += sign * voxel_col_sum
+
+
+def incremental_sphere_estimates(data, indptr, indices, start, stop,
+                                 option='mean'):
+    """Estimate dimensionality for consecutive spheres from updated Grams.
+
+    Consecutive voxels of a mask are mostly neighbours, whose spheres share
+    most of their voxels. Rather than factorizing each sphere from scratch,
+    the Gram matrices between its sessions are updated from those of the
+    previous sphere, by adding the voxels that enter it and removing those
+    that leave, and the nested cross-validation is run on those, as by
+    gram_crossval_correlations.
+
+    Arguments
+    ---------
+        data: Numpy array of the masked beta values.
+        indptr, indices: Sphere index, as returned by sphere_neighbourhoods.
+        start: First voxel of the range.
+        stop: Voxel after the last of the range.
+        option: 'full' or 'mean'; default: 'mean'.
+
+    Returns
+    -------
+        List of the outputs of sphere_estimates for each sphere.
+
+    """
+    estimates = []
+    sphere = None
+    n_updates = 0
+    for centre in range(start, stop):
+        new_sphere = indices[indptr[centre]:indptr[centre + 1]]
+        if sphere is not None:
+            entering = np.setdiff1d(new_sphere, sphere, assume_unique=True)
+            leaving = np.setdiff1d(sphere, new_sphere, assume_unique=True)
+
+        if sphere is None or n_updates == REFRESH_INTERVAL or \
+                len(entering) + len(leaving) >= len(new_sphere):
+            gram, col_sum = session_grams(data[new_sphere])
+            n_updates = 0
+        else:
+            update_grams(gram, col_sum, data[entering])
+            update_grams(gram, col_sum, data[leaving], -1)
+            n_updates += 1
+
+        sphere = new_sphere
+        estimates.append(sphere_results(
+            *gram_crossval_correlations(gram, col_sum, len(sphere)),
+            option=option))
+
+    return estimates
+
+
+def searchlight_chunk(data, res, indptr, indices, start, stop,
+                      option='mean', method='svd', batched=False,
+                      incremental=False):
+    """Estimate dimensionality for the spheres around a range of voxels.
+
+    Arguments
+    ---------
+        data: parallel.SharedArray of the masked beta values.
+        res: parallel.SharedArray of the masked residuals, or None.
+        indptr: parallel.SharedArray of the offsets of the sphere index.
+        indices: parallel.SharedArray of the voxels of the sphere index.
+        start: First voxel of the range.
+        stop: Voxel after the last of the range.
+        option, method, batched: As for sphere_estimates.
+        incremental: If True, estimate as incremental_sphere_estimates;
+            default: False.
+
+    Returns
+    -------
+        The outputs of sphere_estimates, each stacked over the voxels.
+
+    """
+    data = data.load()
+    res = None if res is None else res.load()
+    indptr = indptr.load()
+    indices = indices.load()
+
+    if incremental:
+        estimates = incremental_sphere_estimates(data, indptr, indices, start,
+                                                 stop, option)
+    else:
+        estimates = []
+        for centre in range(start, stop):
+            sphere = indices[indptr[centre]:indptr[centre + 1]]
+            estimates.append(sphere_estimates(
+                data[sphere], None if res is None else res[sphere], option,
+                method, batched))
+
+    return tuple(np.stack(estimate) for estimate in zip(*estimates))
+
+
+def searchlight_estimate_dim(data, mask, res=None, radius=3, option='mean',
+                             method='svd', batched=False, pool=None,
+                             chunk_size=None, incremental=False):
+    """Run a searchlight for a subject.
+
+    Dimensionality is estimated as by svd_nested_crossval in the sphere
+    around every voxel in the mask, after pre-whitening each sphere if
+    residuals are given. The spheres are estimated in chunks of consecutive
+    voxels by a pool of workers, which read the data from shared memory.
+
+    Arguments
+    ---------
+        data: n_voxels * n_conditions * n_sessions Numpy array of beta
+            values for one subject.
+        mask: Mask as an i * j * k Numpy array of booleans such that
+            i * j * k = n_voxels. Only voxels in the mask are centres of, or
+            included in, spheres.
+        res: Residuals, in the same form as data; default: None.
+        radius: Radius of the spheres, in voxels; default: 3.
+        option: 'full' or 'mean'; default: 'mean'.
+        method: 'svd' or 'gram', the factorization used for each fold;
+            default: 'svd'.
+        batched: As for svd_nested_crossval; default: False.
+        pool: parallel.EstimatorPool or concurrent.futures.Executor to run
+            the chunks; default: a new pool of worker processes.
+        chunk_size: Number of spheres in each task sent to the pool;
+            default: enough for four tasks per worker.
+        incremental: If True, update the Gram matrices of each sphere from
+            those of the previous one, as incremental_sphere_estimates,
+            rather than factorizing every sphere from scratch. This always
+            uses the 'gram' factorization, so method and batched are
+            ignored, and it cannot pre-whiten, so res must be None; default:
+            False.
+
+    Returns
+    -------
+        bestn: For each run, the winning dimensionality.
+        r_outer: For each run, the correlation of the winning
+            dimensionality-reconstruction with the test data set.
+        r_alter: For each run, the correlation achieved by a
+            full-dimensional reconstruction with the test data set.
+
+        Each is an i * j * k * r Numpy array, or i * j * k * (r - 1) * r for
+        option 'full', for r runs, which is NaN outside the mask.
+
+    """
+    if option not in ['full', 'mean']:
+        raise ValueError('Unknown option: "' + str(option) +
+                         '"; "full" and "mean" are the only options.')
+    if incremental and res is not None:
+        raise ValueError('Incremental searchlights cannot pre-whiten each '
+                         'sphere, so res must be None.')
+
+    flat_mask = mask.ravel()
+    indptr, indices = sphere_neighbourhoods(mask, radius)
+    n_centres = len(indptr) - 1
+
+    owns_pool = pool is None
+    pool = as_pool(pool)
+    if chunk_size is None:
+        chunk_size = max(1, -(-n_centres // (4 * pool.n_workers)))
+
+    try:
+        with SharedArrays() as shared:
+            args = (shared.put(data, flat_mask),
+                    None if res is None else shared.put(res, flat_mask),
+                    shared.put(indptr), shared.put(indices))
+            futures = [pool.submit(searchlight_chunk, *args, start,
+                                   min(start + chunk_size, n_centres),
+                                   option, method, batched, incremental)
+                       for start in range(0, n_centres, chunk_size)]
+            chunks = [future.result() for future in futures]
+    finally:
+        if owns_pool:
+            pool.close(cancel=True)
+
+    volumes = []
+    for estimate in zip(*chunks):
+        estimate = np.concatenate(estimate)
+        volume = np.full(mask.shape + estimate.shape[1:], np.nan)
+        volume[mask] = estimate
+        volumes.append(volume)
+
+    return tuple(volumes)
@@ -0,0 +1,544 @@
+"""Copyright 2018.
+
+Authors: Christiane Ahlheim, Sebastian Bobadilla-Suarez, Kurt Braunlich,
+Giles Greenway, & Olivia Guest.
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from funcdim.crossval import gram_crossval_correlations
+from funcdim.crossval import select_models
+from funcdim.crossval import session_grams
+from funcdim.funcdim import append_to_sink
+from funcdim.funcdim import iter_functional_dimensionality
+from funcdim.funcdim import pre_proc
+from funcdim.parallel import as_pool
+from funcdim.parallel import bounded_map
+import numpy as np
+
+# Bytes that permutation_test uses at once for its batches of permutations,
+# unless given a batch_size.
+PERMUTATION_MEMORY = 2**28
+
+# Bytes that each chunk of bootstrap replicates uses, unless given a
+# chunk_size.
+BOOTSTRAP_MEMORY = 2**28
+
+
+def random_permutations(rng, n_permutations, n_session, n_beta):
+    """Independent random orders of the conditions of every session.
+
+    Arguments
+    ---------
+        rng: numpy.random.Generator.
+        n_permutations: Number of permutations.
+        n_session: Number of sessions.
+        n_beta: Number of conditions.
+
+    Returns
+    -------
+        n_permutations * n_session * n_beta Numpy array, such that
+        permutations[p, a] is the order of the conditions of session a in
+        permutation p.
+
+    """
+    return rng.permuted(np.broadcast_to(
+        np.arange(n_beta), (n_permutations, n_session, n_beta)), axis=-1)
+
+
+def permute_grams(gram, col_sum, permutations):
+    """Session Gram matrices of data with permuted conditions.
+
+    Permuting the conditions of each session permutes the rows and columns
+    of the Gram matrices between sessions, so the permuted data itself is
+    never needed.
+
+    Arguments
+    ---------
+        gram: o * m * o * m Numpy array of the Gram matrices between
+            sessions, as returned by crossval.session_grams.
+        col_sum: o * m Numpy array of the column sums of each session.
+        permutations: P * o * m Numpy array of the order of the conditions
+            of each session, as returned by random_permutations.
+
+    Returns
+    -------
+        gram: P * o * m * o * m Numpy array of the Gram matrices of each
+            permutation.
+        col_sum: P * o * m Numpy array of the column sums of each
+            permutation.
+
+    """
+    n_permutations, n_session, n_beta = permutations.shape
+    sessions = np.arange(n_session)
+    permuted_gram = gram[
+        sessions.reshape(1, n_session, 1, 1, 1),
+        permutations.reshape(n_permutations, n_session, n_beta, 1, 1),
+        sessions.reshape(1, 1, 1, n_session, 1),
+        permutations.reshape(n_permutations, 1, 1, n_session, n_beta)]
+    permuted_col_sum = col_sum[sessions.reshape(1, n_session, 1),
+                               permutations]
+    return (permuted_gram, permuted_col_sum)
+
+
+def permutation_batch_size(n_beta, n_session, itemsize=8,
+                           memory=PERMUTATION_MEMORY):
+    """Number of permutations whose folds fit in memory at once.
+
+    Each permutation needs about (o + 4) * (o * m)**2 elements, for its
+    permuted Gram matrices and those of the training set of every fold, so
+    the batches shrink quickly with the numbers of conditions and sessions:
+    for 40 conditions and 8 sessions, each permutation needs about 10 MB in
+    double precision.
+
+    Arguments
+    ---------
+        n_beta: Number of conditions m.
+        n_session: Number of sessions o.
+        itemsize: Bytes of each element; default: 8, for np.float64.
+        memory: Bytes to use; default: PERMUTATION_MEMORY.
+
+    Returns
+    -------
+        The number of permutations, at least 1.
+
+    """
+    per_permutation = itemsize * (n_session + 4) * (n_session * n_beta)**2
+    return max(1, int(memory // per_permutation))
+
+
+def mean_test_correlation(rmat, test_rmat, option='full'):
+    """Mean test correlation of the winning models, as the test statistic.
+
+    Arguments
+    ---------
+        rmat, test_rmat: Correlations, as returned by
+            crossval.gram_crossval_correlations, with any leading axes.
+        option: 'full' or 'mean'; default: 'full'.
+
+    Returns
+    -------
+        Mean of the test correlations returned by crossval.select_models,
+        for each element of the leading axes.
+
+    """
+    _, _, test_correlation = select_models(rmat, test_rmat, option)
+    n_axes = 2 if option == 'full' else 1
+    return test_correlation.mean(axis=tuple(range(-n_axes, 0)))
+
+
+def permutation_test(data, res=None, option='full', n_permutations=1000,
+                     min_exceedances=10, batch_size=None, seed=None,
+                     whitening_cache=None, dtype=np.float64):
+    """Permutation test of the test correlations of one subject.
+
+    Under the null hypothesis, the conditions have no consistent pattern
+    across sessions, so the conditions of each session are permuted
+    independently, and the nested cross-validation is rerun on the
+    permuted data. The statistic is the mean of the test correlations of
+    the winning models. The permutations are run from the Gram matrices
+    between sessions, as by crossval.gram_crossval_correlations, batch_size
+    at a time in stacked factorizations.
+
+    Permutations stop early once min_exceedances of them reach the observed
+    statistic, when the p-value is clearly large, as by Besag & Clifford
+    (1991), Sequential Monte Carlo p-values, Biometrika, 78(2), 301-304.
+
+    Arguments
+    ---------
+        data: n * m * o Numpy array of beta values for n voxels and m
+            conditions over o sessions.
+        res: Residuals for pre-whitening, as for funcdim.pre_proc; default:
+            None.
+        option: 'full' or 'mean'; default: 'full'.
+        n_permutations: Most permutations to run; default: 1000.
+        min_exceedances: Number of permutations reaching the observed
+            statistic after which to stop, or None to run every
+            permutation; default: 10.
+        batch_size: Number of permutations factorized together; default:
+            as many as fit in PERMUTATION_MEMORY bytes, as by
+            permutation_batch_size.
+        seed: Seed for numpy.random.default_rng, such as a
+            numpy.random.SeedSequence; default: None.
+        whitening_cache, dtype: As for funcdim.roi_estimator.
+
+    Returns
+    -------
+        test_run: Which test set was used.
+        winning_model: Winning models/dimensionality, as returned by
+            svd_nested_crossval with method 'gram'.
+        test_correlation: The out-of-sample correlation for the winning
+            model.
+        p_value: p-value of the mean test correlation.
+        n_drawn: Number of permutations run.
+
+    """
+    if option not in ['full', 'mean']:
+        raise ValueError('Unknown option: "' + str(option) +
+                         '"; "full" and "mean" are the only options.')
+
+    if res is None:
+        data = np.asarray(data, dtype=dtype)
+    else:
+        data = pre_proc(data, res, whitening_cache, dtype)
+    n_voxels, n_beta, n_session = data.shape
+    if batch_size is None:
+        batch_size = permutation_batch_size(n_beta, n_session,
+                                            data.dtype.itemsize)
+
+    gram, col_sum = session_grams(data)
+    rmat, test_rmat = gram_crossval_correlations(gram, col_sum, n_voxels)
+    test_run, winning_model, test_correlation = select_models(rmat, test_rmat,
+                                                              option)
+    observed = mean_test_correlation(rmat, test_rmat, option)
+
+    rng = np.random.default_rng(seed)
+    n_drawn = 0
+    n_exceed = 0
+    while n_drawn < n_permutations:
+        permutations = random_permutations(
+            rng, min(batch_size, n_permutations - n_drawn), n_session, n_beta)
+        null = mean_test_correlation(*gram_crossval_correlations(
+            *permute_grams(gram, col_sum, permutations), n_voxels),
+            option=option)
+        exceeds = np.flatnonzero(null >= observed)
+
+        if min_exceedances is not None and \
+                n_exceed + len(exceeds) >= min_exceedances:
+            # Stop at the permutation that reached min_exceedances.
+            n_drawn += exceeds[min_exceedances - n_exceed - 1] + 1
+            n_exceed = min_exceedances
+            break
+        n_exceed += len(exceeds)
+        n_drawn += len(permutations)
+
+    if min_exceedances is not None and n_exceed == min_exceedances:
+        p_value = n_exceed / n_drawn
+    else:
+        p_value = (n_exceed + 1) / (n_drawn + 1)
+
+    return (test_run, winning_model + 1, test_correlation, p_value, n_drawn)
+
+
+def permutation_estimator(data, res, subject_ID, option, n_permutations,
+                          min_exceedances, batch_size, seed, whitening_cache,
+                          dtype):
+    """Permutation test estimator for one subject, as for roi_estimator."""
+    test_run, winning_model, test_correlation, p_value, n_drawn = \
+        permutation_test(data, res, option, n_permutations, min_exceedances,
+                         batch_size, seed, whitening_cache, dtype)
+
+    n_rows = len(test_run)
+    return {'subject_ID': np.tile(subject_ID, n_rows), 'test_run': test_run,
+            'winning_model': np.ravel(winning_model),
+            'test_correlation': np.ravel(test_correlation),
+            'p_value': np.full(n_rows, p_value),
+            'n_permutations': np.full(n_rows, n_drawn)}
+
+
+def permutation_dimensionality(wholebrain_all, n_subjects, mask, res=None,
+                               option='full', subject_IDs=None,
+                               n_permutations=1000, min_exceedances=10,
+                               batch_size=None, seed=None,
+                               whitening_cache=None, pool=None,
+                               max_in_flight=None, shared_memory=False,
+                               dtype=np.float64, sink=None):
+    """Estimate functional dimensionality, with permutation p-values.
+
+    Subjects are read and sent to the pool as by
+    funcdim.functional_dimensionality, and each is estimated and tested by
+    permutation_test. Each gets its own random stream, spawned from seed, so
+    the results are reproducible however the subjects are shared between
+    the workers.
+
+    Arguments
+    ---------
+        wholebrain_all, n_subjects, mask, res, option, subject_IDs,
+        whitening_cache, pool, max_in_flight, shared_memory, dtype: As for
+            funcdim.functional_dimensionality.
+        n_permutations, min_exceedances, batch_size: As for
+            permutation_test.
+        seed: Seed for numpy.random.SeedSequence; default: None.
+        sink: As for funcdim.functional_dimensionality, made with
+            p_values=True.
+
+    Returns
+    -------
+        Dictionary of the results, as for functional_dimensionality, with
+        the keys:
+            p_value: p-value of the subject's mean test correlation.
+            n_permutations: Number of permutations run for the subject.
+
+        Or the sink, if one is given.
+
+    """
+    if sink is not None and 'p_value' not in sink.dtype.names:
+        raise ValueError('The sink needs columns for the p-values; make it '
+                         'with p_values=True.')
+
+    seeds = np.random.SeedSequence(seed).spawn(n_subjects)
+    estimates = iter_functional_dimensionality(
+        wholebrain_all, n_subjects, mask, res=res, option=option,
+        subject_IDs=subject_IDs, whitening_cache=whitening_cache, pool=pool,
+        max_in_flight=max_in_flight, shared_memory=shared_memory,
+        dtype=dtype, estimator=permutation_estimator,
+        estimator_args=((option, n_permutations, min_exceedances, batch_size,
+                         subject_seed, whitening_cache, dtype)
+                        for subject_seed in seeds))
+    if sink is not None:
+        return append_to_sink(estimates, sink)
+    estimates = list(estimates)
+
+    return {key: np.concatenate([estimate[key] for estimate in estimates])
+            for key in ['subject_ID', 'test_run', 'winning_model',
+                        'test_correlation', 'p_value', 'n_permutations']}
+
+
+def count_median(values, axis=-1):
+    """Median of small non-negative integers, from their counts.
+
+    Arguments
+    ---------
+        values: Numpy array of non-negative integers, such as winning
+            models.
+        axis: Axis along which to take the median; default: -1.
+
+    Returns
+    -------
+        Numpy array of the medians, as returned by np.median, without
+        sorting values.
+
+    """
+    values = np.moveaxis(values, axis, -1)
+    n_values = values.shape[-1]
+    n_bins = int(values.max()) + 1
+    n_medians = values[..., 0].size
+    offsets = np.arange(n_medians).reshape(values.shape[:-1] + (1,)) * n_bins
+    counts = np.bincount((values + offsets).ravel(),
+                         minlength=n_medians * n_bins)
+    cumulative = np.cumsum(counts.reshape(values.shape[:-1] + (n_bins,)),
+                           axis=-1)
+    # The middle one or two of the sorted values.
+    lower = np.argmax(cumulative > (n_values - 1) // 2, axis=-1)
+    upper = np.argmax(cumulative > n_values // 2, axis=-1)
+    return (lower + upper) / 2
+
+
+def bootstrap_replicates(winning_model, test_correlation, n_replicates,
+                         seed=None):
+    """Bootstrap replicates of the group dimensionality.
+
+    Subjects are resampled with replacement, and then the test runs of each
+    resampled subject, with all of the replicates' indices drawn at once.
+    Every voxel shares the resampled rows, so each replicate is summarized
+    by how many times it draws each row, and its medians and means are
+    weighted sums over the rows, as products with these weights, rather
+    than gathered voxel by voxel.
+
+    Arguments
+    ---------
+        winning_model: n_subjects * n_runs Numpy array of the winning
+            models of each subject, as non-negative integers, which may have
+            trailing axes, such as for the voxels of a searchlight.
+        test_correlation: Numpy array of the test correlations, of the same
+            shape.
+        n_replicates: Number of replicates.
+        seed: Seed for numpy.random.default_rng; default: None.
+
+    Returns
+    -------
+        median_model: Numpy array of the median winning model of each
+            replicate, with the trailing axes of winning_model.
+        mean_correlation: Numpy array of the mean test correlation of each
+            replicate, as for median_model.
+
+    """
+    rng = np.random.default_rng(seed)
+    n_subjects, n_runs = winning_model.shape[:2]
+    n_rows = n_subjects * n_runs
+    # Rows of the arrays flattened over subjects and runs, as subject *
+    # n_runs + run, offset by n_rows for each replicate.
+    rows = rng.integers(n_runs, size=(n_replicates, n_subjects, n_runs),
+                        dtype=np.intp)
+    rows += n_runs * rng.integers(n_subjects, size=(n_replicates, n_subjects,
+                                                    1), dtype=np.intp)
+    rows += n_rows * np.arange(n_replicates).reshape(n_replicates, 1, 1)
+    weights = np.bincount(rows.ravel(), minlength=n_replicates * n_rows)
+    weights = weights.reshape(n_replicates, n_rows).astype(np.float64)
+
+    models = winning_model.reshape(n_rows, -1)
+    # The middle one or two of the sorted values are the first values whose
+    # cumulative counts pass the middle, as for count_median.
+    cumulative = np.zeros((n_replicates, models.shape[1]))
+    lower = np.full(cumulative.shape, -1, dtype=np.intp)
+    upper = np.full(cumulative.shape, -1, dtype=np.intp)
+    for value in np.unique(models):
+        # In floating point, as numpy multiplies floating-point by boolean
+        # matrices without BLAS.
+        is_value = (models == value).astype(np.float64)
+        cumulative += np.matmul(weights, is_value)
+        lower[(lower < 0) & (cumulative > (n_rows - 1) // 2)] = value
+        upper[(upper < 0) & (cumulative > n_rows // 2)] = value
+
+    trailing = (n_replicates,) + winning_model.shape[2:]
+    return (((lower + upper) / 2).reshape(trailing),
+            (np.matmul(weights, test_correlation.reshape(n_rows, -1)) /
+             n_rows).reshape(trailing))
+
+
+def bootstrap(winning_model, test_correlation, n_replicates=10000,
+              confidence=0.95, seed=None, chunk_size=None, pool=None):
+    """Bootstrap confidence intervals for the group dimensionality.
+
+    The replicates are drawn by bootstrap_replicates in chunks of
+    chunk_size, each with its own random stream spawned from seed, so that
+    the results do not depend on whether, or how, the chunks are run in
+    parallel.
+
+    Arguments
+    ---------
+        winning_model, test_correlation: As for bootstrap_replicates. The
+            winning models may also be floating-point, such as the volumes
+            of searchlight.searchlight_estimate_dim stacked over subjects
+            and with their runs moved to the second axis, in which case
+            the elements of the trailing axes that are NaN for any subject
+            or run, such as voxels outside the mask, are left out, and are
+            NaN in the results.
+        n_replicates: Number of replicates; default: 10000.
+        confidence: Confidence level of the intervals; default: 0.95.
+        seed: Seed for numpy.random.SeedSequence; default: None.
+        chunk_size: Most replicates drawn at once, which bounds the memory
+            needed; default: as many as fit in BOOTSTRAP_MEMORY bytes, up to
+            1000. The replicates depend on the chunks, so the same
+            chunk_size is needed to reproduce them.
+        pool: parallel.EstimatorPool or concurrent.futures.Executor to draw
+            the chunks, such as for searchlight volumes; default: draw them
+            in this process.
+
+    Returns
+    -------
+        Dictionary with the keys:
+            median_winning_model: Median winning model over every subject
+                and run.
+            median_winning_model_ci: Lower and upper bounds of its
+                confidence interval.
+            mean_test_correlation: Mean test correlation.
+            mean_test_correlation_ci: Lower and upper bounds of its
+                confidence interval.
+
+        Each has the trailing axes of winning_model.
+
+    """
+    winning_model = np.asarray(winning_model)
+    test_correlation = np.asarray(test_correlation)
+    n_subjects, n_runs = winning_model.shape[:2]
+    trailing = winning_model.shape[2:]
+    models = winning_model.reshape(n_subjects, n_runs, -1)
+    correlations = test_correlation.reshape(n_subjects, n_runs, -1)
+
+    valid = np.all(np.isfinite(models), axis=(0, 1)) & \
+        np.all(np.isfinite(correlations), axis=(0, 1))
+    if not valid.all():
+        models = models[:, :, valid]
+        correlations = correlations[:, :, valid]
+    models = models.astype(np.intp)
+
+    if chunk_size is None:
+        # The weights of the rows, and the running counts, medians and means
+        # of every voxel, as bootstrap_replicates, up to 1000 replicates,
+        # whose weights stay in cache for the products with every value.
+        chunk_size = int(min(1000, max(1, BOOTSTRAP_MEMORY // (
+            8 * n_subjects * n_runs + 48 * models.shape[2]))))
+    chunks = [min(chunk_size, n_replicates - start)
+              for start in range(0, n_replicates, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    args = ((models, correlations, n_chunk, chunk_seed)
+            for n_chunk, chunk_seed in zip(chunks, seeds))
+    if pool is None:
+        replicates = [bootstrap_replicates(*arg) for arg in args]
+    else:
+        pool = as_pool(pool)
+        replicates = list(bounded_map(pool, bootstrap_replicates, args,
+                                      2 * pool.n_workers))
+    median_models, mean_correlations = (np.concatenate(replicate)
+                                        for replicate in zip(*replicates))
+
+    alpha = (1.0 - confidence) / 2
+    quantiles = [alpha, 1.0 - alpha]
+
+    def unmasked(values):
+        # Values of the valid elements, with NaN for the others, in the
+        # trailing axes of winning_model.
+        full = np.full(values.shape[:-1] + valid.shape, np.nan)
+        full[..., valid] = values
+        return full.reshape(values.shape[:-1] + trailing)
+
+    n_rows = n_subjects * n_runs
+    return {'median_winning_model':
+            unmasked(count_median(models.reshape(n_rows, -1), axis=0)),
+            'median_winning_model_ci':
+            unmasked(np.quantile(median_models, quantiles, axis=0)),
+            'mean_test_correlation':
+            unmasked(correlations.reshape(n_rows, -1).mean(axis=0)),
+            'mean_test_correlation_ci':
+            unmasked(np.quantile(mean_correlations, quantiles, axis=0))}
+
+
+def subject_table(results, key):
+    """Arrange a column of results by subject.
+
+    Arguments
+    ---------
+        results: Dictionary of results, as returned by
+            functional_dimensionality, with the same number of rows for
+            every subject.
+        key: Column of the results, such as 'winning_model'.
+
+    Returns
+    -------
+        n_subjects * n_rows Numpy array of the column, with the subjects in
+        sorted order of subject_ID, and the rows of each in their original
+        order.
+
+    """
+    subject_ID = np.asarray(results['subject_ID'])
+    order = np.argsort(subject_ID, kind='stable')
+    _, n_rows = np.unique(subject_ID, return_counts=True)
+    if np.any(n_rows != n_rows[0]):
+        raise ValueError('Every subject must have the same number of test '
+                         'runs.')
+
+    return np.asarray(results[key])[order].reshape(len(n_rows), n_rows[0])
+
+
+def bootstrap_dimensionality(results, n_replicates=10000, confidence=0.95,
+                             seed=None, chunk_size=None, pool=None):
+    """Bootstrap confidence intervals for the results of a group.
+
+    Arguments
+    ---------
+        results: Dictionary of results, as returned by
+            functional_dimensionality, with the same number of rows for
+            every subject.
+        n_replicates, confidence, seed, chunk_size, pool: As for bootstrap.
+
+    Returns
+    -------
+        Dictionary of the estimates and confidence intervals, as returned by
+        bootstrap.
+
+    """
+    return bootstrap(subject_table(results, 'winning_model'),
+                     subject_table(results, 'test_correlation'),
+                     n_replicates, confidence, seed, chunk_size, pool)
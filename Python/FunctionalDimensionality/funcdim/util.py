@@ -17,10 +17,17 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import collections
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from funcdim.profiling import profiled
+import glob
+import hashlib
 import nibabel as nib
 import numpy as np
 import os
 from scipy.io import loadmat
+import tempfile
 
 
 def load_spm(spm_path):  # pragma: no cover
@@ -40,61 +47,435 @@ def spm_beta_images(beta_files):  # pragma: no cover
         yield image
 
 
-def load_brain(spm_path):  # pragma: no cover
-    """Load brain."""
+def mask_bounds(mask):
+    """Slices of the bounding box of the voxels in a mask."""
+    bounds = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(i for i in range(mask.ndim) if i != axis)
+        inside = np.flatnonzero(mask.any(axis=other_axes))
+        if len(inside) == 0:
+            bounds.append(slice(0, 0))
+        else:
+            bounds.append(slice(inside[0], inside[-1] + 1))
+    return tuple(bounds)
+
+
+@profiled
+def load_volumes(images, mask=None, dtype=None, executor=None):
+    """Read the masked voxels of a sequence of images.
+
+    Only the bounding box of the mask is read from each image, through its
+    array proxy, so a small mask never loads the whole volume.
+
+    Arguments
+    ---------
+        images: Sequence of Nibabel images.
+        mask: Mask as an i * j * k Numpy array of booleans, of the shape of
+            the images; default: every voxel.
+        dtype: Data type of the returned array; default: that of the scaled
+            image data.
+        executor: concurrent.futures.Executor, such as a ThreadPoolExecutor,
+            to read and decompress the images concurrently; default: read
+            them one at a time.
+
+    Returns
+    -------
+        n_masked * n_images Numpy array of the values of the n_masked voxels
+        of the mask, in the order of np.flatnonzero(mask).
+
+    """
+    image_shape = images[0].shape[:3]
+    if mask is None:
+        mask = np.ones(image_shape, dtype=bool)
+    elif mask.shape != image_shape:
+        raise ValueError('The mask has shape ' + str(mask.shape) +
+                         ', but the images have shape ' +
+                         str(image_shape) + '.')
+
+    bounds = mask_bounds(mask)
+    box_mask = mask[bounds]
+    n_masked = int(np.count_nonzero(box_mask))
+
+    def read(image):
+        return np.asanyarray(image.dataobj[bounds])[box_mask]
+
+    if executor is None:
+        all_values = map(read, images)
+    else:
+        all_values = executor.map(read, images)
+
+    volumes = None
+    for i_image, values in enumerate(all_values):
+        if volumes is None:
+            volumes = np.empty((n_masked, len(images)),
+                               dtype=values.dtype if dtype is None else dtype)
+        volumes[:, i_image] = values
+    return volumes
+
+
+def load_betas(images, n_conditions, n_sessions, mask=None, dtype=None,
+               executor=None):
+    """Read the masked voxels of the beta images of one subject.
+
+    The betas are ordered as by SPM, and only those of the first
+    n_conditions of each session are read, as by load_volumes.
+
+    Arguments
+    ---------
+        images: Sequence of Nibabel images of the betas.
+        n_conditions: Number of conditions.
+        n_sessions: Number of sessions.
+        mask, dtype, executor: As for load_volumes.
+
+    Returns
+    -------
+        n_masked * n_conditions * n_sessions Numpy array of beta values, for
+        the n_masked voxels of the mask in the order of np.flatnonzero(mask).
+
+    """
+    # Betas are numbered as np.reshape(range(n_betas), (-1, n_sessions)),
+    # and only the first n_conditions rows are kept.
+    volumes = load_volumes(images[:n_conditions * n_sessions], mask, dtype,
+                           executor)
+    return volumes.reshape((len(volumes), n_conditions, n_sessions))
+
+
+@profiled
+def load_brain(spm_path, mask=None, dtype=None,
+               executor=None):  # pragma: no cover
+    """Load brain.
+
+    Arguments
+    ---------
+        spm_path: Directory of the SPM.mat file and beta images.
+        mask, dtype, executor: As for load_betas.
+
+    Returns
+    -------
+        n_masked * n_conditions * n_sessions Numpy array of beta values, as
+        returned by load_betas.
+
+    """
     spm = load_spm(spm_path)
 
     sess = spm['Sess'][0][0][0]
     n_sessions = len(sess)
     n_conditions = len(sess['U'][0][0][0])
 
-    beta_files = spm_beta_files(spm, spm_path)
-    n_betas = len(beta_files)
+    images = list(spm_beta_images(spm_beta_files(spm, spm_path)))
+    return load_betas(images, n_conditions, n_sessions, mask, dtype,
+                      executor)
+
+
+@profiled
+def load_residuals(spm_path, mask=None, dtype=None,
+                   executor=None):  # pragma: no cover
+    """Load the residual images written by SPM.
+
+    Arguments
+    ---------
+        spm_path: Directory of the SPM.mat file and residual images,
+            Res_0001.nii onwards, with the same number of scans in each
+            session.
+        mask, dtype, executor: As for load_volumes.
+
+    Returns
+    -------
+        n_masked * n_scans * n_sessions Numpy array of residuals, as for the
+        res argument of functional_dimensionality.
+
+    """
+    spm = load_spm(spm_path)
+
+    sess = spm['Sess'][0][0][0]
+    rows = [np.ravel(row) - 1 for row in sess['row']]
+
+    res_files = sorted(glob.glob(os.path.join(spm_path, 'Res_*.nii*')))
+    images = [nib.load(res_files[i]) for i in np.concatenate(rows)]
+    volumes = load_volumes(images, mask, dtype, executor)
+    return np.stack(np.split(volumes, len(rows), axis=1), axis=2)
+
+
+def spm_key(spm_path, mask=None, dtype=None, kind='load_brain'):
+    """Key identifying data loaded from an SPM directory.
+
+    The key changes whenever a file in the directory is replaced or
+    modified, or the mask, dtype or kind of data differ, so cached data is
+    never stale.
+
+    Arguments
+    ---------
+        spm_path: Directory of the SPM.mat file and images.
+        mask, dtype: As for load_volumes.
+        kind: Name of the data, such as that of the function loading it;
+            default: 'load_brain'.
+
+    """
+    entries = sorted(os.scandir(spm_path), key=lambda entry: entry.name)
+    stats = []
+    for entry in entries:
+        if entry.is_file():
+            stat = entry.stat()
+            stats.append((entry.name, stat.st_mtime_ns, stat.st_size))
+    digest = hashlib.sha1(repr((
+        os.path.abspath(spm_path), stats,
+        None if mask is None else array_key(mask),
+        None if dtype is None else np.dtype(dtype).str)).encode())
+    return '_'.join([kind, digest.hexdigest()])
+
+
+@profiled
+def load_cached(load, spm_path, cache, mask=None, dtype=None, executor=None):
+    """Load data from an SPM directory through a cache.
 
-    image = spm_beta_images(beta_files).__next__()
-    image_size = np.product(image.shape)
-    image_dtype = image.get_data_dtype()
-    brain_shape = image.shape[:] + (n_betas,)
-    new_shape = (image_size, n_betas // n_sessions, n_sessions)
+    Arguments
+    ---------
+        load: load_brain, load_residuals or another function with the same
+            arguments.
+        spm_path: Directory of the SPM.mat file and images.
+        cache: Mapping in which the data is stored under spm_key. Use an
+            NpyCache with mmap_mode='r' to keep masked brains on disk
+            between sessions, and memory-map them rather than reading the
+            images again.
+        mask, dtype, executor: As for load_volumes.
 
-    brain = np.zeros(brain_shape, dtype=image_dtype)
+    """
+    key = spm_key(spm_path, mask, dtype, load.__name__)
+    if key not in cache:
+        cache[key] = load(spm_path, mask, dtype, executor)
+    return cache[key]
 
-    for beta, image in enumerate(spm_beta_images(beta_files)):
-        brain[:, :, :, beta] = image.get_data()
-    return np.reshape(brain, new_shape)[:, 0:n_conditions, :]
 
+def prefetch(fn, items, n_ahead=2):
+    """Map a function over items in a background thread, ahead of use.
 
-def brains_from_spm(subject_path):  # pragma: no cover
-    """Brains from SPM."""
+    The results are yielded in order, while the next n_ahead of them are
+    computed in the background, so that no more than n_ahead + 1 are held
+    at once. Stopping the iteration cancels those that have not started.
+
+    Arguments
+    ---------
+        fn: Function of each item.
+        items: Iterable of the items.
+        n_ahead: Number of results to compute ahead of the one yielded;
+            default: 2.
+
+    Yields
+    ------
+        fn(item) for each item.
+
+    """
+    pending = collections.deque()
+    executor = ThreadPoolExecutor(max(1, n_ahead))
+    try:
+        for item in items:
+            if len(pending) > n_ahead:
+                yield pending.popleft().result()
+            pending.append(executor.submit(fn, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def brains_from_spm(subject_path, mask=None, dtype=None, n_threads=None,
+                    n_prefetch=2, cache=None,
+                    load=load_brain):  # pragma: no cover
+    """Brains from SPM.
+
+    Each subject's brain is loaded by load_brain, with the given mask and
+    dtype, by a pool of n_threads threads that read the beta images
+    concurrently. The next n_prefetch subjects are loaded while the current
+    one is in use, as by prefetch, so the brains can be passed straight to
+    functional_dimensionality without loading every subject at once.
+
+    Arguments
+    ---------
+        subject_path: Directory of a directory for each subject, holding its
+            SPM.mat file and beta images.
+        mask, dtype: As for load_betas.
+        n_threads: Number of threads reading beta images; default: as for
+            concurrent.futures.ThreadPoolExecutor.
+        n_prefetch: Number of subjects to load ahead; default: 2.
+        cache: Mapping, such as an NpyCache, in which to cache each
+            subject's data, as by load_cached; default: None.
+        load: load_brain, or load_residuals to load the residuals instead;
+            default: load_brain.
+
+    Returns
+    -------
+        n_subjects: Number of subjects.
+        brains: Iterator over the brain of each subject, as returned by
+            load_brain.
+
+    """
     subject_dirs = sorted(os.listdir(subject_path))
     subject_spmpaths = ['/'.join([subject_path, d]) for d in subject_dirs]
 
     n_subjects = len(subject_dirs)
 
-    return n_subjects, map(load_brain, subject_spmpaths)
+    def load_subject(spm_path, executor):
+        if cache is None:
+            return load(spm_path, mask, dtype, executor)
+        return load_cached(load, spm_path, cache, mask, dtype, executor)
+
+    def brains():
+        with ThreadPoolExecutor(n_threads) as executor:
+            yield from prefetch(
+                lambda spm_path: load_subject(spm_path, executor),
+                subject_spmpaths, n_prefetch)
+
+    return n_subjects, brains()
 
 
 def load_mask(mask_file):  # pragma: no cover
     """Load mask."""
-    return nib.load(mask_file).get_data() > 0
+    return np.asanyarray(nib.load(mask_file).dataobj) > 0
 
 
-def demo_data(functional_dims=4, nvoxels=64, nconditions=20, nruns=6,
-              nsubs=20):
-    """Generate demo data with a set dimensionality for tests and demo."""
+def array_key(array):
+    """Key identifying the contents, shape and type of a Numpy array."""
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1(array.view(np.uint8)).hexdigest()
+    shape = 'x'.join(str(n) for n in array.shape)
+    return '_'.join([digest, shape, array.dtype.str.lstrip('<>|=')])
+
+
+class NpyCache(MutableMapping):
+    """Dictionary-like store of Numpy arrays as .npy files in a directory.
+
+    Arrays are written to a temporary file that is then renamed, so the same
+    directory can be shared by worker processes, and between sessions.
+
+    Arguments
+    ---------
+        path: Directory for the files, created if it does not exist.
+        mmap_mode: Passed to np.load, so that arrays can be memory-mapped
+            rather than read; default: None.
+
+    """
+
+    def __init__(self, path, mmap_mode=None):  # noqa:D107
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.mmap_mode = mmap_mode
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def __getitem__(self, key):  # noqa:D105
+        try:
+            return np.load(self._file(key), mmap_mode=self.mmap_mode)
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):  # noqa:D105
+        handle, temp_file = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.save(f, value)
+            os.replace(temp_file, self._file(key))
+        except BaseException:
+            os.remove(temp_file)
+            raise
+
+    def __contains__(self, key):  # noqa:D105
+        return os.path.exists(self._file(key))
+
+    def __delitem__(self, key):  # noqa:D105
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def __iter__(self):  # noqa:D105
+        for file_name in sorted(os.listdir(self.path)):
+            if file_name.endswith('.npy'):
+                yield file_name[:-len('.npy')]
+
+    def __len__(self):  # noqa:D105
+        return sum(1 for key in self)
+
+
+def simulate_subjects(functional_dims=4, nvoxels=64, nconditions=20,
+                      nruns=6, nsubs=20, run_noise=0.0, subject_noise=0.0,
+                      rng=None, dtype=np.float64):
+    """Generate demo data with a set dimensionality, one subject at a time.
+
+    Each voxel's pattern over the first functional_dims conditions is drawn
+    from a standard normal distribution and shared by every subject, and
+    its other conditions are zero, so that the patterns have exactly
+    functional_dims dimensions. Only one subject is held in memory at once.
+
+    Arguments
+    ---------
+        functional_dims: True dimensionality, or a sequence of that of each
+            subject; default: 4.
+        nvoxels: Number of voxels, which must be a cube; default: 64.
+        nconditions: Number of conditions; default: 20.
+        nruns: Number of runs; default: 6.
+        nsubs: Number of subjects; default: 20.
+        run_noise: Standard deviation of the noise added to every beta of
+            each run; default: 0.
+        subject_noise: Standard deviation of the noise added to each
+            subject's pattern over its functional dimensions, which is
+            shared by its runs; default: 0.
+        rng: numpy.random.Generator, or a seed for one; default: a
+            Generator seeded from numpy.random's global state, so that
+            numpy.random.seed makes the data reproducible.
+        dtype: Floating-point type of the data; default: np.float64.
+
+    Yields
+    ------
+        nvoxels * nconditions * nruns Numpy array of each subject's betas.
+        Without run_noise, the runs are identical, and this is a read-only
+        view that repeats the subject's pattern without copying it.
+
+    """
     # Check nvoxels is a cube:
     cube_check = int(np.round(nvoxels**(1 / 3)))
     if cube_check**3 != nvoxels:
         raise ValueError('"nvoxels" must a cube: ' + str(nvoxels) +
                          ' is not a cube')
+    dims = np.broadcast_to(functional_dims, (nsubs,))
+    if np.any(dims > nconditions):
+        raise ValueError('"functional_dims" must be at most "nconditions".')
+
+    if rng is None:
+        rng = np.random.randint(2**31)
+    rng = np.random.default_rng(rng)
+    shared = rng.standard_normal((nvoxels, int(dims.max())), dtype=dtype)
+    for n_dims in dims:
+        pattern = np.zeros((nvoxels, nconditions), dtype=dtype)
+        pattern[:, :n_dims] = shared[:, :n_dims]
+        if subject_noise:
+            pattern[:, :n_dims] += subject_noise * \
+                rng.standard_normal((nvoxels, n_dims), dtype=dtype)
+
+        if run_noise:
+            subject = rng.standard_normal((nvoxels, nconditions, nruns),
+                                          dtype=dtype)
+            subject *= run_noise
+            subject += pattern[:, :, np.newaxis]
+            yield subject
+        else:
+            yield np.broadcast_to(pattern[:, :, np.newaxis],
+                                  (nvoxels, nconditions, nruns))
+
+
+def demo_data(functional_dims=4, nvoxels=64, nconditions=20, nruns=6,
+              nsubs=20, run_noise=0.0, subject_noise=0.0, rng=None,
+              dtype=np.float64):
+    """Generate demo data with a set dimensionality for tests and demo.
 
+    The data are those of simulate_subjects, stacked into one
+    nvoxels * nconditions * nruns * nsubs Numpy array. For many subjects,
+    iterate over simulate_subjects instead.
+    """
     # "data" has the shape (nvoxels, nconditions, nruns, nsubs), containing
     # "beta" values for nvoxels
-    data = np.random.multivariate_normal(
-        np.zeros((nconditions,)), np.eye(nconditions), size=(nvoxels))
-    data[:, functional_dims:] = np.zeros((data[:, functional_dims:].shape))
-    data = data.reshape((nvoxels, nconditions, 1))
-    data = np.tile(data, (nruns))
-    data = data.reshape((nvoxels, nconditions, nruns, 1))
-    data = np.tile(data, (nsubs))
-    return data
+    return np.stack(list(simulate_subjects(
+        functional_dims, nvoxels, nconditions, nruns, nsubs, run_noise,
+        subject_noise, rng, dtype)), axis=-1)
@@ -17,7 +17,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='FuncionalDimensionality',
@@ -28,5 +28,14 @@ setup(
     'Giles Greenway, & Olivia Guest',
     author_email='b.love@ucl.ac.uk',
     packages=['funcdim'],
-    install_requires=['nibabel', 'numpy', 'scipy', 'hdf5storage', 'six']
+    python_requires='>=3.9',
+    install_requires=['nibabel>=2.3.0', 'numpy>=1.20', 'scipy>=1.8',
+                      'hdf5storage', 'six'],
+    extras_require={
+        # Limits the BLAS threads of each worker process.
+        'threads': ['threadpoolctl>=2.0'],
+        # Result sinks for HDF5 and Parquet files.
+        'hdf5': ['h5py>=2.10'],
+        'parquet': ['pyarrow>=1.0'],
+    }
 )
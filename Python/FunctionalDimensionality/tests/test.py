@@ -1,16 +1,67 @@
 """Testing."""
 
+from benchmarks.benchmark import run_benchmarks
+from concurrent.futures import ThreadPoolExecutor
+from funcdim import profiling
+from funcdim.crossval import crossval_correlations
+from funcdim.crossval import gram_crossval_correlations
 from funcdim.crossval import make_components
 from funcdim.crossval import reconstruct
+from funcdim.crossval import reconstruct_all
+from funcdim.crossval import session_grams
 from funcdim.funcdim import covdiag
 from funcdim.funcdim import functional_dimensionality
+from funcdim.funcdim import inv_sqrtm
+from funcdim.funcdim import iter_functional_dimensionality
+from funcdim.funcdim import multi_roi_dimensionality
 from funcdim.funcdim import pre_proc
 from funcdim.funcdim import roi_estimator
 from funcdim.funcdim import svd_nested_crossval
+from funcdim.group import hierarchical_bayes
+from funcdim.group import log_density
+from funcdim.group import model_data
+from funcdim.parallel import bounded_map
+from funcdim.parallel import EstimatorPool
+from funcdim.parallel import plan_parallelism
+from funcdim.parallel import threadpool_limits
+from funcdim.results import ArraySink
+from funcdim.results import h5py
+from funcdim.results import Hdf5Sink
+from funcdim.results import load_npz
+from funcdim.results import NpzSink
+from funcdim.results import ParquetSink
+from funcdim.results import pyarrow
+from funcdim.results import ResultSink
+from funcdim.searchlight import searchlight_estimate_dim
+from funcdim.searchlight import sphere_neighbourhoods
+from funcdim.stats import bootstrap
+from funcdim.stats import bootstrap_dimensionality
+from funcdim.stats import count_median
+from funcdim.stats import permutation_batch_size
+from funcdim.stats import permutation_dimensionality
+from funcdim.stats import permutation_test
+from funcdim.stats import permute_grams
+from funcdim.stats import random_permutations
+from funcdim.util import array_key
 from funcdim.util import demo_data
+from funcdim.util import load_betas
+from funcdim.util import load_cached
+from funcdim.util import NpyCache
+from funcdim.util import prefetch
+from funcdim.util import simulate_subjects
+from funcdim.util import spm_key
+import nibabel as nib
 import numpy as np
+import json
+import os
 import output
+from scipy.linalg import fractional_matrix_power
 from scipy.stats import pearsonr
+from scipy.stats import t as student_t
+from scipy.stats import truncnorm
+import subprocess
+import sys
+import tempfile
 import unittest
 
 
@@ -31,17 +82,60 @@ class TestRealData(unittest.TestCase):  # noqa:D101
         data = self.data[0][0]
         self.assertEqual(covdiag(data).shape, (self.nsubs, self.nsubs))
 
+    def test_covdiag_batch(self):  # noqa:D102
+        data = np.transpose(self.data[:, :, :, 0], (2, 1, 0))
+        batch_cov = covdiag(data)
+        self.assertEqual(batch_cov.shape, (6, 64, 64))
+        for i_session in range(6):
+            self.assertTrue(np.allclose(batch_cov[i_session],
+                                        covdiag(data[i_session])))
+        # Constant observations have no covariance to shrink.
+        self.assertTrue(np.array_equal(covdiag(np.ones((2, 4, 3))),
+                                       np.zeros((2, 3, 3))))
+
     def test_pre_proc(self):  # noqa:D102
         data = self.data[0]
         res = np.random.random(data.shape)
         self.assertEqual(pre_proc(data, res).shape, data.shape)
 
+    def test_inv_sqrtm(self):  # noqa:D102
+        data = self.data[:, :, :, 0]
+        cov = covdiag(np.transpose(data, (2, 1, 0)))
+        inv_root = inv_sqrtm(cov)
+        self.assertTrue(np.isrealobj(inv_root))
+        for i_session in range(6):
+            self.assertTrue(np.allclose(
+                inv_root[i_session],
+                fractional_matrix_power(cov[i_session], -0.5)))
+
+        # A voxel with constant residuals has no variance to whiten.
+        singular = np.copy(cov[0])
+        singular[0, :] = singular[:, 0] = 0.0
+        self.assertRaises(ValueError, inv_sqrtm, singular)
+        self.assertRaises(ValueError, inv_sqrtm, np.full((3, 3), np.nan))
+
+    def test_pre_proc_cache(self):  # noqa:D102
+        data = self.data[:, :, :, 0]
+        res = np.random.random(data.shape)
+        cache = {}
+        beta_norm = pre_proc(data, res, cache)
+        self.assertEqual(list(cache.keys()), [array_key(res)])
+        # A second call must use the cached whitening matrices.
+        cache[array_key(res)] = np.tile(np.eye(64), (6, 1, 1))
+        self.assertTrue(np.allclose(
+            pre_proc(data, res, cache),
+            data - data.mean(axis=1, keepdims=True)))
+        self.assertTrue(np.allclose(beta_norm, pre_proc(data, res)))
+
     def test_svd_nested_crossval_error(self):  # noqa:D102
         data = self.data[0]
         # Check the keys are identical.
         self.assertRaises(ValueError,
                           svd_nested_crossval, data, self.subject_IDs,
                           option='oops')
+        self.assertRaises(ValueError,
+                          svd_nested_crossval, data, self.subject_IDs,
+                          method='oops')
 
     def test_roi_estimator_res(self):  # noqa:D102
         data = self.data[0]
@@ -112,6 +206,72 @@ class TestRealData(unittest.TestCase):  # noqa:D101
             all_subjects, 20, self.mask, res=res, option=option).keys()),
             sorted(output.dictionary_full.keys()))
 
+    def test_functional_dimensionality_masked(self):  # noqa:D102
+        mask = np.zeros((4, 4, 4), dtype=bool)
+        mask[1:3, :, 2:] = True
+        brains = self.data[:, :, :, :4]
+        masked_brains = brains[mask.ravel()]
+        expected = functional_dimensionality(
+            (brains[:, :, :, i] for i in range(4)), 4, mask, option='mean')
+        results = functional_dimensionality(
+            (masked_brains[:, :, :, i] for i in range(4)), 4, mask,
+            option='mean')
+        for key in expected:
+            self.assertTrue(np.array_equal(results[key], expected[key]))
+
+    def test_float32(self):  # noqa:D102
+        # Single precision picks the same winning models as double precision
+        # on the sample data, with or without pre-whitening.
+        brains = np.moveaxis(self.data[:, :, :, :5], 3, 0)
+        res = np.random.standard_normal((5, 64, 30, 6))
+        for option, method, batched, residuals in [
+                ('full', 'svd', False, None), ('mean', 'gram', False, res),
+                ('full', 'gram', True, res)]:
+            expected = functional_dimensionality(
+                brains, 5, self.mask, res=residuals, option=option,
+                method=method, batched=batched)
+            results = functional_dimensionality(
+                brains, 5, self.mask, res=residuals, option=option,
+                method=method, batched=batched, dtype=np.float32)
+            self.assertEqual(results['test_correlation'].dtype, np.float32)
+            self.assertTrue(np.array_equal(results['winning_model'],
+                                           expected['winning_model']))
+            self.assertTrue(np.allclose(results['test_correlation'],
+                                        expected['test_correlation'],
+                                        atol=1e-5))
+
+    def test_multi_roi_dimensionality(self):  # noqa:D102
+        atlas = np.zeros((4, 4, 4), dtype=int)
+        atlas[:2] = 3
+        atlas[2:, :, 1:] = 7
+        brains = np.moveaxis(self.data[:, :, :, :3], 3, 0)
+        res = np.random.standard_normal((3, 64, 30, 6))
+        results = multi_roi_dimensionality(brains, 3, atlas, res=res,
+                                           option='mean')
+        self.assertEqual(sorted(results),
+                         sorted(list(output.dictionary_full) + ['roi']))
+        self.assertTrue(np.array_equal(results['roi'],
+                                       np.repeat([3, 7, 3, 7, 3, 7], 6)))
+        for label in [3, 7]:
+            flat_mask = (atlas == label).ravel()
+            expected = functional_dimensionality(
+                brains, 3, atlas == label, res=res[:, flat_mask],
+                option='mean')
+            for key in expected:
+                self.assertTrue(np.array_equal(
+                    results[key][results['roi'] == label], expected[key]))
+
+        # Masks, brains masked by their union, and shared memory.
+        masks = [atlas == 3, atlas == 7]
+        union = atlas.ravel() > 0
+        masked = multi_roi_dimensionality(
+            brains[:, union], 3, masks, res=res[:, union], option='mean',
+            roi_names=['a', 'b'], shared_memory=True)
+        self.assertTrue(np.array_equal(
+            masked['roi'], np.where(results['roi'] == 3, 'a', 'b')))
+        for key in expected:
+            self.assertTrue(np.array_equal(masked[key], results[key]))
+
     def test_full_values(self):  # noqa:D102
         # Create an iterator over the 20 subjects.
         all_subjects = (self.data[:, :, :, i] for i in range(20))
@@ -126,6 +286,86 @@ class TestRealData(unittest.TestCase):  # noqa:D101
                 self.assertTrue(np.allclose(value,
                                             output.dictionary_full[key]))
 
+    def test_iter_functional_dimensionality(self):  # noqa:D102
+        n_read = []
+
+        def all_subjects():
+            for i in range(self.nsubs):
+                n_read.append(i)
+                yield self.data[:, :, :, i]
+
+        # No more than max_in_flight subjects, and the one waiting to be
+        # submitted, may have been read before each estimate is yielded.
+        n_yielded = 0
+        for estimate in iter_functional_dimensionality(
+                all_subjects(), self.nsubs, self.mask, option='mean',
+                max_in_flight=2):
+            self.assertLessEqual(len(n_read), n_yielded + 3)
+            self.assertEqual(estimate['subject_ID'][0],
+                             self.subject_IDs[n_yielded])
+            n_yielded += 1
+        self.assertEqual(n_yielded, self.nsubs)
+
+        unordered = iter_functional_dimensionality(
+            all_subjects(), self.nsubs, self.mask, option='mean',
+            max_in_flight=2, ordered=False)
+        self.assertEqual(
+            sorted(estimate['subject_ID'][0] for estimate in unordered),
+            sorted(self.subject_IDs))
+
+    def test_estimator_pool(self):  # noqa:D102
+        data = self.data[:, :, :, 0]
+        with EstimatorPool(n_workers=2) as pool:
+            self.assertEqual(pool.n_workers, 2)
+            for option in ['full', 'mean']:
+                all_subjects = (self.data[:, :, :, i] for i in range(20))
+                results = functional_dimensionality(
+                    all_subjects, self.nsubs, self.mask, option=option,
+                    pool=pool)
+                self.assertTrue(np.allclose(
+                    results['test_correlation'],
+                    getattr(output, 'dictionary_' + option)
+                    ['test_correlation']))
+            estimate = pool.submit(roi_estimator, data, None, '1',
+                                   option='mean')
+            self.assertEqual(estimate.result()['test_run'],
+                             list(range(1, 7)))
+
+    def test_estimator_pool_executor(self):  # noqa:D102
+        all_subjects = (self.data[:, :, :, i] for i in range(20))
+        with ThreadPoolExecutor(2) as executor:
+            results = functional_dimensionality(
+                all_subjects, self.nsubs, self.mask, option='mean',
+                pool=executor)
+            # The executor belongs to the caller, so is still usable.
+            self.assertEqual(executor.submit(sum, [1, 2]).result(), 3)
+            pool = EstimatorPool(n_workers=2, executor=executor)
+            self.assertEqual(pool.n_workers, 2)
+            squares = bounded_map(pool, pow, zip(range(5), [2] * 5),
+                                  max_in_flight=1)
+            self.assertEqual(list(squares), [0, 1, 4, 9, 16])
+            self.assertRaises(ValueError, bounded_map, pool, pow, [],
+                              max_in_flight=0)
+        self.assertTrue(np.array_equal(
+            results['winning_model'], output.dictionary_mean['winning_model']))
+        self.assertRaises(TypeError, functional_dimensionality,
+                          all_subjects, self.nsubs, self.mask, pool=2)
+
+    def test_shared_memory(self):  # noqa:D102
+        all_subjects = np.moveaxis(self.data, 3, 0)
+        res = np.random.random(all_subjects.shape)
+        with EstimatorPool(n_workers=2) as pool:
+            for res_i in [None, res]:
+                results = functional_dimensionality(
+                    all_subjects, self.nsubs, self.mask, res=res_i,
+                    option='mean', pool=pool)
+                shared_results = functional_dimensionality(
+                    all_subjects, self.nsubs, self.mask, res=res_i,
+                    option='mean', pool=pool, shared_memory=True)
+                for key, value in results.items():
+                    self.assertTrue(np.array_equal(value,
+                                                   shared_results[key]))
+
     def test_mean_keys(self):  # noqa:D102
         # Create an iterator over the 20 subjects.
         all_subjects = (self.data[:, :, :, i] for i in range(20))
@@ -210,6 +450,73 @@ class TestCrossVal(unittest.TestCase):  # noqa:D101
         self.assertTrue(np.array_equal(mc_diag, np.diag(diag)))
         self.assertTrue(np.array_equal(mc_v.T, v))
 
+    def test_make_components_gram(self):  # noqa:D102
+        data = self.data[:, :, :, 0]
+        u, diag, v = make_components(data)
+        gram_u, gram_diag, gram_v = make_components(data, method='gram')
+
+        self.assertTrue(np.allclose(gram_diag, diag))
+        self.assertTrue(np.allclose(np.matmul(np.matmul(gram_u, gram_diag),
+                                              gram_v.T),
+                                    np.matmul(np.matmul(u, diag), v.T)))
+        self.assertRaises(ValueError, make_components, data, method='oops')
+
+    def test_svd_nested_crossval_gram(self):  # noqa:D102
+        data = self.data[:, :, :, 0]
+        _, _, winning_model, test_correlation = \
+            svd_nested_crossval(data, '1', option='full')
+        _, _, gram_winning_model, gram_test_correlation = \
+            svd_nested_crossval(data, '1', option='full', method='gram')
+
+        self.assertTrue(np.array_equal(gram_winning_model, winning_model))
+        self.assertTrue(np.allclose(gram_test_correlation, test_correlation))
+
+        # With fewer voxels than conditions, every dimensionality above the
+        # rank of the data ties, and both methods pick the lowest of them.
+        rng = np.random.default_rng(0)
+        for _ in range(20):
+            few = (rng.standard_normal((5, 12, 1)) +
+                   0.01 * rng.standard_normal((5, 12, 6)))
+            for batched in [False, True]:
+                self.assertTrue(np.array_equal(
+                    svd_nested_crossval(few, '1', 'mean', 'gram', batched)[2],
+                    svd_nested_crossval(few, '1', 'mean', 'svd', batched)[2]))
+
+    def test_svd_nested_crossval_batched(self):  # noqa:D102
+        data = self.data[:, :, :, 0]
+        for option in ['full', 'mean']:
+            for method in ['svd', 'gram']:
+                looped = svd_nested_crossval(data, '1', option=option,
+                                             method=method)
+                batched_output = svd_nested_crossval(data, '1', option=option,
+                                                     method=method,
+                                                     batched=True)
+
+                self.assertEqual(batched_output[1], looped[1])
+                self.assertTrue(np.array_equal(batched_output[2], looped[2]))
+                self.assertTrue(np.allclose(batched_output[3], looped[3]))
+
+    def test_gram_crossval_correlations(self):  # noqa:D102
+        data = self.data[:, :, :, 0]
+        gram, col_sum = session_grams(data)
+        self.assertEqual(gram.shape, (6, 16, 6, 16))
+        self.assertTrue(np.allclose(gram[1, :, 4, :],
+                                    np.matmul(data[:, :, 1].T, data[:, :, 4])))
+
+        rmat, test_rmat = gram_crossval_correlations(gram, col_sum, 64)
+        gram_rmat, gram_test_rmat = crossval_correlations(data, 'gram')
+        self.assertTrue(np.allclose(rmat, gram_rmat))
+        self.assertTrue(np.allclose(test_rmat, gram_test_rmat))
+
+        # Leading axes are computed together.
+        grams = np.stack([gram, session_grams(self.data[:, :, :, 1])[0]])
+        col_sums = np.stack([col_sum, session_grams(self.data[:, :, :, 1])[1]])
+        batch_rmat, batch_test_rmat = gram_crossval_correlations(grams,
+                                                                 col_sums, 64)
+        self.assertTrue(np.allclose(batch_rmat[0], rmat))
+        self.assertTrue(np.allclose(batch_test_rmat[1], crossval_correlations(
+            self.data[:, :, :, 1], 'gram')[1]))
+
     def test_reconstruct(self):  # noqa:D102
         data = self.data[0]
         n_beta, n_session = data.shape[1:]
@@ -245,10 +552,694 @@ class TestCrossVal(unittest.TestCase):  # noqa:D101
                         reconstruction.ravel(), data_val[:, :, j_val].ravel())
                     self.assertEqual(cor, correlation)
 
+    def test_reconstruct_all(self):  # noqa:D102
+        data = self.data[0]
+        n_beta = data.shape[1]
+        U, S, V = make_components(data[:, :, 1:])
+
+        correlations = reconstruct_all(U, S, V, data[:, :, 0])
+        self.assertEqual(correlations.shape, (n_beta,))
+        for comp in range(n_beta - 1):
+            self.assertTrue(np.isclose(
+                correlations[comp], reconstruct(U, S, V, comp, data[:, :, 0])))
+
+        # With fewer voxels than conditions, every higher dimensionality
+        # reconstructs the data exactly.
+        few = self.data[:5, :, :, 0]
+        U, S, V = make_components(few[:, :, 1:])
+        correlations = reconstruct_all(U, S, V, few[:, :, 0])
+        self.assertEqual(correlations.shape, (16,))
+        for comp in range(16):
+            self.assertTrue(np.isclose(
+                correlations[comp], reconstruct(U, S, V, comp, few[:, :, 0])))
+        self.assertEqual(len(svd_nested_crossval(few, '1')[1]), 30)
+
+
+class TestParallel(unittest.TestCase):  # noqa:D101
+    def test_plan_parallelism(self):  # noqa:D102
+        # Many small subjects: one single-threaded process per CPU.
+        self.assertEqual(plan_parallelism(300, 64, n_cpus=64), (64, 1))
+        # Few large subjects: the CPUs are shared out as BLAS threads.
+        self.assertEqual(plan_parallelism(4, 100000, n_cpus=64), (4, 16))
+        self.assertEqual(plan_parallelism(300, 100000, n_cpus=64), (6, 10))
+        self.assertEqual(plan_parallelism(300, 40000, n_cpus=64), (16, 4))
+        for n_subjects in [1, 7, 20, 300]:
+            for n_voxels in [1, 64, 5000, 100000]:
+                n_workers, blas_threads = plan_parallelism(
+                    n_subjects, n_voxels, n_cpus=12)
+                self.assertLessEqual(n_workers * blas_threads, 12)
+
+    def test_no_threadpoolctl_warning(self):  # noqa:D102
+        # Without threadpoolctl, the BLAS threads planned for a default pool
+        # are silently not limited, and only those asked for are warned of.
+        script = (
+            "import sys\n"
+            "sys.modules['threadpoolctl'] = None\n"
+            "import numpy as np\n"
+            "from funcdim.funcdim import functional_dimensionality\n"
+            "from funcdim.parallel import EstimatorPool\n"
+            "data = np.load('./demos/demo_data/sample_data.npy')\n"
+            "functional_dimensionality(np.moveaxis(data[..., :2], 3, 0), 2,"
+            " np.ones((4, 4, 4), dtype=bool))\n"
+            "print('asked for threads', file=sys.stderr, flush=True)\n"
+            "with EstimatorPool(n_workers=1, blas_threads=1) as pool:\n"
+            "    pool.submit(sum, [1]).result()\n")
+        process = subprocess.run([sys.executable, '-c', script],
+                                 capture_output=True, text=True,
+                                 env=dict(os.environ, PYTHONPATH='.'))
+        self.assertEqual(process.returncode, 0, process.stderr)
+        default, asked = process.stderr.split('asked for threads')
+        self.assertNotIn('threadpoolctl', default)
+        self.assertIn('threadpoolctl is not installed', asked)
+
+    @unittest.skipIf(threadpool_limits is None, 'needs threadpoolctl')
+    def test_blas_threads(self):  # noqa:D102
+        from threadpoolctl import threadpool_info
+        with EstimatorPool(n_workers=1, blas_threads=1) as pool:
+            self.assertEqual(pool.blas_threads, 1)
+            for library in pool.submit(threadpool_info).result():
+                if library['user_api'] == 'blas':
+                    self.assertEqual(library['num_threads'], 1)
+
+
+class TestSearchlight(unittest.TestCase):  # noqa:D101
+    def setUp(self):  # noqa:D102
+        # A 4*4*4 mask with a hole in it for the 64 voxels of the sample data.
+        self.data = np.load('./demos/demo_data/sample_data.npy')[:, :, :, 0]
+        self.mask = np.ones((4, 4, 4), dtype='bool')
+        self.mask[1, 2, 1] = False
+        self.coords = np.argwhere(self.mask)
+
+    def test_sphere_neighbourhoods(self):  # noqa:D102
+        indptr, indices = sphere_neighbourhoods(self.mask, 1.5)
+        self.assertEqual(len(indptr), len(self.coords) + 1)
+        for centre, coord in enumerate(self.coords):
+            distance = np.sqrt(np.square(self.coords - coord).sum(axis=1))
+            self.assertTrue(np.array_equal(
+                indices[indptr[centre]:indptr[centre + 1]],
+                np.flatnonzero(distance <= 1.5)))
+
+    def test_searchlight_estimate_dim(self):  # noqa:D102
+        indptr, indices = sphere_neighbourhoods(self.mask, 2)
+        masked_data = self.data[self.mask.ravel()]
+        with EstimatorPool(n_workers=2) as pool:
+            for option in ['full', 'mean']:
+                bestn, r_outer, r_alter = searchlight_estimate_dim(
+                    self.data, self.mask, radius=2, option=option, pool=pool,
+                    chunk_size=10)
+                self.assertTrue(np.isnan(bestn[1, 2, 1]).all())
+                for centre in [0, 17, 62]:
+                    sphere = masked_data[
+                        indices[indptr[centre]:indptr[centre + 1]]]
+                    _, _, winning_model, test_correlation = \
+                        svd_nested_crossval(sphere, '1', option=option)
+                    coord = tuple(self.coords[centre])
+                    self.assertTrue(np.array_equal(bestn[coord],
+                                                   winning_model))
+                    self.assertTrue(np.allclose(r_outer[coord],
+                                                test_correlation))
+                    # The full-dimensional reconstruction is the mean of the
+                    # training and validation sessions.
+                    test_run = 2
+                    data_val = np.delete(sphere, test_run, axis=2)
+                    correlation, _ = pearsonr(
+                        data_val.mean(axis=2).ravel(),
+                        sphere[:, :, test_run].ravel())
+                    self.assertTrue(np.allclose(
+                        r_alter[coord][..., test_run], correlation))
+
+    def test_searchlight_bootstrap(self):  # noqa:D102
+        subjects = np.load('./demos/demo_data/sample_data.npy')[..., :3]
+        with ThreadPoolExecutor(2) as executor:
+            volumes = [searchlight_estimate_dim(
+                subjects[..., i], self.mask, radius=1.5, option='full',
+                pool=executor) for i in range(3)]
+        # Subjects, then the (r - 1) * r runs of option 'full', then voxels.
+        bestn = np.stack([volume[0] for volume in volumes])
+        r_outer = np.stack([volume[1] for volume in volumes])
+        bestn, r_outer = (np.moveaxis(array, (4, 5), (1, 2)).reshape(
+            (3, 30, 4, 4, 4)) for array in (bestn, r_outer))
+        self.assertEqual(bestn.dtype, np.float64)
+
+        estimates = bootstrap(bestn, r_outer, n_replicates=500, seed=0,
+                              chunk_size=100)
+        self.assertEqual(estimates['median_winning_model_ci'].shape,
+                         (2, 4, 4, 4))
+        for value in estimates.values():
+            self.assertTrue(np.isnan(value[..., 1, 2, 1]).all())
+            self.assertFalse(np.isnan(value[..., self.mask]).any())
+        # Each voxel is bootstrapped as its integer winning models would be.
+        voxel = bootstrap(bestn[..., 0, 0, 0].astype(int),
+                          r_outer[..., 0, 0, 0], n_replicates=500, seed=0,
+                          chunk_size=100)
+        for key in voxel:
+            self.assertTrue(np.allclose(estimates[key][..., 0, 0, 0],
+                                        voxel[key]))
+
+    def test_searchlight_incremental(self):  # noqa:D102
+        with EstimatorPool(n_workers=2) as pool:
+            gram_volumes = searchlight_estimate_dim(
+                self.data, self.mask, radius=2, method='gram', pool=pool)
+            incremental_volumes = searchlight_estimate_dim(
+                self.data, self.mask, radius=2, pool=pool, chunk_size=40,
+                incremental=True)
+        # Rounding can break near-ties between dimensionalities differently,
+        # but not change the correlations of the winning models.
+        gram_bestn, incremental_bestn = gram_volumes[0], incremental_volumes[0]
+        self.assertGreater(np.mean(gram_bestn[self.mask] ==
+                                   incremental_bestn[self.mask]), 0.95)
+        for gram_volume, incremental_volume in zip(gram_volumes[1:],
+                                                   incremental_volumes[1:]):
+            self.assertTrue(np.allclose(gram_volume, incremental_volume,
+                                        equal_nan=True))
+        self.assertRaises(ValueError, searchlight_estimate_dim, self.data,
+                          self.mask, res=self.data, incremental=True)
+
+
+class TestStats(unittest.TestCase):  # noqa:D101
+    def setUp(self):  # noqa:D102
+        self.data = np.load('./demos/demo_data/sample_data.npy')
+        self.mask = np.ones((4, 4, 4), dtype='bool')
+
+    def test_permute_grams(self):  # noqa:D102
+        data = self.data[:, :, :, 0]
+        permutations = random_permutations(np.random.default_rng(0), 3, 6, 16)
+        gram, col_sum = permute_grams(*session_grams(data), permutations)
+        self.assertEqual(gram.shape, (3, 6, 16, 6, 16))
+        permuted = np.stack([data[:, permutations[2, i_session], i_session]
+                             for i_session in range(6)], axis=2)
+        expected_gram, expected_col_sum = session_grams(permuted)
+        self.assertTrue(np.allclose(gram[2], expected_gram))
+        self.assertTrue(np.allclose(col_sum[2], expected_col_sum))
+
+    def test_permutation_test(self):  # noqa:D102
+        data = self.data[:, :, :, 0]
+        test_run, winning_model, test_correlation, p_value, n_drawn = \
+            permutation_test(data, option='mean', n_permutations=200, seed=0)
+        _, expected_model, expected_correlation = svd_nested_crossval(
+            data, '1', 'mean', 'gram')[1:]
+        self.assertTrue(np.array_equal(winning_model, expected_model))
+        self.assertTrue(np.allclose(test_correlation, expected_correlation))
+        self.assertEqual((p_value, n_drawn), (1 / 201, 200))
+
+        # Noise stops early, once min_exceedances permutations reach it.
+        noise = np.random.default_rng(1).standard_normal(data.shape)
+        _, _, _, p_value, n_drawn = permutation_test(
+            noise, n_permutations=200, min_exceedances=5, seed=0)
+        self.assertLess(n_drawn, 200)
+        self.assertEqual(p_value, 5 / n_drawn)
+        self.assertEqual(permutation_test(
+            noise, n_permutations=200, min_exceedances=5, batch_size=7,
+            seed=0)[3:], (p_value, n_drawn))
+
+    def test_permutation_dimensionality(self):  # noqa:D102
+        brains = np.moveaxis(self.data[:, :, :, :3], 3, 0)
+        res = np.random.standard_normal((3, 64, 30, 6))
+        with ThreadPoolExecutor(2) as executor:
+            results = permutation_dimensionality(
+                brains, 3, self.mask, res=res, option='mean',
+                n_permutations=20, seed=2, pool=executor)
+        expected = functional_dimensionality(brains, 3, self.mask, res=res,
+                                             option='mean', method='gram')
+        for key in expected:
+            self.assertTrue(np.allclose(results[key].astype(float),
+                                        expected[key].astype(float)))
+        self.assertEqual(results['p_value'].shape, (18,))
+        self.assertTrue(np.array_equal(results['p_value'],
+                                       permutation_dimensionality(
+                                           brains, 3, self.mask, res=res,
+                                           option='mean', n_permutations=20,
+                                           seed=2)['p_value']))
+
+        # Through shared memory, into a sink.
+        sink = ArraySink(p_values=True)
+        self.assertIs(permutation_dimensionality(
+            brains, 3, self.mask, res=res, option='mean', n_permutations=20,
+            seed=2, shared_memory=True, sink=sink), sink)
+        table = sink.to_dict()
+        self.assertTrue(np.allclose(table['p_value'], results['p_value']))
+        self.assertTrue(np.array_equal(table['n_permutations'],
+                                       results['n_permutations']))
+        self.assertRaises(ValueError, permutation_dimensionality, brains, 3,
+                          self.mask, sink=ArraySink())
+
+    def test_permutation_batch_size(self):  # noqa:D102
+        # About 10 MB for each permutation of 40 conditions and 8 sessions.
+        self.assertEqual(permutation_batch_size(40, 8, memory=10**9), 101)
+        self.assertEqual(permutation_batch_size(40, 8, itemsize=4,
+                                                memory=10**9), 203)
+        self.assertEqual(permutation_batch_size(1000, 100), 1)
+
+    def test_count_median(self):  # noqa:D102
+        rng = np.random.default_rng(0)
+        for shape, axis in [((50, 8), -1), ((50, 7, 13), 1)]:
+            values = rng.integers(0, 9, size=shape)
+            self.assertTrue(np.array_equal(count_median(values, axis),
+                                           np.median(values, axis)))
+
+    def test_bootstrap(self):  # noqa:D102
+        results = functional_dimensionality(
+            np.moveaxis(self.data[:, :, :, :8], 3, 0), 8, self.mask,
+            option='mean')
+        estimates = bootstrap_dimensionality(results, n_replicates=2000,
+                                             seed=0, chunk_size=500)
+        self.assertEqual(estimates['median_winning_model'],
+                         np.median(results['winning_model']))
+        self.assertAlmostEqual(estimates['mean_test_correlation'],
+                               np.mean(results['test_correlation']))
+        low, high = estimates['mean_test_correlation_ci']
+        self.assertTrue(low < estimates['mean_test_correlation'] < high)
+
+        # The chunks have their own streams, however they are run.
+        with ThreadPoolExecutor(2) as executor:
+            pooled = bootstrap_dimensionality(results, n_replicates=2000,
+                                              seed=0, chunk_size=500,
+                                              pool=executor)
+        for key in estimates:
+            self.assertTrue(np.array_equal(pooled[key], estimates[key]))
+
+        # Trailing axes, such as voxels, are bootstrapped together.
+        models = np.stack([results['winning_model'].reshape(8, 6)] * 3, -1)
+        correlations = np.stack(
+            [results['test_correlation'].reshape(8, 6)] * 3, -1)
+        voxels = bootstrap(models, correlations, n_replicates=2000, seed=0,
+                           chunk_size=500)
+        self.assertEqual(voxels['median_winning_model_ci'].shape, (2, 3))
+        self.assertTrue(np.allclose(voxels['mean_test_correlation_ci'][:, 1],
+                                    estimates['mean_test_correlation_ci']))
+
+        self.assertRaises(ValueError, bootstrap_dimensionality,
+                          {key: value[1:] for key, value in results.items()})
+
+
+class TestGroup(unittest.TestCase):  # noqa:D101
+    def setUp(self):  # noqa:D102
+        rng = np.random.default_rng(0)
+        theta = np.clip(np.round(rng.normal(5, 1, 12)), 1, 15)
+        self.winning_model = np.clip(
+            np.round(theta[:, None] + rng.normal(0, 1.5, (12, 6))), 1, 15)
+
+    def test_log_density(self):  # noqa:D102
+        data = model_data(self.winning_model, 15)
+        rng = np.random.default_rng(1)
+        mu, tau_pop = rng.uniform(1, 15, 3), rng.uniform(0.1, 4, 3)
+        theta = rng.uniform(1, 15, (3, 12))
+        tau_sub = rng.uniform(0.1, 4, (3, 12))
+
+        scale = tau_pop[:, None]
+        expected = truncnorm.logpdf(theta, (1 - mu[:, None]) / scale,
+                                    (15 - mu[:, None]) / scale,
+                                    mu[:, None], scale)
+        expected += truncnorm.logpdf(data['sigma'], -tau_sub,
+                                     data['max_tau_sub'] - tau_sub, tau_sub)
+        df = data['n_runs'] - 1
+        expected += student_t.logpdf(data['y'], df, theta, tau_sub) - \
+            np.log(student_t.cdf(15, df, theta, tau_sub) -
+                   student_t.cdf(1, df, theta, tau_sub))
+        self.assertTrue(np.allclose(
+            log_density(mu, tau_pop, theta, tau_sub, data),
+            expected.sum(axis=-1)))
+
+    def test_hierarchical_bayes(self):  # noqa:D102
+        with ThreadPoolExecutor(2) as executor:
+            draws = hierarchical_bayes(self.winning_model, 15, n_chains=3,
+                                       n_warmup=500, n_draws=500, seed=0,
+                                       pool=executor)
+        self.assertEqual(draws['mu'].shape, (3, 500))
+        self.assertEqual(draws['theta'].shape, (3, 500, 12))
+        self.assertEqual(draws['log_lik'].shape, (3, 500, 12))
+        self.assertLess(abs(np.mean(draws['mu']) -
+                            np.mean(self.winning_model)), 0.5)
+
+        # The chains have their own streams, however they are run.
+        with ThreadPoolExecutor(1) as executor:
+            serial = hierarchical_bayes(self.winning_model, 15, n_chains=3,
+                                        n_warmup=500, n_draws=500, seed=0,
+                                        pool=executor)
+        for key in draws:
+            self.assertTrue(np.array_equal(draws[key], serial[key]))
+
+        self.assertRaises(ValueError, model_data, self.winning_model[:, :1],
+                          15)
+        self.assertRaises(ValueError, model_data, self.winning_model, 4)
+
+
+class TestResults(unittest.TestCase):  # noqa:D101
+    def setUp(self):  # noqa:D102
+        data = np.load('./demos/demo_data/sample_data.npy')
+        self.brains = np.moveaxis(data[:, :, :, :4], 3, 0)
+        self.mask = np.ones((4, 4, 4), dtype='bool')
+
+    def test_array_sink(self):  # noqa:D102
+        expected = functional_dimensionality(self.brains, 4, self.mask)
+        sink = ArraySink(chunk_size=10)
+        with ThreadPoolExecutor(2) as executor:
+            self.assertIs(functional_dimensionality(
+                self.brains, 4, self.mask, pool=executor, sink=sink), sink)
+
+        table = sink.table()
+        self.assertEqual(len(table), 4 * 30)
+        self.assertEqual(sink.categories,
+                         {'subject_ID': ['1', '2', '3', '4']})
+        self.assertEqual(table.dtype['winning_model'], np.int8)
+        self.assertEqual(table.dtype['test_correlation'], np.float32)
+        results = sink.to_dict()
+        for key in expected:
+            self.assertTrue(np.allclose(results[key].astype(float),
+                                        expected[key].astype(float)))
+
+        self.assertRaises(ValueError, ArraySink().append,
+                          {'subject_ID': ['1'], 'test_run': [1],
+                           'winning_model': [200],
+                           'test_correlation': [0.5]})
+        for sink in [ArraySink(roi=True), ArraySink(p_values=True)]:
+            self.assertRaises(ValueError, functional_dimensionality,
+                              self.brains, 4, self.mask, sink=sink)
+
+    def test_npz_sink(self):  # noqa:D102
+        atlas = np.zeros((4, 4, 4), dtype=int)
+        atlas[:2] = 3
+        atlas[2:] = 7
+        expected = multi_roi_dimensionality(self.brains, 4, atlas,
+                                            option='mean')
+        with tempfile.TemporaryDirectory() as path:
+            file_name = os.path.join(path, 'results.npz')
+            with NpzSink(file_name, roi=True, chunk_size=20) as sink:
+                multi_roi_dimensionality(self.brains, 4, atlas,
+                                         option='mean', sink=sink)
+            self.assertEqual(sink.n_chunks, 2)
+            results = load_npz(file_name)
+        for key in expected:
+            self.assertTrue(np.allclose(results[key].astype(float),
+                                        expected[key].astype(float)))
+
+        self.assertRaises(ValueError, multi_roi_dimensionality, self.brains,
+                          4, atlas, sink=ArraySink())
+
+        # A sink closed without any rows.
+        with tempfile.TemporaryDirectory() as path:
+            file_name = os.path.join(path, 'empty.npz')
+            NpzSink(file_name, roi=True).close()
+            results = load_npz(file_name)
+        self.assertEqual(sorted(results), sorted(expected))
+        for column in results:
+            self.assertEqual(len(results[column]), 0)
+        self.assertEqual(results['winning_model'].dtype, np.int8)
+
+    def test_result_sink(self):  # noqa:D102
+        # Sinks must say how to write their rows.
+        self.assertRaises(TypeError, ResultSink)
+
+    def file_sink_round_trip(self, sink_class, read):
+        # The rows written to a file sink, as read back by read, and those
+        # of an ArraySink, with the labels of the categories as strings.
+        atlas = np.zeros((4, 4, 4), dtype=int)
+        atlas[:2] = 3
+        atlas[2:] = 7
+        expected = ArraySink(roi=True)
+        multi_roi_dimensionality(self.brains, 4, atlas, option='mean',
+                                 sink=expected)
+        with tempfile.TemporaryDirectory() as path:
+            file_name = os.path.join(path, 'results')
+            with sink_class(file_name, roi=True, chunk_size=20) as sink:
+                multi_roi_dimensionality(self.brains, 4, atlas,
+                                         option='mean', sink=sink)
+            results = read(file_name)
+        expected = expected.to_dict()
+        self.assertEqual(sorted(results), sorted(expected))
+        for column in expected:
+            if column in ['roi', 'subject_ID']:
+                self.assertTrue(np.array_equal(
+                    results[column], expected[column].astype(str)))
+            else:
+                self.assertEqual(results[column].dtype,
+                                 expected[column].dtype)
+                self.assertTrue(np.array_equal(results[column],
+                                               expected[column]))
+
+    @unittest.skipUnless(h5py, 'needs h5py')
+    def test_hdf5_sink(self):  # noqa:D102
+        def read(file_name):
+            with h5py.File(file_name, 'r') as f:
+                columns = [name for name in f
+                           if not name.endswith('_categories')]
+                return {column: f[column + '_categories'].asstr()[:].astype(
+                    str)[f[column][:]]
+                    if column + '_categories' in f else f[column][:]
+                    for column in columns}
+        self.file_sink_round_trip(Hdf5Sink, read)
+
+    @unittest.skipUnless(pyarrow, 'needs pyarrow')
+    def test_parquet_sink(self):  # noqa:D102
+        def read(file_name):
+            table = pyarrow.parquet.read_table(file_name)
+            return {column: np.array(table.column(column).to_pylist(),
+                                     dtype=str)
+                    if pyarrow.types.is_dictionary(
+                        table.schema.field(column).type)
+                    else table.column(column).to_numpy()
+                    for column in table.column_names}
+        self.file_sink_round_trip(ParquetSink, read)
+
+
+class TestProfiling(unittest.TestCase):  # noqa:D101
+    def test_profile(self):  # noqa:D102
+        data = np.load('./demos/demo_data/sample_data.npy')
+        brains = np.moveaxis(data[:, :, :, :3], 3, 0)
+        mask = np.ones((4, 4, 4), dtype='bool')
+        res = np.random.standard_normal((3, 64, 30, 6))
+        with ThreadPoolExecutor(1) as executor:
+            expected = functional_dimensionality(brains, 3, mask, res=res,
+                                                 pool=executor)
+
+        # The stages run by the worker processes are merged into the
+        # profile.
+        with EstimatorPool(n_workers=2) as pool:
+            with profiling.profile() as profile:
+                results = functional_dimensionality(brains, 3, mask, res=res,
+                                                    pool=pool)
+        self.assertIsNone(profiling.state.profile)
+        for key in expected:
+            self.assertTrue(np.array_equal(results[key], expected[key]))
+
+        report = profile.report()
+        stages = report['stages']
+        for name in ['load', 'select', 'submit', 'wait', 'task', 'estimate',
+                     'pre_proc', 'whitening', 'svd_nested_crossval',
+                     'factorize', 'reconstruct_all', 'assemble']:
+            self.assertIn(name, stages)
+        self.assertEqual(stages['estimate']['count'], 3)
+        self.assertEqual(stages['factorize']['count'], 3 * 6 * 6)
+        self.assertEqual(stages['submit']['bytes'],
+                         brains.nbytes + res.nbytes)
+        self.assertNotIn('pickle', stages)
+        self.assertEqual(sorted(report['subjects']), ['1', '2', '3'])
+        self.assertEqual(sum(worker['count']
+                             for worker in report['workers'].values()), 3)
+
+        with tempfile.TemporaryDirectory() as path:
+            profile.save_chrome_trace(os.path.join(path, 'trace.json'))
+            with open(os.path.join(path, 'trace.json')) as f:
+                trace = json.load(f)
+            profile.save_json(os.path.join(path, 'report.json'))
+            with open(os.path.join(path, 'report.json')) as f:
+                self.assertEqual(json.load(f)['subjects'].keys(),
+                                 report['subjects'].keys())
+        self.assertEqual(len(trace['traceEvents']), len(profile.events))
+        self.assertNotIn(os.getpid(), [event['pid']
+                                       for event in trace['traceEvents']
+                                       if event['name'] == 'task'])
+
+        # Without events, only the totals of each stage are kept.
+        with ThreadPoolExecutor(2) as executor:
+            with profiling.profile(events=False) as profile:
+                functional_dimensionality(brains, 3, mask, res=res,
+                                          pool=executor)
+        self.assertEqual(profile.events, [])
+        self.assertEqual(profile.report()['stages']['estimate']['count'], 3)
+
+        # Pickling the arguments of each task is timed separately.
+        with EstimatorPool(n_workers=2) as pool:
+            with profiling.profile(pickling=True) as profile:
+                functional_dimensionality(brains, 3, mask, res=res, pool=pool)
+            stages = profile.report()['stages']
+            self.assertEqual(stages['pickle']['count'], 3)
+            self.assertGreater(stages['pickle']['bytes'],
+                               brains.nbytes + res.nbytes)
+            # Shared arrays are pickled as their paths.
+            with profiling.profile(pickling=True) as profile:
+                functional_dimensionality(brains, 3, mask, res=res, pool=pool,
+                                          shared_memory=True)
+            self.assertLess(profile.report()['stages']['pickle']['bytes'],
+                            10000)
+
+
+class TestBenchmarks(unittest.TestCase):  # noqa:D101
+    def test_run_benchmarks(self):  # noqa:D102
+        grid = {'voxels': [64, 1000], 'conditions': [8], 'sessions': [4],
+                'subjects': [1, 2]}
+        records = run_benchmarks(grid, ['make_components', 'pre_proc',
+                                        'functional_dimensionality'],
+                                 repeat=2, max_bytes=2**24)
+        self.assertEqual([(record['case'], record['voxels'],
+                           record['subjects']) for record in records],
+                         [('make_components', 64, 1), ('pre_proc', 64, 1),
+                          ('functional_dimensionality', 64, 1),
+                          ('functional_dimensionality', 64, 2),
+                          ('make_components', 1000, 1), ('pre_proc', 1000, 1),
+                          ('functional_dimensionality', 1000, 1),
+                          ('functional_dimensionality', 1000, 2)])
+        for record in records[:5]:
+            self.assertEqual(len(record['times']), 2)
+            self.assertGreater(record['peak_bytes'], 0)
+        for record in records[5:]:
+            self.assertTrue(record['skipped'])
+
 
 class TestUtils(unittest.TestCase):  # noqa:D101
     def test_demo_data(self):  # noqa:D102
         self.assertRaises(ValueError, demo_data, nvoxels=100)
+        self.assertRaises(ValueError, demo_data, functional_dims=21)
+
+        data = demo_data(nvoxels=27, nconditions=8, nruns=3, nsubs=4,
+                         run_noise=0.5, rng=0)
+        self.assertEqual(data.shape, (27, 8, 3, 4))
+        for subject, expected in zip(simulate_subjects(
+                nvoxels=27, nconditions=8, nruns=3, nsubs=4, run_noise=0.5,
+                rng=0), np.moveaxis(data, 3, 0)):
+            self.assertTrue(np.array_equal(subject, expected))
+
+        # Without a generator, the data follow numpy.random's global seed.
+        np.random.seed(0)
+        data = demo_data(nvoxels=27, nsubs=2, run_noise=0.5)
+        np.random.seed(0)
+        self.assertTrue(np.array_equal(
+            demo_data(nvoxels=27, nsubs=2, run_noise=0.5), data))
+
+    def test_simulate_subjects(self):  # noqa:D102
+        # Without noise, each subject repeats one pattern without copying.
+        subjects = list(simulate_subjects([2, 5, 3], nvoxels=64,
+                                          nconditions=8, nruns=4, nsubs=3,
+                                          rng=np.random.default_rng(1)))
+        for n_dims, subject in zip([2, 5, 3], subjects):
+            self.assertEqual(subject.shape, (64, 8, 4))
+            self.assertEqual(subject.strides[2], 0)
+            self.assertEqual(np.linalg.matrix_rank(subject[:, :, 0]), n_dims)
+        self.assertTrue(np.array_equal(subjects[0][:, :2],
+                                       subjects[1][:, :2]))
+
+        # Subject noise is shared by the runs, and run noise is not.
+        subject, = simulate_subjects(3, nvoxels=64, nconditions=8, nruns=4,
+                                     nsubs=1, subject_noise=1.0,
+                                     dtype=np.float32)
+        self.assertEqual(subject.dtype, np.float32)
+        self.assertEqual(np.linalg.matrix_rank(subject[:, :, 0]), 3)
+        subject, = simulate_subjects(3, nvoxels=64, nconditions=8, nruns=4,
+                                     nsubs=1, run_noise=1.0)
+        self.assertFalse(np.array_equal(subject[:, :, 0], subject[:, :, 1]))
+        self.assertEqual(np.linalg.matrix_rank(subject[:, :, 0]), 8)
+
+    def test_load_betas(self):  # noqa:D102
+        n_conditions, n_sessions, n_betas = 3, 2, 8
+        volumes = np.random.random((n_betas, 4, 5, 6)).astype(np.float32)
+        mask = np.zeros((4, 5, 6), dtype=bool)
+        mask[1, 2:4, 3] = True
+        mask[2, 2, 1] = True
+        with tempfile.TemporaryDirectory() as beta_dir:
+            images = []
+            for beta, volume in enumerate(volumes):
+                beta_file = os.path.join(beta_dir, str(beta) + '.nii')
+                nib.save(nib.Nifti1Image(volume, np.eye(4)), beta_file)
+                images.append(nib.load(beta_file))
+
+            # SPM orders the betas by condition, then session.
+            dense = np.transpose(volumes, (1, 2, 3, 0)).reshape(
+                (-1, n_betas // n_sessions, n_sessions))[:, :n_conditions]
+            self.assertTrue(np.array_equal(
+                load_betas(images, n_conditions, n_sessions), dense))
+
+            brain = load_betas(images, n_conditions, n_sessions, mask,
+                               np.float64)
+            self.assertEqual(brain.shape, (3, n_conditions, n_sessions))
+            self.assertEqual(brain.dtype, np.float64)
+            self.assertTrue(np.array_equal(brain, dense[mask.ravel()]))
+
+            self.assertRaises(ValueError, load_betas, images, n_conditions,
+                              n_sessions, mask[:3])
+
+            with ThreadPoolExecutor(4) as executor:
+                self.assertTrue(np.array_equal(load_betas(
+                    images, n_conditions, n_sessions, mask, np.float64,
+                    executor), brain))
+
+    def test_prefetch(self):  # noqa:D102
+        started = []
+
+        def square(x):
+            started.append(x)
+            return x * x
+
+        for i, result in enumerate(prefetch(square, range(10), n_ahead=3)):
+            self.assertEqual(result, i * i)
+            self.assertLessEqual(len(started), i + 4)
+        self.assertEqual(sorted(started), list(range(10)))
+
+        results = prefetch(square, range(10), n_ahead=3)
+        next(results)
+        results.close()
+        self.assertEqual(list(prefetch(square, [])), [])
+
+    def test_load_cached(self):  # noqa:D102
+        calls = []
+
+        def load_brain(spm_path, mask, dtype, executor):
+            calls.append(spm_path)
+            return np.arange(24, dtype=dtype).reshape(2, 3, 4)
+
+        mask = np.ones((2, 1, 1), dtype=bool)
+        with tempfile.TemporaryDirectory() as spm_path, \
+                tempfile.TemporaryDirectory() as cache_dir:
+            spm_file = os.path.join(spm_path, 'SPM.mat')
+            with open(spm_file, 'w') as f:
+                f.write('SPM')
+            key = spm_key(spm_path, mask, np.float32)
+            self.assertNotEqual(key, spm_key(spm_path, ~mask, np.float32))
+            self.assertNotEqual(key, spm_key(spm_path, mask, np.float64))
+
+            cache = NpyCache(cache_dir, mmap_mode='r')
+            brain = load_cached(load_brain, spm_path, cache, mask,
+                                np.float32)
+            self.assertIn(key, cache)
+            self.assertIsInstance(brain, np.memmap)
+            self.assertTrue(np.array_equal(
+                load_cached(load_brain, spm_path, cache, mask, np.float32),
+                brain))
+            self.assertEqual(len(calls), 1)
+
+            # Modifying the SPM directory invalidates the cached brain.
+            os.utime(spm_file, ns=(0, 0))
+            self.assertNotEqual(spm_key(spm_path, mask, np.float32), key)
+            load_cached(load_brain, spm_path, cache, mask, np.float32)
+            self.assertEqual(len(calls), 2)
+
+    def test_npy_cache(self):  # noqa:D102
+        array = np.arange(12.0).reshape(3, 4)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = NpyCache(cache_dir)
+            key = array_key(array)
+            self.assertNotIn(key, cache)
+            cache[key] = array
+            self.assertTrue(np.array_equal(NpyCache(cache_dir)[key], array))
+            self.assertEqual(list(cache), [key])
+            self.assertEqual(len(cache), 1)
+            del cache[key]
+            self.assertRaises(KeyError, cache.__getitem__, key)
+
+            # A failed write leaves neither the array nor its temporary file.
+            unpicklable = np.array([(x for x in [])], dtype=object)
+            self.assertRaises(TypeError, cache.__setitem__, key, unpicklable)
+            self.assertEqual(os.listdir(cache_dir), [])
+        self.assertNotEqual(array_key(array), array_key(array.T))
 
 
 if __name__ == '__main__':